@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# ! JWTAuthentication without the SELECT on core_user per request. The
+# ! user behind a token is kept as a snapshot (the fields requests read)
+# ! in the cache for AUTH_USER_CACHE_TIMEOUT seconds, under a key that
+# ! embeds a per user version number. Saving or deleting a User (password
+# ! change, deactivation, profile edit) bumps that number, so the old
+# ! snapshot is never read again. QuerySet.update() on users sends no
+# ! signal, call invalidate_user() after one.
+# ! The password hash stays out of the shared cache: fields not in the
+# ! snapshot are deferred on the rebuilt user and load from the row when
+# ! something reads them (set_password's check_password, say).
+
+SNAPSHOT_FIELDS = (
+    "id", "username", "email", "first_name", "last_name", "is_active", "is_staff", "is_superuser",
+)
+
+
+def get_cache():
+    return caches[getattr(settings, "AUTH_USER_CACHE", "default")]
+
+
+def get_timeout():
+    return getattr(settings, "AUTH_USER_CACHE_TIMEOUT", 60)
+
+
+def version_key(user_id):
+    return f"auth:user:{user_id}:version"
+
+
+def get_user_version(user_id):
+    cache = get_cache()
+    version = cache.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), 1, timeout=None)
+        version = cache.get(version_key(user_id), 1)
+    return version
+
+
+def bump_user_version(user_id):
+    cache = get_cache()
+    try:
+        return cache.incr(version_key(user_id))
+    except ValueError:
+        # Evicted: anything cached under the old number can't be reached
+        # anyway, but start above 1 so it surely isn't
+        cache.add(version_key(user_id), 1, timeout=None)
+        return cache.incr(version_key(user_id))
+
+
+def invalidate_user(user_id):
+    bump_user_version(user_id)
+    # Again after commit, a request reading the row before the change
+    # committed may have cached it under the new number
+    transaction.on_commit(lambda: bump_user_version(user_id))
+
+
+def user_cache_key(user_id, version):
+    return f"auth:user:{user_id}:snapshot:v{version}"
+
+
+def snapshot(user):
+    # In model field order, from_db() matches a partial row up that way
+    values = {
+        field.attname: getattr(user, field.attname)
+        for field in user._meta.concrete_fields if field.attname in SNAPSHOT_FIELDS
+    }
+    # The revoke check only needs the digest tokens carry, not the hash
+    password_md5 = get_md5_hash_password(user.password) if api_settings.CHECK_REVOKE_TOKEN else None
+    return {"fields": values, "password_md5": password_md5}
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves request.user from a cached snapshot."""
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+
+        cache = get_cache()
+        # Version first: a save after this point makes whatever we store unreachable
+        key = user_cache_key(user_id, get_user_version(user_id))
+        cached = cache.get(key)
+        if cached is None:
+            user = super().get_user(validated_token)
+            cache.set(key, snapshot(user), get_timeout())
+            return user
+
+        values = cached["fields"]
+        user = self.user_model.from_db(DEFAULT_DB_ALIAS, list(values), list(values.values()))
+        self.check_user(user, validated_token, cached["password_md5"])
+        return user
+
+    def check_user(self, user, validated_token, password_md5):
+        # Same checks JWTAuthentication.get_user does on the row
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password_md5:
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
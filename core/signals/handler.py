@@ -1,7 +1,16 @@
 from store.signals import order_created
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from core.authentication import invalidate_user
 
 
 @receiver(order_created)
-def on_order_create(send, **kwargs):
-    print(kwargs['order'])
\ No newline at end of file
+def on_order_create(sender, **kwargs):
+    print(kwargs['order'])
+
+
+# Any change to a user (password, is_active, profile) drops its cached auth snapshot
+@receiver([post_save, post_delete], sender = settings.AUTH_USER_MODEL)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
@@ -1,3 +1,95 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.authentication import api_settings, get_user_version, invalidate_user, user_cache_key
+from core.models import User
+from store.models import Cart
 
 # Create your tests here.
+
+
+# ! CachedJWTAuthentication: the per request SELECT on core_user is gone
+# ! once the snapshot is cached, and any change to the user drops it.
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        # override_settings(SIMPLE_JWT=...) rebinds simplejwt's module
+        # global, the modules that imported api_settings keep this object
+        revoke = mock.patch.object(api_settings, "CHECK_REVOKE_TOKEN", True)
+        revoke.start()
+        self.addCleanup(revoke.stop)
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="cached", email="cached@example.com", password="old-secret",
+        )
+        self.cart = Cart.objects.create()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"JWT {AccessToken.for_user(user)}")
+        return client
+
+    def cached_snapshot(self):
+        return cache.get(user_cache_key(self.user.pk, get_user_version(self.user.pk)))
+
+    def queries(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [query["sql"] for query in queries.captured_queries]
+
+    def test_cached_user_saves_the_user_query(self):
+        client = self.client_for(self.user)
+        for url in [f"/store/carts/{self.cart.id}/", "/store/orders/", "/auth/users/me/"]:
+            with self.subTest(url):
+                # First call creates whatever the view creates once (the customer row)
+                client.get(url)
+                invalidate_user(self.user.pk)
+                cold = self.queries(client, url)
+                warm = self.queries(client, url)
+                self.assertEqual(len(warm), len(cold) - 1, warm)
+                self.assertFalse([sql for sql in warm if 'FROM "core_user"' in sql], warm)
+
+    def test_current_user_comes_from_the_snapshot(self):
+        client = self.client_for(self.user)
+        client.get("/auth/users/me/")
+        self.assertEqual(self.queries(client, "/auth/users/me/"), [])
+        self.assertEqual(client.get("/auth/users/me/").data["username"], "cached")
+
+    def test_password_hash_is_not_cached(self):
+        self.client_for(self.user).get("/auth/users/me/")
+        cached = self.cached_snapshot()
+        self.assertIsNotNone(cached)
+        self.assertNotIn("password", cached["fields"])
+        self.assertNotIn(self.user.password, str(cached))
+
+    def test_password_change_evicts_the_snapshot(self):
+        client = self.client_for(self.user)
+        client.get("/auth/users/me/")
+        response = client.post(
+            "/auth/users/set_password/",
+            {"current_password": "old-secret", "new_password": "New-secret-123"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 204, response.data)
+        self.assertIsNone(self.cached_snapshot())
+
+        # The old token carries the old password's digest
+        response = client.get("/auth/users/me/")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data["code"], "password_changed")
+
+    def test_deactivation_evicts_the_snapshot(self):
+        client = self.client_for(self.user)
+        client.get("/auth/users/me/")
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.cached_snapshot())
+
+        response = client.get("/auth/users/me/")
+        self.assertEqual(response.status_code, 401)
@@ -6,6 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
+    # Tests run on SQLite unless DJANGO_SETTINGS_MODULE says otherwise
+    if sys.argv[1:2] == ["test"]:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "storefront.test_settings")
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "storefront.settings")
     try:
         from django.core.management import execute_from_command_line
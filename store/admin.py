@@ -4,9 +4,11 @@ from django.contrib import admin, messages
 from django.contrib import admin
 from django.db.models.query import QuerySet
 from . import models
+from .cache import invalidate_catalog
 from django.db.models import Count
 from django.utils.html import format_html, urlencode
 from django.urls import reverse
+from django.utils import timezone
 
 
 # ! so here we are making a custom filter on products in admin panel
@@ -91,7 +93,10 @@ class ProductAdmin(admin.ModelAdmin):
     # ! Creating custom actions
     @admin.action(description='clear inventory')
     def clear_inventory(self, request, queryset):
-        updates_count = queryset.update(inventory = 0)
+        # ! update() skips auto_now, so set last_update by hand (ETags use it)
+        updates_count = queryset.update(inventory = 0, last_update = timezone.now())
+        # ! update() does not send post_save, so drop the cached catalog ourselves
+        invalidate_catalog()
         self.message_user(request,
                           f"{updates_count} Products were successfully updated",
         # ! If I uncomment this below it will dispaly error red meesage
@@ -135,7 +140,8 @@ class OrderAdmin(admin.ModelAdmin):
     # calling its field, and model is returning str of firt name last name 
     # combine
 
-    list_display = ["id", 'placed_at', "customer"]
+    list_display = ["id", 'placed_at', "customer", "item_count", "total_price"]
+    list_select_related = ["customer__user"]
     list_per_page = 10
     autocomplete_fields = ["customer"]
     # ! This means that in "Order" model admin panel; we are displaying table of Orders placed
@@ -146,3 +152,26 @@ class OrderAdmin(admin.ModelAdmin):
     def customer_first_name(self, order):
         return order.customer.first_name
 
+
+
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = models.ArchivedOrderItem
+    fields = ["product", "quantity", "unit_price"]
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+# ! Orders moved out of the hot tables by archive_orders, read only
+@admin.register(models.ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ["id", "placed_at", "customer", "payment_status", "item_count", "total_price"]
+    list_select_related = ["customer__user"]
+    list_per_page = 10
+    readonly_fields = ["id", "placed_at", "payment_status", "customer", "item_count", "total_price", "archived_at"]
+    inlines = [ArchivedOrderItemInline]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,106 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import (
+    ArchiveCheckpoint, ArchivedOrder, ArchivedOrderItem, Order, OrderEvent, OrderItem,
+)
+
+# ! Moves orders older than STORE_ORDER_ARCHIVE_AFTER (with their items)
+# ! from store_order / store_orderitem into the archive tables, a batch
+# ! per transaction: copy, delete from the hot tables, advance the
+# ! checkpoint. A batch is all or nothing, and the next run starts after
+# ! the last order the checkpoint says is done.
+# ! Orders whose outbox events (OrderEvent) aren't delivered yet stay
+# ! behind, and so does the checkpoint: the relay still needs the order,
+# ! a later run archives it once the events are out.
+
+CHECKPOINT = "orders"
+
+ORDER_FIELDS = ["id", "placed_at", "payment_status", "customer_id", "item_count", "total_price"]
+ITEM_FIELDS = ["id", "order_id", "product_id", "quantity", "unit_price"]
+
+
+def get_archive_age():
+    return timedelta(seconds=getattr(settings, "STORE_ORDER_ARCHIVE_AFTER", 60 * 60 * 24 * 365))
+
+
+def _pending_events():
+    return Exists(OrderEvent.objects.filter(order=OuterRef("pk"), delivered_at__isnull=True))
+
+
+def _delete_where(model, column, ids):
+    quote = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {quote(model._meta.db_table)} WHERE {quote(column)} IN ({placeholders})", ids
+        )
+
+
+def archive_batch(checkpoint, cutoff, batch_size):
+    """Archive the next batch after the checkpoint, returns orders moved."""
+    with transaction.atomic():
+        orders = list(
+            Order.objects.select_for_update()
+            .filter(~_pending_events(), id__gt=checkpoint.last_id, placed_at__lt=cutoff)
+            .order_by("id").values(*ORDER_FIELDS)[:batch_size]
+        )
+        if not orders:
+            return 0
+        ids = [order["id"] for order in orders]
+        items = list(OrderItem.objects.filter(order_id__in=ids).values(*ITEM_FIELDS))
+
+        ArchivedOrder.objects.bulk_create([ArchivedOrder(**order) for order in orders])
+        ArchivedOrderItem.objects.bulk_create([ArchivedOrderItem(**item) for item in items], batch_size=1000)
+
+        # Plain SQL DELETEs, no collector and so no post_delete: the only
+        # receiver is the OrderItem one refreshing Order.item_count /
+        # total_price, one UPDATE per item for orders that are leaving the
+        # table in this same batch, with their totals already copied.
+        # Customer history is lifetime (archive included), nothing to undo.
+        # Pinned by OrderArchiveTests. The events left are delivered ones.
+        _delete_where(OrderItem, "order_id", ids)
+        _delete_where(OrderEvent, "order_id", ids)
+        _delete_where(Order, "id", ids)
+
+        # Old orders still in the table between the checkpoint and this
+        # batch are the ones held back, don't move past the first of them
+        held = Order.objects.filter(
+            id__gt=checkpoint.last_id, id__lt=ids[-1], placed_at__lt=cutoff
+        ).order_by("id").values_list("id", flat=True).first()
+        checkpoint.last_id = ids[-1] if held is None else held - 1
+        checkpoint.archived += len(ids)
+        checkpoint.save()
+    return len(ids)
+
+
+def archive_orders(age=None, batch_size=500, max_batches=None, pause=0, reset=False):
+    """Archive old orders in batches, returns a stats dict."""
+    cutoff = timezone.now() - (get_archive_age() if age is None else age)
+    checkpoint, _ = ArchiveCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    if reset:
+        checkpoint.last_id = 0
+        checkpoint.save()
+    started = time.monotonic()
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = archive_batch(checkpoint, cutoff, batch_size)
+        if not count:
+            break
+        moved += count
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    seconds = time.monotonic() - started
+    return {
+        "orders": moved,
+        "batches": batches,
+        "checkpoint": checkpoint.last_id,
+        "seconds": seconds,
+        "orders_per_second": moved / seconds if seconds else 0.0,
+    }
@@ -0,0 +1,85 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+# ! Read-through cache for catalog reads (products, collections).
+# ! Every key embeds a "catalog version" number, writes to Product,
+# ! Collection or Promotion bump that number once they commit, so all old
+# ! entries become unreachable at once and simply expire from the cache.
+VERSION_KEY = "catalog:version"
+
+
+def get_cache():
+    return caches[getattr(settings, "STORE_CATALOG_CACHE", "default")]
+
+
+def get_timeout():
+    return getattr(settings, "STORE_CATALOG_CACHE_TIMEOUT", 60 * 5)
+
+
+def get_catalog_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version(**kwargs):
+    # kwargs so it can be connected directly as a signal receiver
+    cache = get_cache()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # Key was evicted, start a new generation that can't clash with old keys
+        cache.add(VERSION_KEY, 1, timeout=None)
+        return cache.incr(VERSION_KEY)
+
+
+def invalidate_catalog(**kwargs):
+    # Bump once the write commits: bumped before, a concurrent reader could
+    # miss the new version, read the old rows and cache them under it.
+    # robust: a cache error is logged, it doesn't fail the committed write
+    transaction.on_commit(bump_catalog_version, robust=True)
+
+
+def normalize_query(query_params):
+    # ?b=2&a=1 and ?a=1&b=2 are the same request
+    items = sorted((key, sorted(values)) for key, values in query_params.lists())
+    return urlencode(items, doseq=True)
+
+
+def catalog_cache_key(request, version=None):
+    version = get_catalog_version() if version is None else version
+    raw = f"{request.get_host()}{request.path}?{normalize_query(request.query_params)}"
+    digest = hashlib.md5(raw.encode("utf-8")).hexdigest()
+    return f"catalog:v{version}:{digest}"
+
+
+class CatalogCacheMixin:
+    """Serve list/retrieve from the catalog cache, filling it on a miss."""
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        cache = get_cache()
+        key = catalog_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data, headers={"X-Cache": "HIT"})
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, get_timeout())
+            response["X-Cache"] = "MISS"
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
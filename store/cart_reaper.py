@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .cart_storage import get_cart_storage
+from .models import Cart, CartItem
+
+logger = logging.getLogger(__name__)
+
+# ! Abandoned carts: nobody ever deletes a cart that wasn't checked out, so
+# ! store_cart / store_cartitem only ever grow. reap_abandoned_carts()
+# ! deletes carts nobody changed for longer than the TTL (Cart.updated_at,
+# ! so a cart still being filled isn't reaped for its age), longest idle
+# ! first, a small chunk of primary keys per transaction so no lock is
+# ! held for long.
+# ! Carts being checked out are row locked (select_for_update in
+# ! CreateOrderSerializer.save); we skip locked rows instead of waiting.
+
+
+def get_ttl():
+    return timedelta(seconds=getattr(settings, "STORE_CART_TTL", 60 * 60 * 24 * 30))
+
+
+def lock_chunk(ids, cutoff):
+    # Still idle: a cart changed since we picked the chunk is left alone
+    queryset = Cart.objects.filter(pk__in=ids, updated_at__lt=cutoff)
+    if connection.features.has_select_for_update_skip_locked:
+        queryset = queryset.select_for_update(skip_locked=True)
+    # SQLite has no row locks, a checkout there holds the database write
+    # lock, so our DELETE simply waits for it to commit
+    return list(queryset.values_list("pk", flat=True))
+
+
+def reap_abandoned_carts(ttl=None, chunk_size=500, pause=0, now=None):
+    """Delete carts last changed more than ttl ago, returns a stats dict."""
+    cutoff = (now or timezone.now()) - (ttl or get_ttl())
+    storage = get_cart_storage()
+    stats = {"carts": 0, "items": 0, "chunks": 0, "skipped": 0}
+    started = time.monotonic()
+    last = None
+
+    while True:
+        queryset = Cart.objects.filter(updated_at__lt=cutoff)
+        if last is not None:
+            # Keyset on the (updated_at, id) index, carts we skipped stay behind us
+            queryset = queryset.filter(
+                Q(updated_at__gt=last[0]) | Q(updated_at=last[0], id__gt=last[1])
+            )
+        chunk = list(queryset.order_by("updated_at", "id").values_list("updated_at", "id")[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1]
+        ids = [cart_id for _, cart_id in chunk]
+
+        with transaction.atomic():
+            locked = lock_chunk(ids, cutoff)
+            items, _ = CartItem.objects.filter(cart_id__in=locked).delete()
+            carts, _ = Cart.objects.filter(pk__in=locked).delete()
+        storage.discard(locked)
+
+        stats["carts"] += carts
+        stats["items"] += items
+        stats["chunks"] += 1
+        stats["skipped"] += len(ids) - len(locked)
+        if len(chunk) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    stats["seconds"] = time.monotonic() - started
+    stats["carts_per_second"] = stats["carts"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+class CartReaper(threading.Thread):
+    """Runs reap_abandoned_carts every interval seconds until stop()."""
+
+    def __init__(self, interval, **options):
+        super().__init__(name="cart-reaper", daemon=True)
+        self.interval = interval
+        self.options = options
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                stats = reap_abandoned_carts(**self.options)
+                logger.info("Reaped %(carts)s carts (%(items)s items) in %(seconds).2fs", stats)
+            except Exception:
+                logger.exception("Reaping abandoned carts failed")
+            finally:
+                close_old_connections()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def start_cart_reaper():
+    # ! Optional in-process scheduler, only when STORE_CART_REAPER_INTERVAL
+    # ! is set. Otherwise run `manage.py reap_carts` from cron.
+    global _reaper
+    interval = getattr(settings, "STORE_CART_REAPER_INTERVAL", None)
+    if not interval:
+        return None
+    with _reaper_lock:
+        if _reaper is None or not _reaper.is_alive():
+            _reaper = CartReaper(interval, chunk_size=getattr(settings, "STORE_CART_REAPER_CHUNK", 500))
+            _reaper.start()
+    return _reaper
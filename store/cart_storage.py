@@ -0,0 +1,461 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Case, Count, DateTimeField, Value, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .carts import (
+    CartNotFound, ProductNotFound, add_cart_item, cart_items_with_totals,
+    cart_summary, carts_with_totals, money, sync_cart_items, touch_cart,
+)
+from .models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+# ! Where carts live. CartViewSet, CartItemsViewSet and checkout only talk
+# ! to a cart storage, never to Cart / CartItem directly:
+# !  - DatabaseCartStorage: every change goes straight to store_cart(item)
+# !  - CacheCartStorage: carts live in the Django cache and are written
+# !    behind to the database in batches, and always before checkout
+# ! Both hand back Cart / CartItem instances so the serializers don't care.
+
+
+class CartBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The cart is being changed by another request, try again."
+    default_code = "cart_busy"
+
+
+class CartStateLost(Exception):
+    """Dirty carts whose cached state was gone before a flush wrote it."""
+
+    def __init__(self, cart_ids, flushed=0):
+        super().__init__(
+            f"changes to {len(cart_ids)} carts left the cache before they were written: {', '.join(cart_ids)}"
+        )
+        self.cart_ids = cart_ids
+        self.flushed = flushed
+
+
+class BaseCartStorage:
+    def create_cart(self):
+        raise NotImplementedError
+
+    def get_cart(self, cart_id):
+        """Cart with .total_price and its items, or None."""
+        raise NotImplementedError
+
+    def delete_cart(self, cart_id):
+        raise NotImplementedError
+
+    def get_items(self, cart_id):
+        raise NotImplementedError
+
+    def get_item(self, cart_id, item_id):
+        raise NotImplementedError
+
+    def add_item(self, cart_id, product_id, quantity):
+        """Raises CartNotFound / ProductNotFound."""
+        raise NotImplementedError
+
+    def update_item(self, cart_id, item_id, quantity):
+        raise NotImplementedError
+
+    def remove_item(self, cart_id, item_id):
+        raise NotImplementedError
+
+    def replace_items(self, cart_id, quantities):
+        """Make the cart hold exactly {product_id: quantity}.
+        Raises CartNotFound / ProductNotFound (with the missing ids)."""
+        raise NotImplementedError
+
+    def summary(self, cart_id):
+        raise NotImplementedError
+
+    def item_count(self, cart_id):
+        """Number of lines in the cart, None when there is no such cart."""
+        raise NotImplementedError
+
+    def prepare_checkout(self, cart_id):
+        """Make sure store_cart / store_cartitem hold the latest cart state."""
+
+    def checked_out(self, cart_id):
+        """Called once the order for this cart is committed."""
+
+    def discard(self, cart_ids):
+        """Forget carts whose rows were deleted behind our back (reap_carts)."""
+
+    def flush(self, cart_ids=None):
+        """Write pending changes to the database, returns carts written."""
+        return 0
+
+
+class DatabaseCartStorage(BaseCartStorage):
+    def create_cart(self):
+        cart = Cart.objects.create()
+        cart.total_price = money(0)
+        return cart
+
+    def get_cart(self, cart_id):
+        return carts_with_totals().filter(pk=cart_id).first()
+
+    def delete_cart(self, cart_id):
+        deleted, _ = Cart.objects.filter(pk=cart_id).delete()
+        return deleted > 0
+
+    def get_items(self, cart_id):
+        return list(cart_items_with_totals().filter(cart_id=cart_id))
+
+    def get_item(self, cart_id, item_id):
+        return cart_items_with_totals().filter(cart_id=cart_id, pk=item_id).first()
+
+    def add_item(self, cart_id, product_id, quantity):
+        return add_cart_item(cart_id, product_id, quantity)
+
+    def update_item(self, cart_id, item_id, quantity):
+        updated = CartItem.objects.filter(cart_id=cart_id, pk=item_id).update(quantity=quantity) > 0
+        if updated:
+            touch_cart(cart_id)
+        return updated
+
+    def remove_item(self, cart_id, item_id):
+        deleted, _ = CartItem.objects.filter(cart_id=cart_id, pk=item_id).delete()
+        if deleted:
+            touch_cart(cart_id)
+        return deleted > 0
+
+    def replace_items(self, cart_id, quantities):
+        return sync_cart_items(cart_id, quantities)
+
+    def summary(self, cart_id):
+        return cart_summary(cart_id)
+
+    def item_count(self, cart_id):
+        return Cart.objects.filter(pk=cart_id) \
+            .annotate(count=Count("items")) \
+            .values_list("count", flat=True).first()
+
+
+@contextmanager
+def cache_lock(cache, key, timeout=5, wait=2):
+    # cache.add only succeeds for one caller, so it works as a small mutex
+    # across threads (locmem) or processes (shared cache backends)
+    token = uuid4().hex
+    deadline = time.monotonic() + wait
+    while not cache.add(key, token, timeout):
+        if time.monotonic() > deadline:
+            # A 503 through the API, the client can simply retry
+            raise CartBusy()
+        time.sleep(0.002)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+class CacheCartStorage(BaseCartStorage):
+    """Hot store for carts on top of the Django cache API.
+
+    A cart is one cache entry {"items": {product_id: quantity}}, so line
+    ids in this mode are product ids. Changed carts are remembered in a
+    "dirty" entry and written to the database in batches once there are
+    flush_batch of them or the oldest waited flush_interval seconds,
+    by the flush_carts command, and always before checkout.
+
+    Until then the cache holds the only copy of a change, so
+    STORE_CART_CACHE must be a cache that doesn't evict (see CACHES)."""
+
+    key_prefix = "cartstore"
+    # Seconds to wait for another request's lock on the same cart
+    lock_wait = 2
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, "STORE_CART_CACHE", "default")]
+        self.timeout = getattr(settings, "STORE_CART_CACHE_TIMEOUT", 60 * 60 * 24)
+        self.flush_batch = getattr(settings, "STORE_CART_FLUSH_BATCH", 50)
+        self.flush_interval = getattr(settings, "STORE_CART_FLUSH_INTERVAL", 30)
+        self.dirty_key = f"{self.key_prefix}:dirty"
+
+    def cart_key(self, cart_id):
+        return f"{self.key_prefix}:cart:{cart_id}"
+
+    def lock(self, key):
+        return cache_lock(self.cache, f"{key}:lock", wait=self.lock_wait)
+
+    # State ---------------------------------------------------------------
+
+    def load(self, cart_id):
+        """Cart state from the cache, read through from the database on a miss."""
+        state = self.cache.get(self.cart_key(cart_id))
+        if state is None:
+            cart = Cart.objects.filter(pk=cart_id).first()
+            if cart is None:
+                return None
+            items = CartItem.objects.filter(cart_id=cart_id).order_by("id")
+            state = {
+                "items": {item.product_id: item.quantity for item in items},
+                "created_at": cart.created_at,
+                "updated_at": cart.updated_at,
+                "deleted": False,
+            }
+            self.cache.add(self.cart_key(cart_id), state, self.timeout)
+        if state.get("deleted"):
+            return None
+        return state
+
+    def store(self, cart_id, state):
+        state["updated_at"] = timezone.now()
+        self.cache.set(self.cart_key(cart_id), state, self.timeout)
+        self.mark_dirty(cart_id)
+
+    def add_dirty(self, cart_id):
+        with self.lock(self.dirty_key):
+            dirty = self.cache.get(self.dirty_key) or {}
+            dirty.setdefault(str(cart_id), time.time())
+            self.cache.set(self.dirty_key, dirty, None)
+        return dirty
+
+    def mark_dirty(self, cart_id):
+        dirty = self.add_dirty(cart_id)
+        waited = time.time() - min(dirty.values())
+        if len(dirty) >= self.flush_batch or waited >= self.flush_interval:
+            try:
+                self.flush(sorted(dirty, key=dirty.get)[:self.flush_batch])
+            except CartStateLost:
+                # Other people's carts, don't fail this request over them
+                logger.exception("Cart write behind lost changes")
+
+    def build_items(self, cart_id, state):
+        products = Product.objects.only("id", "title", "unit_price").in_bulk(list(state["items"]))
+        items = []
+        for product_id, quantity in state["items"].items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            item = CartItem(id=product_id, cart_id=cart_id, product=product, quantity=quantity)
+            item.total_price = money(quantity * product.unit_price)
+            items.append(item)
+        return items
+
+    def build_cart(self, cart_id, state):
+        items = self.build_items(cart_id, state)
+        cart = Cart(id=cart_id, created_at=state["created_at"], updated_at=state.get("updated_at"))
+        cart.total_price = money(sum(item.total_price for item in items))
+        # Let CartSerializer read cart.items.all() without a query
+        prefetched = CartItem.objects.none()
+        prefetched._result_cache = items
+        prefetched._prefetch_done = True
+        cart._prefetched_objects_cache = {"items": prefetched}
+        return cart
+
+    # Storage API ---------------------------------------------------------
+
+    def create_cart(self):
+        cart_id = uuid4()
+        state = {"items": {}, "created_at": timezone.now(), "deleted": False}
+        self.store(cart_id, state)
+        return self.build_cart(cart_id, state)
+
+    def get_cart(self, cart_id):
+        state = self.load(cart_id)
+        return None if state is None else self.build_cart(cart_id, state)
+
+    def delete_cart(self, cart_id):
+        with self.lock(self.cart_key(cart_id)):
+            if self.load(cart_id) is None:
+                return False
+            # Tombstone, so the next flush deletes the database rows too
+            self.store(cart_id, {"items": {}, "created_at": None, "deleted": True})
+        return True
+
+    def get_items(self, cart_id):
+        state = self.load(cart_id)
+        return [] if state is None else self.build_items(cart_id, state)
+
+    def get_item(self, cart_id, item_id):
+        return next((item for item in self.get_items(cart_id) if item.id == int(item_id)), None)
+
+    def add_item(self, cart_id, product_id, quantity):
+        if not Product.objects.filter(pk=product_id).exists():
+            raise ProductNotFound(product_id)
+        with self.lock(self.cart_key(cart_id)):
+            state = self.load(cart_id)
+            if state is None:
+                raise CartNotFound(cart_id)
+            state["items"][product_id] = state["items"].get(product_id, 0) + quantity
+            self.store(cart_id, state)
+        return CartItem(id=product_id, cart_id=cart_id, product_id=product_id,
+                        quantity=state["items"][product_id])
+
+    def update_item(self, cart_id, item_id, quantity):
+        with self.lock(self.cart_key(cart_id)):
+            state = self.load(cart_id)
+            if state is None or int(item_id) not in state["items"]:
+                return False
+            state["items"][int(item_id)] = quantity
+            self.store(cart_id, state)
+        return True
+
+    def remove_item(self, cart_id, item_id):
+        with self.lock(self.cart_key(cart_id)):
+            state = self.load(cart_id)
+            if state is None or state["items"].pop(int(item_id), None) is None:
+                return False
+            self.store(cart_id, state)
+        return True
+
+    def replace_items(self, cart_id, quantities):
+        existing = set(Product.objects.filter(id__in=list(quantities)).values_list("id", flat=True))
+        missing = set(quantities) - existing
+        if missing:
+            raise ProductNotFound(sorted(missing))
+        with self.lock(self.cart_key(cart_id)):
+            state = self.load(cart_id)
+            if state is None:
+                raise CartNotFound(cart_id)
+            current = state["items"]
+            changes = {
+                "created": len(set(quantities) - set(current)),
+                "updated": sum(1 for product_id in current
+                               if product_id in quantities and quantities[product_id] != current[product_id]),
+                "deleted": len(set(current) - set(quantities)),
+            }
+            state["items"] = dict(quantities)
+            self.store(cart_id, state)
+        return changes
+
+    def summary(self, cart_id):
+        state = self.load(cart_id)
+        if state is None:
+            return None
+        items = self.build_items(cart_id, state)
+        return {
+            "id": cart_id,
+            "item_count": len(items),
+            "quantity": sum(item.quantity for item in items),
+            "total_price": money(sum(item.total_price for item in items)),
+        }
+
+    def item_count(self, cart_id):
+        state = self.load(cart_id)
+        return None if state is None else len(state["items"])
+
+    def prepare_checkout(self, cart_id):
+        self.flush([cart_id])
+
+    def checked_out(self, cart_id):
+        self.discard([cart_id])
+
+    def discard(self, cart_ids):
+        if not cart_ids:
+            return
+        with self.lock(self.dirty_key):
+            dirty = self.cache.get(self.dirty_key) or {}
+            for cart_id in cart_ids:
+                dirty.pop(str(cart_id), None)
+            self.cache.set(self.dirty_key, dirty, None)
+        self.cache.delete_many([self.cart_key(cart_id) for cart_id in cart_ids])
+
+    # Write behind ----------------------------------------------------------
+
+    def flush(self, cart_ids=None):
+        with self.lock(self.dirty_key):
+            dirty = self.cache.get(self.dirty_key) or {}
+            if cart_ids is None:
+                cart_ids = list(dirty)
+            cart_ids = [str(cart_id) for cart_id in cart_ids]
+            for cart_id in cart_ids:
+                dirty.pop(cart_id, None)
+            self.cache.set(self.dirty_key, dirty, None)
+        if not cart_ids:
+            return 0
+
+        states = self.cache.get_many([self.cart_key(cart_id) for cart_id in cart_ids])
+        live, deleted, lost = {}, [], []
+        for cart_id in cart_ids:
+            state = states.get(self.cart_key(cart_id))
+            if state is None:
+                # Evicted or expired before it was written: the changes are gone
+                lost.append(cart_id)
+                continue
+            if state.get("deleted"):
+                deleted.append(cart_id)
+            else:
+                live[cart_id] = state
+
+        try:
+            self.write(live, deleted)
+        except Exception:
+            # Keep them dirty so the next flush tries again
+            for cart_id in cart_ids:
+                self.add_dirty(cart_id)
+            raise
+        self.cache.delete_many([self.cart_key(cart_id) for cart_id in deleted])
+        if lost:
+            # Keep them dirty so they stay visible until someone looks
+            # (discard() or reading the cart back from the database)
+            for cart_id in lost:
+                self.add_dirty(cart_id)
+            raise CartStateLost(lost, flushed=len(live) + len(deleted))
+        return len(live) + len(deleted)
+
+    def write(self, live, deleted):
+        product_ids = {product_id for state in live.values() for product_id in state["items"]}
+        existing = set(Product.objects.filter(id__in=product_ids).values_list("id", flat=True))
+        with transaction.atomic():
+            Cart.objects.bulk_create(
+                [Cart(id=cart_id) for cart_id in live], ignore_conflicts=True
+            )
+            # auto_now(_add) stamp the flush time on insert, put back when
+            # the carts were really created and last changed (the reaper
+            # goes by updated_at)
+            stamped = {cart_id: state for cart_id, state in live.items() if state["created_at"]}
+            if stamped:
+                Cart.objects.filter(pk__in=list(stamped)).update(**{
+                    field: Case(
+                        *[When(pk=cart_id, then=Value(state.get(field) or state["created_at"]))
+                          for cart_id, state in stamped.items()],
+                        output_field=DateTimeField(),
+                    )
+                    for field in ("created_at", "updated_at")
+                })
+            CartItem.objects.filter(cart_id__in=list(live)).delete()
+            CartItem.objects.bulk_create([
+                CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                for cart_id, state in live.items()
+                for product_id, quantity in state["items"].items()
+                if product_id in existing
+            ], batch_size=500)
+            if deleted:
+                Cart.objects.filter(pk__in=deleted).delete()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_cart_storage():
+    # settings.STORE_CART_STORAGE picks the backend, database by default
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                path = getattr(settings, "STORE_CART_STORAGE", "store.cart_storage.DatabaseCartStorage")
+                _storage = import_string(path)()
+    return _storage
+
+
+def reset_cart_storage():
+    global _storage
+    with _storage_lock:
+        _storage = None
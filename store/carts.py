@@ -0,0 +1,200 @@
+from contextlib import nullcontext
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+# ! "Add to cart" as ONE statement. The row is inserted from a SELECT on
+# ! store_product, so a missing product simply inserts nothing (that's the
+# ! existence check), and an existing (cart, product) row gets its quantity
+# ! incremented by the database itself, so concurrent clicks never lose an
+# ! increment or trip over the unique_together constraint.
+
+
+class ProductNotFound(Exception):
+    pass
+
+
+class CartNotFound(Exception):
+    pass
+
+
+def touch_cart(cart_id):
+    """Record activity on a cart (item writes don't save the Cart row),
+    returns False when there is no such cart."""
+    return Cart.objects.filter(pk=cart_id).update(updated_at=timezone.now()) > 0
+
+
+def _tables():
+    quote = connection.ops.quote_name
+    return quote(CartItem._meta.db_table), quote(Product._meta.db_table)
+
+
+def add_cart_item(cart_id, product_id, quantity):
+    """Insert or increment a cart line, returns the saved CartItem."""
+    cart_id = CartItem._meta.get_field("cart").get_db_prep_value(cart_id, connection)
+    mysql = connection.vendor == "mysql"
+    # A lone statement is atomic in autocommit mode; we only need a
+    # transaction for the MySQL read-back or a savepoint inside an outer one
+    if mysql or connection.in_atomic_block:
+        block = transaction.atomic()
+    else:
+        block = nullcontext()
+    try:
+        with block:
+            if mysql:
+                item_id, total = _upsert_mysql(cart_id, product_id, quantity)
+            else:
+                item_id, total = _upsert_returning(cart_id, product_id, quantity)
+            touch_cart(cart_id)
+    except IntegrityError:
+        # The only FK left unchecked by the SELECT is the cart
+        raise CartNotFound(cart_id)
+    return CartItem(id=item_id, cart_id=cart_id, product_id=product_id, quantity=total)
+
+
+def _upsert_returning(cart_id, product_id, quantity):
+    # SQLite >= 3.35 and PostgreSQL: ON CONFLICT ... RETURNING, one round trip
+    items, products = _tables()
+    sql = (
+        f"INSERT INTO {items} (cart_id, product_id, quantity) "
+        f"SELECT %s, id, %s FROM {products} WHERE id = %s "
+        f"ON CONFLICT (cart_id, product_id) "
+        f"DO UPDATE SET quantity = {items}.quantity + excluded.quantity "
+        f"RETURNING id, quantity"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [cart_id, quantity, product_id])
+        row = cursor.fetchone()
+    if row is None:
+        raise ProductNotFound(product_id)
+    return row
+
+
+def _upsert_mysql(cart_id, product_id, quantity):
+    # No RETURNING on MySQL. id = LAST_INSERT_ID(id) makes lastrowid point at
+    # the row for inserts and updates alike, the new total is one PK lookup.
+    items, products = _tables()
+    sql = (
+        f"INSERT INTO {items} (cart_id, product_id, quantity) "
+        f"SELECT %s, id, %s FROM {products} WHERE id = %s "
+        f"ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), "
+        f"quantity = quantity + VALUES(quantity)"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [cart_id, quantity, product_id])
+        if cursor.rowcount == 0:
+            raise ProductNotFound(product_id)
+        item_id = cursor.lastrowid
+        cursor.execute(f"SELECT quantity FROM {items} WHERE id = %s", [item_id])
+        (total,) = cursor.fetchone()
+    return item_id, total
+
+
+# ! Cart totals computed by the database: quantity * unit_price per line
+# ! and SUM() of that per cart, instead of summing in Python.
+CENT = Decimal("0.01")
+
+
+def money(value):
+    """Cart amounts with 2 places, whichever storage computed them."""
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class MoneyField(DecimalField):
+    # Backends only quantize plain columns, a computed Decimal comes back
+    # as Decimal('6') on SQLite and Decimal('6.00') on MySQL
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else money(value)
+
+
+MONEY = MoneyField(max_digits=12, decimal_places=2)
+
+
+def line_total(prefix=""):
+    return ExpressionWrapper(
+        F(f"{prefix}quantity") * F(f"{prefix}product__unit_price"), output_field=MONEY
+    )
+
+
+def cart_total():
+    return Coalesce(Sum(line_total("items__")), Value(0), output_field=MONEY)
+
+
+def cart_items_with_totals():
+    return CartItem.objects.select_related("product").annotate(total_price=line_total())
+
+
+def carts_with_totals():
+    # The cart total comes from a subquery-free aggregate on the cart row,
+    # the item line totals from the prefetch query
+    return Cart.objects.annotate(total_price=cart_total()).prefetch_related(
+        Prefetch("items", queryset=cart_items_with_totals())
+    )
+
+
+def cart_summary(cart_id):
+    """Totals for one cart in a single query, None if the cart doesn't exist."""
+    return Cart.objects.filter(pk=cart_id).annotate(
+        total_price=cart_total(),
+        item_count=Count("items"),
+        quantity=Coalesce(Sum("items__quantity"), Value(0)),
+    ).values("id", "item_count", "quantity", "total_price").first()
+
+
+# ! Whole-cart sync (PUT /store/carts/{id}/items/): the client sends the
+# ! full list it wants, we diff it against the rows and apply the diff as
+# ! one bulk insert, one bulk update and one delete in a single transaction.
+def sync_cart_items(cart_id, quantities):
+    """Make the cart hold exactly {product_id: quantity}, returns the counts."""
+    missing = set(quantities) - set(
+        Product.objects.filter(id__in=list(quantities)).values_list("id", flat=True)
+    )
+    if missing:
+        raise ProductNotFound(sorted(missing))
+
+    with transaction.atomic():
+        # Touching the cart row locks it, so concurrent syncs apply one
+        # after the other. add_cart_item upserts its line before it
+        # touches the cart, so new lines are upserted too: a line an add
+        # inserts meanwhile is overwritten with the synced quantity
+        # instead of an IntegrityError
+        if not touch_cart(cart_id):
+            raise CartNotFound(cart_id)
+        current = {item.product_id: item for item in CartItem.objects.filter(cart_id=cart_id)}
+
+        created = [
+            CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+            for product_id, quantity in quantities.items()
+            if product_id not in current
+        ]
+        updated = []
+        for product_id, item in current.items():
+            quantity = quantities.get(product_id)
+            if quantity is not None and quantity != item.quantity:
+                item.quantity = quantity
+                updated.append(item)
+        removed = [item.id for product_id, item in current.items() if product_id not in quantities]
+
+        if created:
+            # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target (and
+            # Django refuses one), the (cart, product) unique key is the
+            # only one an insert can hit besides the primary key anyway
+            if connection.features.supports_update_conflicts_with_target:
+                unique_fields = ["cart", "product"]
+            else:
+                unique_fields = None
+            CartItem.objects.bulk_create(
+                created, update_conflicts=True,
+                unique_fields=unique_fields, update_fields=["quantity"],
+            )
+        if updated:
+            CartItem.objects.bulk_update(updated, ["quantity"])
+        if removed:
+            CartItem.objects.filter(pk__in=removed).delete()
+
+    return {"created": len(created), "updated": len(updated), "deleted": len(removed)}
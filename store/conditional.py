@@ -0,0 +1,64 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+
+from .cache import normalize_query
+
+# ! Conditional GET (ETag / Last-Modified). Before running the real query
+# ! and serializer we ask the database a cheap question like
+# ! MAX(last_update), COUNT(id) for the same filters. If the client already
+# ! has that version (If-None-Match / If-Modified-Since) we answer 304.
+
+
+class ConditionalGetMixin:
+    """Viewsets implement get_list_validators / get_detail_validators and
+    return a dict with at least "last_modified" (datetime or None) plus any
+    other values (counts) that change when the response body changes."""
+
+    def get_list_validators(self):
+        return None
+
+    def get_detail_validators(self):
+        return None
+
+    def make_etag(self, request, validators):
+        raw = f"{request.path}?{normalize_query(request.query_params)}|{sorted(validators.items())!r}"
+        return quote_etag(hashlib.md5(raw.encode("utf-8")).hexdigest())
+
+    def conditional_response(self, validators, handler, request, *args, **kwargs):
+        if validators is None:
+            return handler(request, *args, **kwargs)
+
+        etag = self.make_etag(request, validators)
+        last_modified = validators.get("last_modified")
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=timestamp
+        )
+        if not_modified is not None:
+            return not_modified
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response["ETag"] = etag
+            if timestamp is not None:
+                response["Last-Modified"] = http_date(timestamp)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            self.get_list_validators(), super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            self.get_detail_validators(), super().retrieve, request, *args, **kwargs
+        )
+
+
+def latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
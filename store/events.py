@@ -0,0 +1,211 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+
+from .outbox import record_order_created, send_order_events, settle
+
+logger = logging.getLogger(__name__)
+
+# ! order_created receivers used to run inside the checkout transaction,
+# ! so each one added its latency to checkout, and saw an order that might
+# ! still roll back. Now checkout writes an outbox row (store.outbox) and
+# ! only queues the order once the transaction commits; a small pool of
+# ! worker threads takes events off the queue in batches and sends:
+# !  - order_created once per order (same signature as before)
+# !  - orders_created once per batch with orders=[...], for receivers that
+# !    would rather do one bulk query / request per batch
+# ! then marks the outbox rows delivered. Whatever they don't get to
+# ! (queue lost on a crash, failing receiver) relay_order_events sends later.
+
+
+class Metrics:
+    """Counters, queue depth and handler latency of a dispatcher."""
+
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.latencies = deque(maxlen=samples)
+
+    def record_depth(self, depth):
+        with self.lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    def record_batch(self, size, failed, seconds):
+        with self.lock:
+            self.batches += 1
+            self.delivered += size - failed
+            self.failed += failed
+            self.latencies.append(seconds)
+
+    def record_overflow(self):
+        with self.lock:
+            self.overflowed += 1
+
+    def snapshot(self, depth):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            data = {
+                "queue_depth": depth,
+                "max_queue_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "overflowed": self.overflowed,
+                "batches": self.batches,
+            }
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+        data["handler_latency_ms"] = {
+            "p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0),
+        }
+        return data
+
+
+_STOP = object()
+
+
+class OrderEventDispatcher:
+    def __init__(self, workers=2, queue_size=1000, batch_size=50, batch_wait=0.05, put_timeout=1.0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = Metrics()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        with self.lock:
+            if self.threads or self.closed:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f"order-events-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def dispatch(self, sender, order, event=None):
+        if self.closed:
+            self.deliver([(sender, order, event)])
+            return
+        self.start()
+        try:
+            # Backpressure: when the workers fall behind, checkout waits a
+            # little for room and then delivers the event itself
+            self.queue.put((sender, order, event), timeout=self.put_timeout)
+        except queue.Full:
+            self.metrics.record_overflow()
+            logger.warning("Order event queue full, delivering order %s inline", order.pk)
+            self.deliver([(sender, order, event)])
+            return
+        self.metrics.record_depth(self.queue.qsize())
+
+    def next_batch(self):
+        first = self.queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                event = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if event is _STOP:
+                # Deliver what we have first, the next get() picks it up again
+                self.queue.put(_STOP)
+                break
+            batch.append(event)
+        return batch
+
+    def work(self):
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                close_old_connections()
+                self.deliver(batch)
+        finally:
+            connections.close_all()
+
+    def deliver(self, batch):
+        started = time.monotonic()
+        errors = send_order_events(batch[0][0], [order for _, order, _ in batch])
+        events = [event for _, _, event in batch if event is not None]
+        for event in events:
+            event.attempts += 1
+        try:
+            settle(events, errors)
+        except Exception:
+            # The outbox rows stay pending, the relay sends them again
+            logger.exception("Could not mark order events delivered")
+        self.metrics.record_batch(len(batch), len(errors), time.monotonic() - started)
+
+    def shutdown(self, timeout=10):
+        """Stop taking events and wait for the queued ones to be delivered."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = self.threads
+        if threads:
+            # One stop marker per worker, queued behind the pending events
+            for _ in threads:
+                self.queue.put(_STOP)
+            deadline = time.monotonic() + timeout
+            for thread in threads:
+                thread.join(max(0, deadline - time.monotonic()))
+        if not self.queue.empty():
+            logger.warning("Order event dispatcher stopped with %s events undelivered", self.queue.qsize())
+
+    def stats(self):
+        return self.metrics.snapshot(self.queue.qsize())
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_order_event_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OrderEventDispatcher(
+                    workers=getattr(settings, "STORE_ORDER_EVENTS_WORKERS", 2),
+                    queue_size=getattr(settings, "STORE_ORDER_EVENTS_QUEUE_SIZE", 1000),
+                    batch_size=getattr(settings, "STORE_ORDER_EVENTS_BATCH_SIZE", 50),
+                    batch_wait=getattr(settings, "STORE_ORDER_EVENTS_BATCH_WAIT", 0.05),
+                )
+                atexit.register(_dispatcher.shutdown)
+    return _dispatcher
+
+
+def dispatch_order_created(sender, order):
+    """Record the outbox row now, send order_created once the transaction commits."""
+    event = record_order_created(order)
+    dispatcher = get_order_event_dispatcher()
+    # robust: a failure here mustn't fail the committed checkout, the
+    # outbox row is still pending and the relay sends it
+    if getattr(settings, "STORE_ORDER_EVENTS_ASYNC", True):
+        transaction.on_commit(lambda: dispatcher.dispatch(sender, order, event), robust=True)
+    else:
+        transaction.on_commit(lambda: dispatcher.deliver([(sender, order, event)]), robust=True)
@@ -0,0 +1,100 @@
+import hashlib
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Case, Count, IntegerField, Value, When
+from rest_framework.exceptions import ValidationError
+
+from .cache import get_cache, get_catalog_version, get_timeout, normalize_query
+
+# ! Facet counts for the product sidebar: how many of the currently
+# ! filtered products are in each collection and in each price bucket.
+# ! Both come from ONE grouped query (GROUP BY collection_id, bucket)
+# ! which we then fold into the two facets in Python.
+# ! Cached like the listings themselves (store.cache): under the catalog
+# ! version, so any catalog write makes them stale at once, for the
+# ! catalog cache timeout. The key leaves out paging, every page of a
+# ! listing shares one entry.
+
+
+class ProductFacets:
+    default_price_buckets = [10, 25, 50, 100]
+    buckets_query_param = "price_buckets"
+    max_buckets = 20
+    # Facets don't depend on which page is being looked at
+    ignored_params = {"cursor", "page", "pagination", "facets", "ordering"}
+
+    def __init__(self, request, queryset):
+        self.request = request
+        self.queryset = queryset
+
+    def get_price_buckets(self):
+        raw = self.request.query_params.get(self.buckets_query_param)
+        if not raw:
+            return self.default_price_buckets
+        try:
+            edges = sorted({Decimal(edge) for edge in raw.split(",") if edge.strip()})
+        except InvalidOperation:
+            raise ValidationError({self.buckets_query_param: ["Expected comma separated prices."]})
+        if not edges or len(edges) > self.max_buckets:
+            raise ValidationError({
+                self.buckets_query_param: [f"Send between 1 and {self.max_buckets} prices."]
+            })
+        return edges
+
+    def bucket_ranges(self, edges):
+        # [10, 25] -> (None, 10), (10, 25), (25, None)
+        bounds = [None, *edges, None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def bucket_expression(self, ranges):
+        whens = []
+        for index, (low, high) in enumerate(ranges):
+            lookups = {}
+            if low is not None:
+                lookups["unit_price__gte"] = low
+            if high is not None:
+                lookups["unit_price__lt"] = high
+            whens.append(When(then=Value(index), **lookups))
+        return Case(*whens, output_field=IntegerField())
+
+    def cache_key(self, edges):
+        params = self.request.query_params.copy()
+        for param in self.ignored_params:
+            params.pop(param, None)
+        raw = f"{normalize_query(params)}|{edges!r}"
+        digest = hashlib.md5(raw.encode("utf-8")).hexdigest()
+        return f"facets:v{get_catalog_version()}:{digest}"
+
+    def compute(self, ranges):
+        rows = self.queryset.order_by() \
+            .annotate(price_bucket=self.bucket_expression(ranges)) \
+            .values("collection_id", "price_bucket") \
+            .annotate(count=Count("id"))
+
+        collections = defaultdict(int)
+        buckets = defaultdict(int)
+        for row in rows:
+            collections[row["collection_id"]] += row["count"]
+            buckets[row["price_bucket"]] += row["count"]
+
+        return {
+            "collection_id": [
+                {"value": collection_id, "count": count}
+                for collection_id, count in sorted(collections.items())
+            ],
+            "unit_price": [
+                {"min": low, "max": high, "count": buckets.get(index, 0)}
+                for index, (low, high) in enumerate(ranges)
+            ],
+        }
+
+    def get(self):
+        edges = self.get_price_buckets()
+        cache = get_cache()
+        key = self.cache_key(edges)
+        facets = cache.get(key)
+        if facets is None:
+            facets = self.compute(self.bucket_ranges(edges))
+            cache.set(key, facets, get_timeout())
+        return facets
@@ -1,10 +1,30 @@
 from django_filters.rest_framework import FilterSet
+from rest_framework.filters import BaseFilterBackend
 from .models import Product
+from .search import get_search_backend
 
 class ProductFilter(FilterSet):
     class Meta:
         model = Product
         fields = {
             'collection_id' : ['exact'],
-            'unit_price' : ['gt', 'lt']
-        }
\ No newline at end of file
+            'unit_price' : ['gt', 'lt'],
+            'effective_price' : ['gt', 'lt'],
+        }
+
+
+# ! Replacement for DRF SearchFilter on products. SearchFilter builds
+# ! LIKE '%term%' on every column (full table scan), this one asks the
+# ! configured search backend (FULLTEXT index / inverted index) instead
+# ! and returns the rows ranked by relevance.
+class ProductSearchFilter(BaseFilterBackend):
+    search_param = 'search'
+
+    def get_search_query(self, request):
+        return request.query_params.get(self.search_param, '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_query(request)
+        if not query:
+            return queryset
+        return get_search_backend().search(queryset, query)
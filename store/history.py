@@ -0,0 +1,143 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, Customer, CustomerHistory, CustomerProductStat, Order, OrderItem,
+)
+
+# ! Incremental customer history rollups (CustomerHistory and
+# ! CustomerProductStat). Every update is a delta applied with F()
+# ! expressions, so concurrent checkouts of the same customer add up
+# ! instead of overwriting each other.
+# ! Item edits after checkout (admin) aren't tracked here, a rebuild
+# ! picks them up.
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def _case(values, output_field):
+    return Case(
+        *[When(product_id=product_id, then=Value(value)) for product_id, value in values.items()],
+        default=Value(0),
+        output_field=output_field,
+    )
+
+
+def record_order(order, order_items):
+    """Add a freshly placed order, call inside the checkout transaction."""
+    CustomerHistory.objects.get_or_create(customer_id=order.customer_id)
+    CustomerHistory.objects.filter(customer_id=order.customer_id).update(
+        order_count=F("order_count") + 1,
+        # Coalesce first, GREATEST() with a NULL is NULL on SQLite / MySQL
+        last_order_at=Greatest(Coalesce(F("last_order_at"), Value(order.placed_at)), Value(order.placed_at)),
+    )
+
+    quantities, amounts = defaultdict(int), defaultdict(int)
+    for item in order_items:
+        quantities[item.product_id] += item.quantity
+        amounts[item.product_id] += item.quantity * item.unit_price
+    if not quantities:
+        return
+    # Make sure a row exists per product, then one UPDATE adds to all of them
+    CustomerProductStat.objects.bulk_create(
+        [CustomerProductStat(customer_id=order.customer_id, product_id=product_id) for product_id in quantities],
+        ignore_conflicts=True,
+    )
+    CustomerProductStat.objects.filter(customer_id=order.customer_id, product_id__in=list(quantities)).update(
+        quantity=F("quantity") + _case(quantities, IntegerField()),
+        amount=F("amount") + _case(amounts, MONEY),
+    )
+
+
+def record_payment_change(order, old_status):
+    """Move the order in or out of the completed totals."""
+    new_status = order.payment_status
+    if old_status == new_status or Order.PAYMENT_COMPLETED not in (old_status, new_status):
+        return
+    sign = 1 if new_status == Order.PAYMENT_COMPLETED else -1
+    CustomerHistory.objects.get_or_create(customer_id=order.customer_id)
+    CustomerHistory.objects.filter(customer_id=order.customer_id).update(
+        completed_order_count=F("completed_order_count") + sign,
+        total_spent=F("total_spent") + sign * order.total_price,
+    )
+
+
+def top_products(customer_id, limit=5):
+    return CustomerProductStat.objects.filter(customer_id=customer_id, quantity__gt=0) \
+        .select_related("product").only("product__id", "product__title", "quantity", "amount") \
+        .order_by("-quantity", "product_id")[:limit]
+
+
+def customer_ranges(chunk_size):
+    """Split the customer ids into (first, last) ranges of about chunk_size."""
+    ids = Customer.objects.order_by("id").values_list("id", flat=True)
+    ranges, start, count, last = [], None, 0, None
+    for customer_id in ids.iterator(chunk_size=5000):
+        if start is None:
+            start = customer_id
+        count += 1
+        last = customer_id
+        if count == chunk_size:
+            ranges.append((start, last))
+            start, count = None, 0
+    if start is not None:
+        ranges.append((start, last))
+    return ranges
+
+
+def _order_rows(model, first, last):
+    return model.objects.filter(customer_id__gte=first, customer_id__lte=last) \
+        .order_by().values("customer_id").annotate(
+            order_count=Count("id"),
+            completed_order_count=Count("id", filter=Q(payment_status=Order.PAYMENT_COMPLETED)),
+            total_spent=Sum("total_price", filter=Q(payment_status=Order.PAYMENT_COMPLETED)),
+            last_order_at=Max("placed_at"),
+        )
+
+
+def _product_rows(model, first, last):
+    return model.objects.filter(order__customer_id__gte=first, order__customer_id__lte=last) \
+        .order_by().values("order__customer_id", "product_id").annotate(
+            total_quantity=Sum("quantity"),
+            total_amount=Sum(F("quantity") * F("unit_price"), output_field=MONEY),
+        )
+
+
+def rebuild_range(first, last):
+    """Recompute the rollups of customers first..last from their orders,
+    hot and archived alike, history is lifetime."""
+    in_range = Q(customer_id__gte=first, customer_id__lte=last)
+    with transaction.atomic():
+        # Lock the range's history rows (and on MySQL the gaps between them)
+        # before reading any order. record_order / record_payment_change
+        # update CustomerHistory first, so a checkout or payment change
+        # that isn't in the aggregates below waits and applies its delta
+        # on top of the rebuilt rows instead of being overwritten by them.
+        list(CustomerHistory.objects.select_for_update().filter(in_range).values_list("pk", flat=True))
+
+        histories = {}
+        for model in (Order, ArchivedOrder):
+            for row in _order_rows(model, first, last):
+                history = histories.setdefault(row["customer_id"], CustomerHistory(customer_id=row["customer_id"]))
+                history.order_count += row["order_count"]
+                history.completed_order_count += row["completed_order_count"]
+                history.total_spent += row["total_spent"] or 0
+                if history.last_order_at is None or row["last_order_at"] > history.last_order_at:
+                    history.last_order_at = row["last_order_at"]
+
+        stats = {}
+        for model in (OrderItem, ArchivedOrderItem):
+            for row in _product_rows(model, first, last):
+                key = (row["order__customer_id"], row["product_id"])
+                stat = stats.setdefault(key, CustomerProductStat(customer_id=key[0], product_id=key[1]))
+                stat.quantity += row["total_quantity"]
+                stat.amount += row["total_amount"]
+
+        CustomerHistory.objects.filter(in_range).delete()
+        CustomerProductStat.objects.filter(in_range).delete()
+        CustomerHistory.objects.bulk_create(histories.values(), batch_size=1000)
+        CustomerProductStat.objects.bulk_create(stats.values(), batch_size=1000)
+    return len(histories), len(stats)
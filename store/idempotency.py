@@ -0,0 +1,165 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+# ! Idempotency-Key support for unsafe endpoints (order creation). The
+# ! first request with a key claims an IdempotencyKey row, runs, and
+# ! stores its response; retries get that response back without running
+# ! the handler again. A retry arriving while the first one is still
+# ! running polls until it finishes instead of racing it.
+
+HEADER = "Idempotency-Key"
+
+
+class IdempotencyConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A request with this Idempotency-Key is still being processed."
+    default_code = "idempotency_in_progress"
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "This Idempotency-Key was already used for a different request."
+    default_code = "idempotency_key_reused"
+
+
+class _ServerError(Exception):
+    """Carries a 5xx response out of the transaction so it rolls back."""
+
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def _setting(name, default):
+    return timedelta(seconds=getattr(settings, name, default))
+
+
+def fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method} {request.path}\n{body}".encode("utf-8")).hexdigest()
+
+
+def claim(user_id, key, request_fingerprint):
+    """Returns (record, owned). owned means this request must run the handler."""
+    now = timezone.now()
+    lease = now + _setting("STORE_IDEMPOTENCY_LEASE", 60)
+    expires = now + _setting("STORE_IDEMPOTENCY_TTL", 60 * 60 * 24)
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user_id=user_id, key=key, fingerprint=request_fingerprint,
+                locked_until=lease, expires_at=expires,
+            )
+        return record, True
+    except IntegrityError:
+        pass
+
+    record = IdempotencyKey.objects.filter(user_id=user_id, key=key).first()
+    if record is None:
+        # Purged between our insert and our read, just try again
+        return claim(user_id, key, request_fingerprint)
+    # Expired responses and abandoned claims can be taken over, the
+    # conditional UPDATE makes sure only one request gets it
+    stale = Q(expires_at__lte=now) | Q(status=IdempotencyKey.IN_PROGRESS, locked_until__lte=now)
+    taken = IdempotencyKey.objects.filter(stale, pk=record.pk).update(
+        fingerprint=request_fingerprint, status=IdempotencyKey.IN_PROGRESS,
+        response_status=None, response_body="", locked_until=lease, expires_at=expires,
+    )
+    if taken:
+        record.refresh_from_db()
+        return record, True
+    return record, False
+
+
+def replay(record):
+    response = Response(json.loads(record.response_body or "null"), status=record.response_status)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+class IdempotencyMixin:
+    """View mixin, wrap an unsafe action as `return self.idempotent(request, handler)`."""
+
+    idempotency_poll_interval = 0.05
+
+    def idempotent(self, request, handler, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return handler(request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({"detail": f"{HEADER} must be at most 255 characters."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        request_fingerprint = fingerprint(request)
+        deadline = time.monotonic() + _setting("STORE_IDEMPOTENCY_WAIT", 10).total_seconds()
+        while True:
+            record, owned = claim(request.user.id, key, request_fingerprint)
+            if owned:
+                return self.run_and_store(record, request, handler, *args, **kwargs)
+            if record.fingerprint != request_fingerprint:
+                raise IdempotencyKeyReused()
+            if record.status == IdempotencyKey.DONE:
+                return replay(record)
+            if time.monotonic() > deadline:
+                raise IdempotencyConflict()
+            time.sleep(self.idempotency_poll_interval)
+
+    def run_and_store(self, record, request, handler, *args, **kwargs):
+        # The handler's writes and the stored response commit together, so
+        # a failure anywhere (building the response, storing it) rolls the
+        # order back with it and the retry can safely run again. Run apart,
+        # an error after the handler committed released the key and the
+        # retry failed on the cart the first attempt had used up.
+        try:
+            with transaction.atomic():
+                try:
+                    response = handler(request, *args, **kwargs)
+                except APIException as exc:
+                    # Validation errors etc. are answers too, a retry gets the same one
+                    response = self.handle_exception(exc)
+
+                if response.status_code >= 500:
+                    # Returning here would commit whatever the handler
+                    # wrote before it gave up
+                    raise _ServerError(response)
+                IdempotencyKey.objects.filter(pk=record.pk).update(
+                    status=IdempotencyKey.DONE,
+                    response_status=response.status_code,
+                    response_body=JSONRenderer().render(response.data).decode("utf-8"),
+                )
+        except _ServerError as error:
+            # Rolled back, release the key so a retry can run again
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+            return error.response
+        except Exception:
+            # Unexpected failure: release the key so a retry can run again
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+            raise
+        return response
+
+
+def purge_expired(chunk_size=1000):
+    """Delete expired keys in id chunks, returns rows deleted."""
+    deleted = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(expires_at__lte=timezone.now())
+            .order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        count, _ = IdempotencyKey.objects.filter(id__in=ids).delete()
+        deleted += count
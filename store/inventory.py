@@ -0,0 +1,72 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .cache import invalidate_catalog
+from .models import Product
+
+# ! Stock reservation at checkout. All lines of an order are taken off
+# ! Product.inventory by ONE conditional UPDATE:
+# !   UPDATE store_product SET inventory = inventory - CASE id WHEN .. END
+# !   WHERE id IN (..) AND inventory >= CASE id WHEN .. END
+# ! If fewer rows matched than lines we asked for, some product ran out and
+# ! the surrounding transaction is rolled back, decrements included.
+
+
+class OutOfStock(Exception):
+    def __init__(self, shortages):
+        # {product_id: units still available}
+        self.shortages = shortages
+        super().__init__(f"Not enough stock for products {sorted(shortages)}")
+
+
+def _per_product(quantities):
+    return Case(
+        *[When(id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def reserve_stock(quantities):
+    """Take {product_id: quantity} off the inventory or raise OutOfStock.
+
+    Must run inside the checkout transaction. Product rows are locked in
+    ascending id order, the same order for every checkout, so two
+    checkouts sharing products queue up instead of deadlocking."""
+    if not quantities:
+        return
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError("reserve_stock() must run inside transaction.atomic()")
+
+    product_ids = sorted(quantities)
+    available = dict(
+        Product.objects.select_for_update()
+        .filter(id__in=product_ids)
+        .order_by("id")
+        .values_list("id", "inventory")
+    )
+    shortages = {
+        product_id: available.get(product_id, 0)
+        for product_id in product_ids
+        if available.get(product_id, 0) < quantities[product_id]
+    }
+    if shortages:
+        raise OutOfStock(shortages)
+
+    requested = _per_product(quantities)
+    updated = Product.objects.filter(id__in=product_ids, inventory__gte=requested) \
+        .update(inventory=F("inventory") - requested, last_update=timezone.now())
+    # update() sends no post_save, listings cached with the old inventory
+    # are dropped once the checkout commits (nothing happens on rollback)
+    invalidate_catalog()
+    if updated != len(product_ids):
+        # Only possible where select_for_update locks nothing (SQLite): a
+        # concurrent checkout got there between our read and our write.
+        # Rows that did match are decremented here, so this over-reports a
+        # little, the rollback puts them back anyway.
+        remaining = dict(Product.objects.filter(id__in=product_ids).values_list("id", "inventory"))
+        raise OutOfStock({
+            product_id: remaining.get(product_id, 0)
+            for product_id in product_ids
+            if remaining.get(product_id, 0) < quantities[product_id]
+        })
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from store.archive import archive_orders, get_archive_age
+
+
+class Command(BaseCommand):
+    help = "Move orders older than STORE_ORDER_ARCHIVE_AFTER into the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=float, help="override STORE_ORDER_ARCHIVE_AFTER")
+        parser.add_argument("--batch-size", type=int, default=500, help="orders per transaction")
+        parser.add_argument("--max-batches", type=int, help="stop after this many batches")
+        parser.add_argument("--pause", type=float, default=0, help="seconds to sleep between batches")
+        parser.add_argument("--reset-checkpoint", action="store_true", help="scan from the first order again")
+
+    def handle(self, *args, **options):
+        days = options["older_than_days"]
+        age = timedelta(days=days) if days is not None else get_archive_age()
+        stats = archive_orders(
+            age=age,
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+            pause=options["pause"],
+            reset=options["reset_checkpoint"],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {stats['orders']} orders in {stats['batches']} batches, "
+            f"checkpoint at order {stats['checkpoint']}, {stats['seconds']:.2f}s "
+            f"({stats['orders_per_second']:.0f} orders/s)"
+        ))
@@ -0,0 +1,231 @@
+import json
+import platform
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from statistics import median
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from core.models import User
+from store.models import (
+    Cart, CartItem, Collection, Customer, IdempotencyKey, Order, OrderEvent, OrderItem, Product,
+)
+
+# ! Checkout load test: seeds throwaway customers, products and carts,
+# ! fires POST /store/orders/ at them from a thread pool through the DRF
+# ! test client and writes the numbers to a JSON file, so runs can be
+# ! compared between commits. Seeded rows are deleted at the end (--keep
+# ! leaves them). Don't point it at a database you care about.
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def is_deadlock(error):
+    message = str(error).lower()
+    # MySQL 1213 / 1205, PostgreSQL "deadlock detected", SQLite busy
+    return any(text in message for text in ("deadlock", "lock wait timeout", "database is locked"))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Load test POST /store/orders/ and write latency / throughput numbers as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=200, help="checkouts to run (one cart each)")
+        parser.add_argument("--threads", type=int, default=8, help="concurrent clients")
+        parser.add_argument("--customers", type=int, default=50)
+        parser.add_argument("--products", type=int, default=20)
+        parser.add_argument("--items-per-cart", type=int, default=3)
+        parser.add_argument(
+            "--stock", type=int, default=1_000_000,
+            help="inventory per product, set it low to measure contention on stock",
+        )
+        parser.add_argument("--retries", type=int, default=3, help="retries after a deadlock")
+        parser.add_argument("--output", help="JSON file to write (default bench-checkout-<time>.json)")
+        parser.add_argument("--keep", action="store_true", help="don't delete the seeded rows")
+
+    def handle(self, *args, **options):
+        self.tag = f"bench-{uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.deadlocks = 0
+        self.retries = 0
+        self.replayed = 0
+        self.errors = []
+
+        self.stdout.write(f"Seeding {options['orders']} carts for {options['customers']} customers ...")
+        users, carts = self.seed(options)
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"]):
+                results, elapsed = self.run(users, carts, options)
+            report = self.report(results, elapsed, options)
+        finally:
+            if not options["keep"]:
+                self.cleanup()
+
+        path = options["output"] or f"bench-checkout-{datetime.now():%Y%m%d-%H%M%S}.json"
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+
+        latency = report["latency_ms"]
+        self.stdout.write(
+            f"{report['orders_placed']} orders in {report['seconds']:.2f}s, "
+            f"{report['orders_per_second']:.1f} orders/s, "
+            f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms, "
+            f"{report['queries_per_order']} queries/order, "
+            f"{report['deadlocks']} deadlocks, {report['retries']} retries"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Results written to {path}"))
+
+    def seed(self, options):
+        collection = Collection.objects.create(title=self.tag)
+        self.collection_id = collection.id
+        products = Product.objects.bulk_create(
+            Product(
+                title=f"{self.tag} product {i}", slug=f"{self.tag}-{i}", unit_price=5 + i % 50,
+                effective_price=5 + i % 50, inventory=options["stock"], collection=collection,
+            )
+            for i in range(options["products"])
+        )
+        if products[0].pk is None:
+            # bulk_create doesn't return ids on MySQL
+            products = list(Product.objects.filter(collection=collection).order_by("id"))
+        # User.objects.create so the post_save handler creates the Customer
+        users = [
+            User.objects.create(username=f"{self.tag}-{i}", email=f"{self.tag}-{i}@example.com")
+            for i in range(options["customers"])
+        ]
+        carts = Cart.objects.bulk_create(Cart() for _ in range(options["orders"]))
+        CartItem.objects.bulk_create(
+            CartItem(
+                cart=cart,
+                product=products[(index + offset) % len(products)],
+                quantity=1 + offset,
+            )
+            for index, cart in enumerate(carts)
+            for offset in range(min(options["items_per_cart"], len(products)))
+        )
+        self.cart_ids = [cart.id for cart in carts]
+        return users, carts
+
+    def checkout(self, job):
+        user, cart_id, key, retries = job
+        client = APIClient()
+        client.force_authenticate(user)
+        # One Idempotency-Key per checkout: an error after the order
+        # committed gets retried, and the retry replays the stored response
+        # instead of failing on the cart the first attempt used up.
+        # Latency is the whole checkout as the client sees it, retries included.
+        started = time.perf_counter()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    with CaptureQueriesContext(connection) as queries:
+                        response = client.post(
+                            "/store/orders/", {"cart_id": str(cart_id)},
+                            format="json", HTTP_IDEMPOTENCY_KEY=key,
+                        )
+                    if response.has_header("Idempotent-Replayed"):
+                        with self.lock:
+                            self.replayed += 1
+                    latency = (time.perf_counter() - started) * 1000
+                    return response.status_code, latency, len(queries)
+                except DatabaseError as error:
+                    deadlock = is_deadlock(error)
+                    with self.lock:
+                        self.deadlocks += deadlock
+                        if not deadlock or attempt >= retries:
+                            self.errors.append(repr(error))
+                            return "error", None, None
+                        self.retries += 1
+                    attempt += 1
+                    time.sleep(0.01 * attempt)
+        finally:
+            connections.close_all()
+
+    def run(self, users, carts, options):
+        jobs = [
+            (users[index % len(users)], cart.id, f"{self.tag}-{index}", options["retries"])
+            for index, cart in enumerate(carts)
+        ]
+        self.stdout.write(f"Checking out {len(jobs)} carts with {options['threads']} threads ...")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+            results = list(pool.map(self.checkout, jobs))
+        return results, time.perf_counter() - started
+
+    def report(self, results, elapsed, options):
+        succeeded = [result for result in results if result[0] in (200, 201)]
+        # Orders actually written, whatever the responses said
+        placed = Order.objects.filter(customer__user__username__startswith=self.tag).count()
+        latencies = [latency for status, latency, _ in results if latency is not None]
+        statuses = {}
+        for status, _, _ in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        def ms(value):
+            return None if value is None else round(value, 3)
+
+        return {
+            "benchmark": "checkout",
+            "timestamp": datetime.now(dt_timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "parameters": {
+                key: options[key]
+                for key in ("orders", "threads", "customers", "products", "items_per_cart", "stock", "retries")
+            },
+            "seconds": round(elapsed, 3),
+            "orders_placed": placed,
+            "orders_per_second": round(placed / elapsed, 3) if elapsed else 0,
+            "successful_responses": len(succeeded),
+            "statuses": statuses,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 50)),
+                "p95": ms(percentile(latencies, 95)),
+                "p99": ms(percentile(latencies, 99)),
+                "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+                "max": ms(max(latencies)) if latencies else None,
+            },
+            "queries_per_order": median([queries for _, _, queries in succeeded]) if succeeded else None,
+            "deadlocks": self.deadlocks,
+            "retries": self.retries,
+            "replayed": self.replayed,
+            "errors": self.errors[:20],
+        }
+
+    def cleanup(self):
+        customers = Customer.objects.filter(user__username__startswith=self.tag)
+        orders = Order.objects.filter(customer__in=customers)
+        OrderItem.objects.filter(order__in=orders).delete()
+        OrderEvent.objects.filter(order__in=orders).delete()
+        orders.delete()
+        IdempotencyKey.objects.filter(user__username__startswith=self.tag).delete()
+        Cart.objects.filter(id__in=self.cart_ids).delete()
+        # Customers, their history rollups and product stats go with the users
+        User.objects.filter(username__startswith=self.tag).delete()
+        Product.objects.filter(collection_id=self.collection_id).delete()
+        Collection.objects.filter(id=self.collection_id).delete()
@@ -0,0 +1,87 @@
+import time
+from statistics import median
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from store.models import Collection, Product
+from store.serializers import ProductSerializer, ProductValuesSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare ProductSerializer with the values() based ProductValuesSerializer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100, help="rows per page")
+        parser.add_argument("--repeat", type=int, default=50, help="timed runs per path")
+        parser.add_argument(
+            "--seed", type=int, default=0,
+            help="create this many throwaway products first (rolled back at the end)",
+        )
+
+    def handle(self, *args, **options):
+        rows, repeat = options["rows"], options["repeat"]
+        # Everything runs inside a transaction we roll back, so seeding
+        # never leaves data behind
+        try:
+            with transaction.atomic():
+                if options["seed"]:
+                    self.seed(options["seed"])
+                self.run(rows, repeat)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        collection = Collection.objects.create(title="bench")
+        Product.objects.bulk_create(
+            Product(
+                title=f"Bench product {i}",
+                slug=f"bench-{i}",
+                description="Benchmark row " * 5,
+                unit_price=10 + i % 90,
+                inventory=i % 50,
+                collection=collection,
+            )
+            for i in range(count)
+        )
+
+    def run(self, rows, repeat):
+        queryset = Product.objects.order_by("id")
+
+        def model_path():
+            return ProductSerializer(list(queryset[:rows]), many=True).data
+
+        def values_path():
+            page = list(queryset.values(*ProductValuesSerializer.value_fields)[:rows])
+            return ProductValuesSerializer(page, many=True).data
+
+        fetched = len(model_path())
+        if not fetched:
+            self.stderr.write("No products to serialize, use --seed N")
+            return
+        if [dict(row) for row in model_path()] != list(values_path()):
+            self.stderr.write(self.style.WARNING("Outputs of the two paths differ"))
+
+        results = {}
+        for name, path in [("ProductSerializer", model_path), ("ProductValuesSerializer", values_path)]:
+            with CaptureQueriesContext(connection) as queries:
+                path()
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                path()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = median(timings)
+            self.stdout.write(
+                f"{name:<26} median {results[name]:8.3f} ms  "
+                f"best {min(timings):8.3f} ms  queries {len(queries)}  rows {fetched}"
+            )
+
+        speedup = results["ProductSerializer"] / results["ProductValuesSerializer"]
+        self.stdout.write(self.style.SUCCESS(f"values() path is {speedup:.1f}x faster"))
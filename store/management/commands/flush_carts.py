@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.cart_storage import CartStateLost, get_cart_storage
+
+
+class Command(BaseCommand):
+    help = "Write carts waiting in the cart hot store to the database"
+
+    def handle(self, *args, **options):
+        storage = get_cart_storage()
+        started = time.monotonic()
+        try:
+            count = storage.flush()
+        except CartStateLost as error:
+            raise CommandError(f"Flushed {error.flushed} carts, but {error}")
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Flushed {count} carts with {storage.__class__.__name__} in {elapsed:.2f}s"
+        ))
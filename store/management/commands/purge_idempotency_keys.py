@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired Idempotency-Key records"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="rows deleted per statement")
+
+    def handle(self, *args, **options):
+        deleted = purge_expired(options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired idempotency keys"))
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from store.cart_reaper import CartReaper, get_ttl, reap_abandoned_carts
+
+
+class Command(BaseCommand):
+    help = "Delete carts left untouched for longer than STORE_CART_TTL in small chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ttl-hours", type=float, help="override STORE_CART_TTL")
+        parser.add_argument("--chunk-size", type=int, default=500, help="carts per transaction")
+        parser.add_argument("--pause", type=float, default=0, help="seconds to sleep between chunks")
+        parser.add_argument(
+            "--every", type=float, default=0,
+            help="keep running and reap again every N seconds",
+        )
+
+    def handle(self, *args, **options):
+        ttl = timedelta(hours=options["ttl_hours"]) if options["ttl_hours"] is not None else get_ttl()
+        reap_options = {"ttl": ttl, "chunk_size": options["chunk_size"], "pause": options["pause"]}
+
+        if options["every"]:
+            reaper = CartReaper(options["every"], **reap_options)
+            self.stdout.write(f"Reaping carts idle for {ttl} every {options['every']}s, Ctrl+C to stop")
+            reaper.start()
+            try:
+                while reaper.is_alive():
+                    reaper.join(1)
+            except KeyboardInterrupt:
+                reaper.stop()
+            return
+
+        stats = reap_abandoned_carts(**reap_options)
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {stats['carts']} carts and {stats['items']} items in {stats['chunks']} chunks, "
+            f"skipped {stats['skipped']} locked, {stats['seconds']:.2f}s "
+            f"({stats['carts_per_second']:.0f} carts/s)"
+        ))
@@ -0,0 +1,40 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from store.history import customer_ranges, rebuild_range
+
+
+class Command(BaseCommand):
+    help = "Recompute the customer history rollups from orders, in parallel chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="customers per chunk")
+        parser.add_argument("--workers", type=int, default=4, help="chunks rebuilt at the same time")
+
+    def rebuild(self, first, last):
+        # Each worker thread has its own database connection
+        try:
+            return rebuild_range(first, last)
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        ranges = customer_ranges(options["chunk_size"])
+        customers = stats = 0
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as pool:
+            futures = {pool.submit(self.rebuild, first, last): (first, last) for first, last in ranges}
+            for future in as_completed(futures):
+                first, last = futures[future]
+                histories, products = future.result()
+                customers += histories
+                stats += products
+                self.stdout.write(f"customers {first}-{last}: {histories} histories, {products} product rows")
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {customers} customer histories and {stats} product rows "
+            f"in {len(ranges)} chunks, {elapsed:.2f}s"
+        ))
@@ -0,0 +1,50 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.reconciliation import Reconciliation, parse_row
+
+
+class Command(BaseCommand):
+    help = "Apply a payment settlement CSV (order id, payment status) to orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file with a header row")
+        parser.add_argument("--id-column", default="id")
+        parser.add_argument("--status-column", default="payment_status")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="rows applied per transaction")
+        parser.add_argument("--dry-run", action="store_true", help="report only, roll every chunk back")
+
+    def handle(self, *args, **options):
+        id_column, status_column = options["id_column"], options["status_column"]
+        reconciliation = Reconciliation(dry_run=options["dry_run"])
+        started = time.monotonic()
+        chunk = []
+        # The file is streamed, only one chunk of rows is held at a time
+        with open(options["path"], newline="", encoding="utf-8-sig") as file:
+            reader = csv.DictReader(file)
+            missing = {id_column, status_column} - set(reader.fieldnames or [])
+            if missing:
+                raise CommandError(f"Missing columns: {', '.join(sorted(missing))}")
+            for row in reader:
+                try:
+                    chunk.append(parse_row(row[id_column], row[status_column]))
+                except ValueError as error:
+                    reconciliation.add_invalid(reader.line_num, str(error))
+                if len(chunk) >= options["chunk_size"]:
+                    reconciliation.apply(chunk)
+                    chunk = []
+            reconciliation.apply(chunk)
+
+        report = reconciliation.report()
+        for invalid in report["invalid"]:
+            self.stderr.write(f"line {invalid['row']}: {invalid['error']}")
+        if report["unknown_ids"]:
+            self.stderr.write(f"unknown order ids: {', '.join(map(str, report['unknown_ids']))}")
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Dry run: ' if report['dry_run'] else ''}{report['received']} rows, "
+            f"{report['updated']} updated, {report['unchanged']} unchanged, "
+            f"{report['unknown']} unknown, {len(report['invalid'])} invalid, {elapsed:.2f}s"
+        ))
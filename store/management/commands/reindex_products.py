@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index used by ProductViewSet ?search="
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.monotonic()
+        count = backend.rebuild()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {count} products with {backend.__class__.__name__} in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from store.outbox import prune_delivered, relay_batch
+
+
+class Command(BaseCommand):
+    help = "Deliver pending order events from the outbox and prune delivered ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="events claimed at a time")
+        parser.add_argument("--lease", type=int, default=60, help="seconds a claim is held")
+        parser.add_argument("--poll", type=float, default=2.0, help="seconds to sleep when idle")
+        parser.add_argument("--prune-chunk", type=int, default=1000, help="rows deleted per statement")
+        parser.add_argument(
+            "--once", action="store_true",
+            help="relay until the outbox is drained, prune, then exit",
+        )
+
+    def handle(self, *args, **options):
+        total_delivered = total_failed = 0
+        started = time.monotonic()
+        try:
+            while True:
+                close_old_connections()
+                delivered, failed = relay_batch(options["batch_size"], options["lease"])
+                total_delivered += delivered
+                total_failed += failed
+                if delivered or failed:
+                    self.stdout.write(f"delivered {delivered}, failed {failed}")
+                    continue
+                # Idle: a good moment to trim the table
+                pruned = prune_delivered(chunk_size=options["prune_chunk"])
+                if pruned:
+                    self.stdout.write(f"pruned {pruned} delivered events")
+                if options["once"]:
+                    break
+                time.sleep(options["poll"])
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Delivered {total_delivered} events, {total_failed} failed, in {elapsed:.2f}s "
+            f"({total_delivered / elapsed if elapsed else 0:.0f} events/s)"
+        ))
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+INDEX_NAME = "store_product_title_description_ft"
+
+
+# ! FULLTEXT indexes only exist on MySQL, other databases use the
+# ! in-process inverted index from store.search so we skip them here
+def create_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(
+        f"CREATE FULLTEXT INDEX {INDEX_NAME} ON store_product (title, description)"
+    )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(f"DROP INDEX {INDEX_NAME} ON store_product")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0014_alter_orderitem_order"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0015_product_fulltext_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="last_update",
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,52 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+# Same rule as store.pricing.effective_price, copied so the migration
+# does not depend on app code that may change later
+def populate_effective_price(apps, schema_editor):
+    Product = apps.get_model("store", "Product")
+    Through = Product.promotions.through
+    discounts = dict(
+        Through.objects.values("product_id")
+        .annotate(discount=Max("promotion__discount"))
+        .values_list("product_id", "discount")
+    )
+    batch = []
+    for product in Product.objects.only("id", "unit_price").iterator(chunk_size=2000):
+        discount = min(max(Decimal(str(discounts.get(product.id) or 0)), Decimal(0)), Decimal(100))
+        product.effective_price = (
+            product.unit_price * (Decimal(100) - discount) / Decimal(100)
+        ).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        batch.append(product)
+        if len(batch) >= 2000:
+            Product.objects.bulk_update(batch, ["effective_price"])
+            batch = []
+    Product.objects.bulk_update(batch, ["effective_price"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0017_product_filter_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="effective_price",
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=6),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(fields=["effective_price", "id"], name="store_prod_effective_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(fields=["collection", "effective_price", "id"], name="store_prod_coll_effective_idx"),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['created_at', 'id'], name='store_cart_created_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_cart_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('order_created', 'Order created')], default='order_created', max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField()),
+                ('claim_token', models.CharField(blank=True, default='', max_length=32)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('latency_ms', models.FloatField(blank=True, null=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='store.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['delivered_at', 'available_at'], name='store_orderevent_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:26
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_order_totals(apps, schema_editor):
+    Order = apps.get_model("store", "Order")
+    OrderItem = apps.get_model("store", "OrderItem")
+    money = DecimalField(max_digits=12, decimal_places=2)
+
+    def per_order(aggregate):
+        return Subquery(
+            OrderItem.objects.filter(order_id=OuterRef("pk")).order_by()
+            .values("order_id").annotate(value=aggregate).values("value")[:1]
+        )
+
+    Order.objects.update(
+        item_count=Coalesce(per_order(Count("id")), Value(0)),
+        total_price=Coalesce(
+            per_order(Sum(F("unit_price") * F("quantity"), output_field=money)),
+            Value(0), output_field=money,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_order_event_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunPython(populate_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:12
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def populate_updated_at(apps, schema_editor):
+    # Existing carts got the migration time, nothing touched them since creation
+    Cart = apps.get_model("store", "Cart")
+    Cart.objects.update(updated_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0024_order_archive'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='cart',
+            name='store_cart_created_idx',
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(populate_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['updated_at', 'id'], name='store_cart_updated_idx'),
+        ),
+    ]
@@ -14,6 +14,8 @@ class Promotion(models.Model):
 
 class Collection(models.Model):
     title = models.CharField(max_length=255)
+    # Used for ETag / Last-Modified on collection endpoints
+    last_update = models.DateTimeField(auto_now=True)
     """+ means no reverse relationship with Product model"""
     featured_product = models.ForeignKey('Product', 
                                          on_delete=models.SET_NULL,
@@ -37,11 +39,36 @@ class Product(models.Model):
     unit_price = models.DecimalField(max_digits=6, decimal_places=2, validators= [MinValueValidator(1)]) #These two are always required for decimal_places field
     inventory = models.IntegerField( validators= [MinValueValidator(0)])
     last_update = models.DateTimeField(auto_now=True)
+    # ! unit_price after the best promotion, maintained by store.pricing
+    # ! (signal handlers), so we can filter / order on it without joins
+    effective_price = models.DecimalField(max_digits=6, decimal_places=2, editable=False)
     # when delete a collection will not delete all products in that collection PROTECT
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT, related_name="products")
     promotions = models.ManyToManyField(Promotion, blank= True)
     def __str__(self):
         return self.title
+
+    # ! Remember the unit_price the row had, so the effective_price handler
+    # ! only looks the promotions up when a save changes the price
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_unit_price = instance.__dict__.get("unit_price")
+        return instance
+
+    # ! Composite indexes for ProductFilter + OrderingFilter + keyset pagination
+    # ! (which always adds id as tiebreaker), so these combinations are an
+    # ! index range scan already in the right order instead of a filesort.
+    # ! tests.ProductQueryPlanTests fails if one of them goes back to a scan.
+    class Meta:
+        indexes = [
+            models.Index(fields=["unit_price", "id"], name="store_prod_price_id_idx"),
+            models.Index(fields=["last_update", "id"], name="store_prod_updated_id_idx"),
+            models.Index(fields=["collection", "unit_price", "id"], name="store_prod_coll_price_idx"),
+            models.Index(fields=["collection", "last_update", "id"], name="store_prod_coll_updated_idx"),
+            models.Index(fields=["effective_price", "id"], name="store_prod_effective_id_idx"),
+            models.Index(fields=["collection", "effective_price", "id"], name="store_prod_coll_effective_idx"),
+        ]
    
 
 class Customer(models.Model):
@@ -94,12 +121,89 @@ class Order(models.Model):
     placed_at = models.DateTimeField(auto_now_add=True)
     payment_status = models.CharField(max_length=1,choices=PAYMENT_STATUS, default= PAYMENT_PENDING)
     customer = models.ForeignKey(Customer,on_delete= models.PROTECT )
+    # ! Denormalized from the items so order lists don't have to load them.
+    # ! Set at checkout, kept current by the OrderItem signal handlers
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
 
     class Meta:
         permissions = [
             ('cancel_order', 'can_cancel_order')
         ]
 
+# ! Transactional outbox: checkout writes one row here in the same
+# ! transaction as the Order, so the event can't be lost once the order
+# ! exists. Delivered by the order event workers, or by relay_order_events
+# ! for anything they didn't get to (crash, restart, failing receiver).
+class OrderEvent(models.Model):
+    ORDER_CREATED = "order_created"
+    EVENT_TYPES = [(ORDER_CREATED, "Order created")]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="events")
+    event_type = models.CharField(max_length=50, choices=EVENT_TYPES, default=ORDER_CREATED)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # The relay leaves a row alone until then (grace period, lease, backoff)
+    available_at = models.DateTimeField()
+    claim_token = models.CharField(max_length=32, blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    latency_ms = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["delivered_at", "available_at"], name="store_orderevent_pending_idx"),
+        ]
+
+# ! Per customer rollups behind CustomerViewSet.history. Checkout and
+# ! payment status changes add their deltas (store.history), so reading a
+# ! history is two small queries however many orders the customer has.
+# ! `manage.py rebuild_customer_history` recomputes them from the orders.
+class CustomerHistory(models.Model):
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name="history")
+    order_count = models.PositiveIntegerField(default=0)
+    completed_order_count = models.PositiveIntegerField(default=0)
+    # Sum of Order.total_price over orders with payment completed
+    total_spent = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class CustomerProductStat(models.Model):
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="product_stats")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    quantity = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [["customer", "product"]]
+        indexes = [
+            # ! top products of a customer straight off the index
+            models.Index(fields=["customer", "-quantity"], name="store_custprod_top_idx"),
+        ]
+
+# ! Idempotency-Key header for POST /store/orders/ (store.idempotency).
+# ! One row per (user, key): the first request claims it, its response is
+# ! stored here and replayed to retries until expires_at.
+class IdempotencyKey(models.Model):
+    IN_PROGRESS = "P"
+    DONE = "D"
+    STATUS_CHOICES = [(IN_PROGRESS, "In progress"), (DONE, "Done")]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=255)
+    # sha256 of the request, a key reused for a different request is refused
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=IN_PROGRESS)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    # An in progress claim older than this was abandoned (crashed worker)
+    locked_until = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [["user", "key"]]
+
 class Address(models.Model):
     street = models.CharField(max_length=255)
     city = models.CharField(max_length=255)
@@ -121,9 +225,44 @@ class OrderItem(models.Model):
     quantity = models.PositiveSmallIntegerField( validators= [MinValueValidator(1)] )
     unit_price = models.DecimalField(max_digits=6, decimal_places=2, validators= [MinValueValidator(0)] )
 
+# ! Cold storage for old orders (store.archive). Same ids and columns as
+# ! Order / OrderItem, so the hot tables only hold recent orders and
+# ! OrderViewSet can still serve an archived order by its id.
+class ArchivedOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    placed_at = models.DateTimeField()
+    payment_status = models.CharField(max_length=1, choices=Order.PAYMENT_STATUS)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name="+")
+    item_count = models.PositiveIntegerField(default=0)
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name="items")
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name="+")
+    quantity = models.PositiveSmallIntegerField()
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2)
+
+# ! Where an archive run got to, so an interrupted run carries on from there
+class ArchiveCheckpoint(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+    archived = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
     created_at = models.DateTimeField(auto_now_add=True)
+    # ! Last change to the cart or its items (store.carts.touch_cart), the
+    # ! reaper measures abandonment from here
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # ! reap_carts walks idle carts longest idle first, (updated_at, id)
+            models.Index(fields=["updated_at", "id"], name="store_cart_updated_idx"),
+        ]
     
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
@@ -0,0 +1,35 @@
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Order, OrderItem
+
+# ! Order.item_count / Order.total_price are copies of what the items say.
+# ! refresh_order_totals() recomputes them in ONE UPDATE with correlated
+# ! subqueries, for whenever items change outside checkout (admin edits).
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
+def order_totals(order_items):
+    """(item_count, total_price) for a list of unsaved/saved OrderItems."""
+    return len(order_items), sum(item.unit_price * item.quantity for item in order_items)
+
+
+def _per_order(aggregate):
+    return Subquery(
+        OrderItem.objects.filter(order_id=OuterRef("pk"))
+        .order_by()
+        .values("order_id")
+        .annotate(value=aggregate)
+        .values("value")[:1]
+    )
+
+
+def refresh_order_totals(order_ids):
+    return Order.objects.filter(id__in=order_ids).update(
+        item_count=Coalesce(_per_order(Count("id")), Value(0)),
+        total_price=Coalesce(
+            _per_order(Sum(F("unit_price") * F("quantity"), output_field=MONEY)),
+            Value(0), output_field=MONEY,
+        ),
+    )
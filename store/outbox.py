@@ -0,0 +1,133 @@
+import logging
+import time
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Order, OrderEvent
+from .signals import order_created, orders_created
+
+logger = logging.getLogger(__name__)
+
+# ! Order events outbox (OrderEvent). Delivery is at-least-once: a row is
+# ! only marked delivered after the receivers ran, so a crash in between
+# ! means the relay sends it again later. Receivers should be idempotent.
+
+
+def relay_delay():
+    # Time the in-process workers get before the relay steps in
+    return timedelta(seconds=getattr(settings, "STORE_OUTBOX_RELAY_DELAY", 30))
+
+
+def record_order_created(order):
+    """Write the outbox row, call inside the checkout transaction."""
+    return OrderEvent.objects.create(
+        order=order,
+        event_type=OrderEvent.ORDER_CREATED,
+        available_at=timezone.now() + relay_delay(),
+    )
+
+
+def send_order_events(sender, orders):
+    """Run the receivers, returns {order pk: error message} for failures."""
+    errors = {}
+    if not orders:
+        return errors
+    for order in orders:
+        for receiver, response in order_created.send_robust(sender, order=order):
+            if isinstance(response, Exception):
+                logger.error("order_created receiver %r failed for order %s: %r",
+                             receiver, order.pk, response)
+                errors[order.pk] = repr(response)
+    for receiver, response in orders_created.send_robust(sender, orders=list(orders)):
+        if isinstance(response, Exception):
+            # A batch receiver failing fails every order in the batch
+            logger.error("orders_created receiver %r failed: %r", receiver, response)
+            for order in orders:
+                errors.setdefault(order.pk, repr(response))
+    return errors
+
+
+def settle(events, errors):
+    """Mark events delivered, or schedule a retry with backoff, one UPDATE each kind."""
+    now = timezone.now()
+    delivered, failed = [], []
+    for event in events:
+        error = errors.get(event.order_id)
+        if error is None:
+            event.delivered_at = now
+            event.latency_ms = (now - event.created_at).total_seconds() * 1000
+            event.claim_token = ""
+            delivered.append(event)
+        else:
+            event.last_error = error
+            event.available_at = now + timedelta(seconds=min(2 ** event.attempts, 3600))
+            event.claim_token = ""
+            failed.append(event)
+    if delivered:
+        OrderEvent.objects.bulk_update(delivered, ["delivered_at", "latency_ms", "claim_token", "attempts"])
+    if failed:
+        OrderEvent.objects.bulk_update(failed, ["last_error", "available_at", "claim_token", "attempts"])
+    return len(delivered), len(failed)
+
+
+def claim_events(batch_size=100, lease=60):
+    """Claim up to batch_size due events for this relay, returns them.
+
+    Claiming pushes available_at out by the lease and bumps attempts, in a
+    short transaction. If the relay dies before settling, the lease runs
+    out and another relay picks the rows up again."""
+    now = timezone.now()
+    token = uuid4().hex
+    due = OrderEvent.objects.filter(delivered_at__isnull=True, available_at__lte=now).order_by("id")
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            # Other relays skip the rows we hold instead of waiting on them
+            ids = list(due.select_for_update(skip_locked=True).values_list("id", flat=True)[:batch_size])
+        else:
+            # SQLite: no row locks, the claim token below decides who won
+            ids = list(due.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return []
+        # Re-checking "due" here means a row another relay claimed in the
+        # meantime no longer matches
+        due.filter(id__in=ids).update(
+            claim_token=token,
+            available_at=now + timedelta(seconds=lease),
+            attempts=F("attempts") + 1,
+        )
+    return list(OrderEvent.objects.filter(claim_token=token).order_by("id"))
+
+
+def relay_batch(batch_size=100, lease=60):
+    """Claim and deliver one batch, returns (delivered, failed)."""
+    events = claim_events(batch_size, lease)
+    if not events:
+        return 0, 0
+    orders = Order.objects.in_bulk([event.order_id for event in events])
+    # An order that is gone has nothing left to announce, it settles as delivered
+    errors = send_order_events(OrderEvent, [orders[event.order_id] for event in events if event.order_id in orders])
+    return settle(events, errors)
+
+
+def prune_delivered(older_than=None, chunk_size=1000, pause=0):
+    """Delete events delivered before older_than ago in id chunks, returns rows deleted."""
+    if older_than is None:
+        older_than = timedelta(seconds=getattr(settings, "STORE_OUTBOX_RETENTION", 60 * 60 * 24 * 7))
+    cutoff = timezone.now() - older_than
+    deleted = 0
+    while True:
+        ids = list(
+            OrderEvent.objects.filter(delivered_at__lt=cutoff)
+            .order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        count, _ = OrderEvent.objects.filter(id__in=ids).delete()
+        deleted += count
+        if pause:
+            time.sleep(pause)
@@ -1,6 +1,195 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
 
 class DefaultPagination(PageNumberPagination):
     page_size = 10
 
-    
\ No newline at end of file
+
+# ! Keyset (cursor) pagination: instead of COUNT(*) + OFFSET we remember the
+# ! (ordering field, id) of the last row on the page and ask the database for
+# ! rows "after" it. Deep pages cost the same as the first one.
+class KeysetPagination(BasePagination):
+    page_size = 10
+    cursor_query_param = "cursor"
+    # Used when the client does not send ?ordering=
+    default_ordering = "id"
+    # Unique column appended to the ordering so the position is always stable
+    tiebreaker = "id"
+    # Relevance annotation added by ProductSearchFilter, used when searching
+    # without an explicit ?ordering=
+    rank_field = "search_rank"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor["r"]
+        # Going backwards means walking the index the other way round
+        # and flipping the rows back afterwards
+        ordering = [_flip(field) for field in self.ordering] if reverse else self.ordering
+
+        queryset = queryset.order_by(*ordering)
+        if cursor is not None:
+            values = self.clean_values(queryset, cursor["v"])
+            queryset = queryset.filter(self.after(ordering, values))
+
+        # One extra row tells us if there is another page without counting
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = results
+        return results
+
+    def get_ordering(self, request, queryset, view):
+        # ! Reuse whatever OrderingFilter resolved (?ordering=unit_price etc)
+        # ! so we stay in sync with the view's ordering_fields
+        field = None
+        for backend in getattr(view, "filter_backends", []):
+            if hasattr(backend, "get_ordering"):
+                ordering = backend().get_ordering(request, queryset, view)
+                if ordering:
+                    field = ordering[0]
+                break
+
+        if field is None and self.rank_field in queryset.query.annotations:
+            field = "-" + self.rank_field
+        field = field or self.default_ordering
+        if field.lstrip("-") == self.tiebreaker:
+            return [field]
+        tiebreaker = "-" + self.tiebreaker if field.startswith("-") else self.tiebreaker
+        return [field, tiebreaker]
+
+    def after(self, ordering, values):
+        # (a, b) > (x, y)  ==  a > x OR (a = x AND b > y)
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= Q(**equal, **{f"{name}__{lookup}": value})
+            equal[name] = value
+        return condition
+
+    def clean_values(self, queryset, values):
+        # Cursors come from the client, check every value parses as its
+        # column (the same to_python() the filter would run) so a tampered
+        # one is a 404 and not a 500
+        cleaned = []
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip("-")
+            if name in queryset.query.annotations:
+                model_field = queryset.query.annotations[name].output_field
+            else:
+                model_field = queryset.model._meta.get_field(name)
+            try:
+                value = model_field.to_python(value)
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            cleaned.append(value)
+        return cleaned
+
+    def position(self, item):
+        # Rows are model instances, or dicts when the view paginates values()
+        fields = [field.lstrip("-") for field in self.ordering]
+        if isinstance(item, dict):
+            return [_encode_value(item[field]) for field in fields]
+        return [_encode_value(getattr(item, field)) for field in fields]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            values, reverse = cursor["v"], bool(cursor["r"])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return {"v": values, "r": reverse}
+
+    def encode_cursor(self, values, reverse):
+        payload = json.dumps({"v": values, "r": reverse}, separators=(",", ":"))
+        encoded = base64.urlsafe_b64encode(payload.encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.position(self.page[-1]), False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.position(self.page[0]), True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class ProductPagination(KeysetPagination):
+    page_size = 10
+
+
+# ! Back-office clients still want page numbers and a total count,
+# ! they can ask for it with ?pagination=page (or just send ?page=N)
+PAGE_NUMBER_QUERY_PARAM = "pagination"
+
+
+def wants_page_numbers(request):
+    params = request.query_params
+    return params.get(PAGE_NUMBER_QUERY_PARAM) == "page" or "page" in params
+
+
+def _flip(field):
+    return field[1:] if field.startswith("-") else "-" + field
+
+
+def _encode_value(value):
+    # Keep full precision (microseconds / decimals) so the keyset is exact
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
@@ -0,0 +1,62 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db.models import DecimalField, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Least, Round
+from django.utils import timezone
+
+from .models import Product
+
+# ! Product.effective_price = unit_price minus the best promotion discount.
+# ! Promotion.discount is a percentage (10 means 10% off), promotions don't
+# ! stack, only the biggest one counts. The column is kept up to date by the
+# ! signal handlers so listings can filter/order on it without any join.
+# ! Promotion.discount is a float, both the Python and the SQL side turn it
+# ! into a 4 place decimal first so they agree on every price.
+CENT = Decimal("0.01")
+PERCENT_PLACES = Decimal("0.0001")
+PERCENT = DecimalField(max_digits=7, decimal_places=4)
+PRICE = DecimalField(max_digits=6, decimal_places=2)
+
+
+def effective_price(unit_price, discount=None):
+    if unit_price is None:
+        return None
+    discount = Decimal(str(discount or 0)).quantize(PERCENT_PLACES, rounding=ROUND_HALF_UP)
+    discount = min(max(discount, Decimal(0)), Decimal(100))
+    price = Decimal(unit_price) * (Decimal(100) - discount) / Decimal(100)
+    return price.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def best_discount(product_id):
+    return Product.promotions.through.objects \
+        .filter(product_id=product_id) \
+        .aggregate(discount=Max("promotion__discount"))["discount"]
+
+
+def product_discount(product):
+    """best_discount() of a saved product, without a query when its
+    promotions are prefetched."""
+    promotions = getattr(product, "_prefetched_objects_cache", {}).get("promotions")
+    if promotions is None:
+        return best_discount(product.pk)
+    return max((promotion.discount for promotion in promotions), default=None)
+
+
+def refresh_effective_prices(product_ids):
+    """Recompute effective_price for many products in one UPDATE."""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    best = Product.promotions.through.objects \
+        .filter(product_id=OuterRef("pk")) \
+        .values("product_id") \
+        .annotate(discount=Cast(Max("promotion__discount"), PERCENT)) \
+        .values("discount")
+    zero, hundred = Value(Decimal(0), output_field=PERCENT), Value(Decimal(100), output_field=PERCENT)
+    discount = Least(Greatest(Coalesce(Subquery(best), zero), zero), hundred)
+    # Rounded in SQL like effective_price() does, SQLite would store 8.4915
+    # in the 2 decimal column otherwise
+    price = Round(F("unit_price") * (hundred - discount) / hundred, 2, output_field=PRICE)
+    # update() skips auto_now, stamp last_update so ETags change too
+    return Product.objects.filter(pk__in=product_ids) \
+        .update(effective_price=price, last_update=timezone.now())
@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, Value, When
+
+from .models import ArchivedOrder, CustomerHistory, Order
+
+# ! Bulk payment status reconciliation (settlement files). Rows are
+# ! applied a chunk at a time: one SELECT finds which ids exist (and their
+# ! current status), then one UPDATE ... WHERE id IN (...) per status.
+# ! QuerySet.update() sends no signals, so the customer history deltas
+# ! that post_save would apply are applied here, one UPDATE per chunk.
+
+IN_LIST_SIZE = 1000
+MAX_ORDER_ID = 2 ** 63 - 1
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+# Accept the status codes and their labels ("C", "completed", ...)
+STATUS_ALIASES = {}
+for code, label in Order.PAYMENT_STATUS:
+    STATUS_ALIASES[code.lower()] = code
+    STATUS_ALIASES[label.lower()] = code
+
+
+def parse_row(order_id, status):
+    """(id, status code) or raises ValueError with a readable message."""
+    try:
+        parsed = int(str(order_id).strip())
+    except (TypeError, ValueError):
+        parsed = None
+    # Anything a BigAutoField can't hold would fail in the SELECT instead
+    if parsed is None or not 0 < parsed <= MAX_ORDER_ID:
+        raise ValueError(f"Invalid order id {order_id!r}")
+    order_id = parsed
+    code = STATUS_ALIASES.get(str(status or "").strip().lower())
+    if code is None:
+        raise ValueError(f"Invalid payment_status {status!r}")
+    return order_id, code
+
+
+class Reconciliation:
+    """Accumulates the outcome of one reconciliation over many chunks."""
+
+    def __init__(self, dry_run=False, max_unknown=1000):
+        self.dry_run = dry_run
+        self.max_unknown = max_unknown
+        self.received = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.unknown = 0
+        self.unknown_ids = []
+        self.invalid = []
+
+    def add_invalid(self, row, error):
+        self.invalid.append({"row": row, "error": error})
+
+    def apply(self, rows):
+        """Apply a chunk of (order id, status code) rows, the last row for an id wins."""
+        wanted = dict(rows)
+        self.received += len(rows)
+        if not wanted:
+            return
+        with transaction.atomic():
+            for model in (Order, ArchivedOrder):
+                if not wanted:
+                    break
+                found = self.apply_to(model, wanted)
+                for order_id in found:
+                    wanted.pop(order_id)
+            if self.dry_run:
+                transaction.set_rollback(True)
+
+        self.unknown += len(wanted)
+        room = self.max_unknown - len(self.unknown_ids)
+        if room > 0:
+            self.unknown_ids.extend(sorted(wanted)[:room])
+
+    def apply_to(self, model, wanted):
+        current = list(
+            model.objects.select_for_update().filter(id__in=list(wanted))
+            .values_list("id", "payment_status", "customer_id", "total_price")
+        )
+        by_status = defaultdict(list)
+        completed = defaultdict(int)
+        spent = defaultdict(int)
+        for order_id, old_status, customer_id, total_price in current:
+            new_status = wanted[order_id]
+            if new_status == old_status:
+                self.unchanged += 1
+                continue
+            by_status[new_status].append(order_id)
+            if Order.PAYMENT_COMPLETED in (old_status, new_status):
+                sign = 1 if new_status == Order.PAYMENT_COMPLETED else -1
+                completed[customer_id] += sign
+                spent[customer_id] += sign * total_price
+
+        for status, ids in by_status.items():
+            for start in range(0, len(ids), IN_LIST_SIZE):
+                self.updated += model.objects.filter(id__in=ids[start:start + IN_LIST_SIZE]) \
+                    .update(payment_status=status)
+        self.apply_history(completed, spent)
+        return [order_id for order_id, *_ in current]
+
+    def apply_history(self, completed, spent):
+        customers = [customer_id for customer_id, count in completed.items() if count]
+        if not customers:
+            return
+        CustomerHistory.objects.bulk_create(
+            [CustomerHistory(customer_id=customer_id) for customer_id in customers], ignore_conflicts=True
+        )
+        for start in range(0, len(customers), IN_LIST_SIZE):
+            chunk = customers[start:start + IN_LIST_SIZE]
+            CustomerHistory.objects.filter(customer_id__in=chunk).update(
+                completed_order_count=F("completed_order_count") + Case(
+                    *[When(customer_id=customer_id, then=Value(completed[customer_id])) for customer_id in chunk],
+                    default=Value(0), output_field=IntegerField(),
+                ),
+                total_spent=F("total_spent") + Case(
+                    *[When(customer_id=customer_id, then=Value(spent[customer_id])) for customer_id in chunk],
+                    default=Value(0), output_field=MONEY,
+                ),
+            )
+
+    def report(self):
+        return {
+            "received": self.received,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "unknown": self.unknown,
+            "unknown_ids": self.unknown_ids,
+            "invalid": self.invalid,
+            "dry_run": self.dry_run,
+        }
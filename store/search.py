@@ -0,0 +1,229 @@
+import abc
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, FloatField, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# ! Columns we search on and how much a hit in each one is worth
+SEARCH_FIELDS = {"title": 2.0, "description": 1.0}
+# ! Name of the relevance annotation, KeysetPagination orders by it too
+RANK_ANNOTATION = "search_rank"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [token for token in _TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+class BaseSearchBackend(abc.ABC):
+    """Interface every product search backend implements."""
+
+    # Most matches a search can return, None when the backend has no cap
+    max_results = None
+
+    @abc.abstractmethod
+    def search(self, queryset, query):
+        """Return queryset narrowed to matches and ordered by relevance."""
+
+    def index(self, product):
+        """Called after a product is saved."""
+
+    def remove(self, product_id):
+        """Called after a product is deleted."""
+
+    def index_many(self, products):
+        """Called after bulk writes, which send no post_save."""
+        for product in products:
+            self.index(product)
+
+    def rebuild(self):
+        """Re-index the whole catalog, returns number of products indexed."""
+        return Product.objects.count()
+
+
+class MySQLFullTextSearchBackend(BaseSearchBackend):
+    """MATCH ... AGAINST on the FULLTEXT index added in migration 0015.
+    MySQL keeps that index up to date itself, so index/remove are no-ops."""
+
+    def search(self, queryset, query):
+        table = Product._meta.db_table
+        columns = ", ".join(
+            f"{connection.ops.quote_name(table)}.{connection.ops.quote_name(field)}"
+            for field in SEARCH_FIELDS
+        )
+        match = RawSQL(
+            f"MATCH ({columns}) AGAINST (%s IN NATURAL LANGUAGE MODE)",
+            (query,),
+            output_field=FloatField(),
+        )
+        return queryset.annotate(**{RANK_ANNOTATION: match}) \
+            .filter(**{f"{RANK_ANNOTATION}__gt": 0}) \
+            .order_by(f"-{RANK_ANNOTATION}", "id")
+
+
+class InvertedIndexSearchBackend(BaseSearchBackend):
+    """In-process inverted index (term -> {product id: weighted tf}).
+
+    Used for SQLite and tests. The index lives in this process only and is
+    built lazily on the first search, then kept current by the Product
+    post_save/post_delete handlers (once the write commits)."""
+
+    # ! Only the best STORE_SEARCH_MAX_RESULTS matches are pushed down to
+    # ! the database (as an id list), anything ranked below that is not
+    # ! returned, not even on later pages. Product listings report the cap
+    # ! as "search_max_results" and a warning is logged when it cuts.
+    # ! The cap counts matches the listing's filters let through: ranked
+    # ! ids are checked against the filtered queryset candidate_chunk_size
+    # ! at a time, best first, until the cap is full.
+    max_results = 1000
+    candidate_chunk_size = 1000
+
+    def __init__(self):
+        self.max_results = getattr(settings, "STORE_SEARCH_MAX_RESULTS", self.max_results)
+        self._lock = threading.RLock()
+        self._postings = defaultdict(dict)
+        self._documents = {}
+        self._built = False
+
+    def _terms(self, product):
+        weights = defaultdict(float)
+        for field, weight in SEARCH_FIELDS.items():
+            for token in tokenize(getattr(product, field)):
+                weights[token] += weight
+        return weights
+
+    def _add(self, product_id, weights):
+        self._discard(product_id)
+        for term, weight in weights.items():
+            self._postings[term][product_id] = weight
+        self._documents[product_id] = tuple(weights)
+
+    def _discard(self, product_id):
+        for term in self._documents.pop(product_id, ()):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def rebuild(self):
+        products = Product.objects.only("id", *SEARCH_FIELDS).iterator(chunk_size=2000)
+        with self._lock:
+            self._postings = defaultdict(dict)
+            self._documents = {}
+            for product in products:
+                self._add(product.id, self._terms(product))
+            self._built = True
+            return len(self._documents)
+
+    def index(self, product):
+        with self._lock:
+            if self._built:
+                self._add(product.pk, self._terms(product))
+
+    def remove(self, product_id):
+        with self._lock:
+            if self._built:
+                self._discard(product_id)
+
+    def index_many(self, products):
+        with self._lock:
+            if not self._built:
+                return
+            for product in products:
+                if product.pk is None:
+                    # bulk_create on MySQL doesn't return ids, rebuild lazily
+                    self._built = False
+                    return
+                self._add(product.pk, self._terms(product))
+
+    def scores(self, query):
+        # tf-idf: rare terms count more than terms found in every product
+        with self._lock:
+            self._ensure_built()
+            total = len(self._documents) or 1
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + total / len(postings))
+                for product_id, weight in postings.items():
+                    scores[product_id] += weight * idf
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(product_id, round(score, 6)) for product_id, score in ranked]
+
+    def search(self, queryset, query):
+        ranked = []
+        candidates = self.scores(query)
+        for start in range(0, len(candidates), self.candidate_chunk_size):
+            chunk = candidates[start:start + self.candidate_chunk_size]
+            allowed = set(
+                queryset.order_by().filter(id__in=[product_id for product_id, _ in chunk])
+                .values_list("id", flat=True)
+            )
+            ranked.extend(item for item in chunk if item[0] in allowed)
+            if len(ranked) > self.max_results:
+                break
+        if len(ranked) > self.max_results:
+            logger.warning(
+                "Search %r matched more than %d products, only the best %d are returned",
+                query, self.max_results, self.max_results,
+            )
+            ranked = ranked[:self.max_results]
+        if not ranked:
+            return queryset.none()
+        rank = Case(
+            *[When(id=product_id, then=Value(score)) for product_id, score in ranked],
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+        return queryset.filter(id__in=[product_id for product_id, _ in ranked]) \
+            .annotate(**{RANK_ANNOTATION: rank}) \
+            .order_by(f"-{RANK_ANNOTATION}", "id")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    # ! settings.STORE_SEARCH_BACKEND can point at any BaseSearchBackend,
+    # ! otherwise we pick FULLTEXT on MySQL and the inverted index elsewhere
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, "STORE_SEARCH_BACKEND", None)
+                if path:
+                    _backend = import_string(path)()
+                elif connection.vendor == "mysql":
+                    _backend = MySQLFullTextSearchBackend()
+                else:
+                    _backend = InvertedIndexSearchBackend()
+    return _backend
+
+
+def reset_search_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
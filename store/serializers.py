@@ -1,10 +1,18 @@
-# from init file importing order_created
-from .signals import order_created
+from .events import dispatch_order_created
 from rest_framework import serializers
+from collections import Counter
 from decimal import Decimal
 from  store.models import Order, OrderItem, Review,CartItem, Collection, Product, Cart, Customer
 from rest_framework.viewsets import ModelViewSet
-from django.db import transaction
+from rest_framework.settings import api_settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .pricing import effective_price, refresh_effective_prices
+from .carts import CartNotFound, ProductNotFound
+from .cart_storage import get_cart_storage
+from .inventory import OutOfStock, reserve_stock
+from .orders import order_totals
+from .history import record_order
 # ! The objects we return in api is not important
 # ! to be exactly like our models
 
@@ -48,17 +56,19 @@ class CollectionSerializer(serializers.Serializer):
 # ! In model serilizartion we dont need to define each field
 # ! separate
 
+TAX_RATE = Decimal(1.1)
+
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ["id", "title", "description","slug", "inventory" , "unit_price", "price_with_tax", "collection"]
+        fields = ["id", "title", "description","slug", "inventory" , "unit_price", "effective_price", "price_with_tax", "collection"]
         # fields = "__al__" #This is the bad practice
     price_with_tax = serializers.SerializerMethodField(
         method_name='calculate_tax'
     )
 
     def calculate_tax(self, product):
-        return product.unit_price * Decimal(1.1)
+        return product.unit_price * TAX_RATE
 
 
     # ! Lets say users want to register, we can validate their data
@@ -84,6 +94,139 @@ class ProductSerializer(serializers.ModelSerializer):
         return instance
         
 
+# ! Read only, fast version of ProductSerializer for listings.
+# ! It works on rows from Product.objects.values(*value_fields) so no model
+# ! instances and no field machinery per row, output is the same shape.
+class ProductValuesSerializer(serializers.BaseSerializer):
+    value_fields = ["id", "title", "description", "slug", "inventory", "unit_price",
+                    "effective_price", "collection_id"]
+
+    def to_representation(self, row):
+        unit_price = row["unit_price"]
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "description": row["description"],
+            "slug": row["slug"],
+            "inventory": row["inventory"],
+            "unit_price": unit_price,
+            "effective_price": row["effective_price"],
+            "price_with_tax": unit_price * TAX_RATE,
+            "collection": row["collection_id"],
+        }
+
+
+# ! Bulk create/update of products (catalog sync from the PIM).
+# ! Rows with an "id" update that product, rows without one are created.
+# ! Field validation runs per row, but the collection FK and the ids to
+# ! update are checked with one query each instead of one per row.
+class BulkProductListSerializer(serializers.ListSerializer):
+    batch_size = 500
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ["Expected a list of products."]
+            })
+        if not data:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ["No products were sent."]
+            })
+        if self.max_length is not None and len(data) > self.max_length:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [f"Send at most {self.max_length} products at once."]
+            })
+
+        rows, errors = [], []
+        for item in data:
+            try:
+                rows.append(self.child.run_validation(item))
+                errors.append({})
+            except serializers.ValidationError as exc:
+                rows.append(None)
+                errors.append(exc.detail)
+
+        valid = [row for row in rows if row is not None]
+        collection_ids = set(Collection.objects.filter(
+            id__in={row["collection_id"] for row in valid}
+        ).values_list("id", flat=True))
+        product_ids = set(Product.objects.filter(
+            id__in=[row["id"] for row in valid if row.get("id") is not None]
+        ).values_list("id", flat=True))
+
+        seen = set()
+        for index, row in enumerate(rows):
+            if row is None:
+                continue
+            if row["collection_id"] not in collection_ids:
+                errors[index]["collection_id"] = ["No collection with the given id was found"]
+            product_id = row.get("id")
+            if product_id is not None:
+                if product_id not in product_ids:
+                    errors[index]["id"] = ["No product with the given id was found"]
+                elif product_id in seen:
+                    errors[index]["id"] = ["This product appears more than once"]
+                seen.add(product_id)
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return rows
+
+    def save(self, **kwargs):
+        to_create, to_update = [], []
+        for row in self.validated_data:
+            row = dict(row)
+            product_id = row.pop("id", None)
+            if product_id is None:
+                # New products have no promotions yet
+                to_create.append(Product(effective_price=effective_price(row["unit_price"]), **row))
+            else:
+                to_update.append(Product(id=product_id, **row))
+
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                created = Product.objects.bulk_create(to_create, batch_size=self.batch_size)
+            else:
+                created = self.insert_one_by_one(to_create)
+            # bulk_update skips auto_now, so stamp last_update ourselves
+            now = timezone.now()
+            for product in to_update:
+                product.last_update = now
+            Product.objects.bulk_update(
+                to_update, self.child.update_fields, batch_size=self.batch_size
+            )
+            refresh_effective_prices(product.id for product in to_update)
+
+        self.instance = {"created": created, "updated": to_update}
+        return self.instance
+
+    def insert_one_by_one(self, products):
+        # bulk_create doesn't return ids on MySQL, and a multi-row INSERT's
+        # auto-increment ids needn't even be consecutive there. A single-row
+        # INSERT reports its own id: the same _insert() Model.save() does,
+        # without the signals the bulk path skips anyway.
+        meta = Product._meta
+        fields = [field for field in meta.local_concrete_fields if field is not meta.auto_field]
+        for product in products:
+            [(product.pk,)] = Product._base_manager._insert(
+                [product], fields=fields, returning_fields=meta.db_returning_fields
+            )
+            product._state.adding = False
+        return products
+
+
+class BulkProductSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(required=False)
+    collection_id = serializers.IntegerField()
+    update_fields = ["title", "slug", "description", "unit_price",
+                     "inventory", "collection_id", "last_update"]
+
+    class Meta:
+        model = Product
+        fields = ["id", "title", "slug", "description", "unit_price", "inventory", "collection_id"]
+        list_serializer_class = BulkProductListSerializer
+
+
 class CollectionSerializer(serializers.ModelSerializer):
     # ! Since the collection model does not have field products_count
     # ! So I define a field here  below, which is readonly not accept input data
@@ -131,7 +274,11 @@ class CartItemSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField()
     #This is convention to return value using method for above field
     # The method should follow the field name
+    # total_price is annotated by the database (store.carts.line_total),
+    # fall back to Python for items that weren't loaded through it
     def get_total_price(self, cart_item:CartItem):
+        if hasattr(cart_item, 'total_price'):
+            return cart_item.total_price
         return cart_item.quantity * cart_item.product.unit_price
     
     class Meta:
@@ -144,6 +291,8 @@ class CartSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField()
 
     def get_total_price(self, cart):
+        if hasattr(cart, 'total_price'):
+            return cart.total_price
         return sum([item.quantity * item.product.unit_price for item in cart.items.all()])
     
     # This will show all items in cart, cart id and items
@@ -155,24 +304,21 @@ class CartSerializer(serializers.ModelSerializer):
 class AddCartItemSerializer(serializers.ModelSerializer):
     product_id = serializers.IntegerField()
 
-    # how to handle if someone updating quantity for a product in cart that does not exists
-    def validate_product_id(self, value):
-        if not Product.objects.filter(pk=value).exists():
-            raise serializers.ValidationError("No Product With The Given Id was found")
-        return value
-    
+    # ! No validate_product_id query anymore, the cart storage checks the
+    # ! product exists (in the same upsert statement for the database)
     def save(self, **kwargs):
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
         cart_id = self.context['cart_id']
 
         try:
-            cart_item = CartItem.objects.get(cart_id=cart_id, product_id = product_id)
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(cart_id= cart_id, **self.validated_data)
+            self.instance = get_cart_storage().add_item(cart_id, product_id, quantity)
+        except ProductNotFound:
+            raise serializers.ValidationError(
+                {"product_id": ["No Product With The Given Id was found"]}
+            )
+        except CartNotFound:
+            raise serializers.ValidationError({"cart_id": ["No cart with given id found"]})
         return self.instance
 
     class Meta:
@@ -180,10 +326,49 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product_id', 'quantity']
 
 
+class CartSummarySerializer(serializers.Serializer):
+    id = serializers.UUIDField()
+    item_count = serializers.IntegerField()
+    quantity = serializers.IntegerField()
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class SyncCartItemSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, max_value=32767)
+
+
+class SyncCartItemListSerializer(serializers.ListSerializer):
+    # PUT /store/carts/{id}/items/ body: the complete list of lines wanted
+    child = SyncCartItemSerializer()
+
+    def validate(self, items):
+        counts = Counter(item["product_id"] for item in items)
+        duplicates = sorted(product_id for product_id, count in counts.items() if count > 1)
+        if duplicates:
+            raise serializers.ValidationError(f"Duplicate product ids: {duplicates}")
+        return items
+
+    def save(self, **kwargs):
+        cart_id = self.context['cart_id']
+        quantities = {item["product_id"]: item["quantity"] for item in self.validated_data}
+        try:
+            return get_cart_storage().replace_items(cart_id, quantities)
+        except ProductNotFound as error:
+            raise serializers.ValidationError({"product_id": [f"No product with the given ids {error.args[0]}"]})
+        except CartNotFound:
+            raise serializers.ValidationError({"cart_id": ["No cart with given id found"]})
+
+
 class UpdateCartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = ["quantity"]
+
+    def update(self, instance, validated_data):
+        instance.quantity = validated_data.get("quantity", instance.quantity)
+        get_cart_storage().update_item(self.context['cart_id'], instance.id, instance.quantity)
+        return instance
         
 class CustomerSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField(read_only = True)
@@ -191,6 +376,21 @@ class CustomerSerializer(serializers.ModelSerializer):
         model = Customer
         fields = ["id", "user_id", "phone", "birth_date", "membership"]
 
+class TopProductSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    title = serializers.CharField(source="product.title")
+    quantity = serializers.IntegerField()
+    amount = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+
+class CustomerHistorySerializer(serializers.Serializer):
+    customer_id = serializers.IntegerField()
+    order_count = serializers.IntegerField()
+    completed_order_count = serializers.IntegerField()
+    total_spent = serializers.DecimalField(max_digits=14, decimal_places=2)
+    last_order_at = serializers.DateTimeField(allow_null=True)
+    top_products = TopProductSerializer(many=True)
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = SimpleProductSerializer()
     class Meta:
@@ -201,35 +401,70 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     class Meta:
         model = Order
-        fields = ["id","customer","placed_at","payment_status","items"]
+        fields = ["id","customer","placed_at","payment_status","item_count","total_price","items"]
 
 class CreateOrderSerializer(serializers.Serializer):
     cart_id = serializers.UUIDField()
+
+    def validate_cart_id(self, cart_id):
+        count = get_cart_storage().item_count(cart_id)
+        if count is None:
+            raise serializers.ValidationError("No cart with given id found")
+        if count == 0:
+            raise serializers.ValidationError("No Items founds in cart")
+        return cart_id
    
     # Creating an Order using with tranaction all will be done, or Rollback on failure
     def save(self,**kwargs):
-        with transaction.atomic():
-            cart_id = self.validated_data['cart_id']
-            (customer, create) = Customer.objects.get(user_id = self.context['user_id'])
-            order = Order.objects.create(customer = customer)
+        cart_id = self.validated_data['cart_id']
+        storage = get_cart_storage()
+        # ! A cart in the cache hot store is written to the database first,
+        # ! so what we read below is the latest state whatever the backend
+        storage.prepare_checkout(cart_id)
 
-            cart_items = CartItem.objects.select_related('product') \
-            .filter(cart_id= cart_id)
+        with transaction.atomic():
+            (customer, create) = Customer.objects.get_or_create(user_id = self.context['user_id'])
+            # Lock the cart row so the items can't change while we copy them
+            if not Cart.objects.select_for_update().filter(pk = cart_id).exists():
+                raise serializers.ValidationError({"cart_id": ["No cart with given id found"]})
+
+            cart_items = list(CartItem.objects.select_related('product') \
+            .filter(cart_id= cart_id))
+
+            if not cart_items:
+                # The cart was emptied (or reaped) after validation
+                raise serializers.ValidationError({"cart_id": ["No Items founds in cart"]})
+
+            # ! Take the stock first, any shortage rolls the whole order back
+            try:
+                reserve_stock({item.product_id: item.quantity for item in cart_items})
+            except OutOfStock as error:
+                raise serializers.ValidationError({"items": [
+                    f"Only {available} left of product {product_id}"
+                    for product_id, available in sorted(error.shortages.items())
+                ]})
 
             order_items = [
                 OrderItem(
-                    order = order,
                     product = item.product,
                     unit_price = item.product.unit_price,
                     quantity = item.quantity
                 ) for item in cart_items
             ]
+            item_count, total_price = order_totals(order_items)
+            order = Order.objects.create(customer = customer, item_count = item_count, total_price = total_price)
+            for order_item in order_items:
+                order_item.order = order
 
             # This is how to create a bulk order
             OrderItem.objects.bulk_create(order_items)
+            record_order(order, order_items)
             # Delete cart after creating the order
             Cart.objects.filter(pk = cart_id).delete()
-            order_created.send_robust(self.__class__, order = order)
+            # robust: the order is committed by then, a cache hiccup mustn't fail the request
+            transaction.on_commit(lambda: storage.checked_out(cart_id), robust=True)
+            # ! Receivers run after commit on the order event workers
+            dispatch_order_created(self.__class__, order)
             return order
             
 
@@ -1,3 +1,5 @@
 from django.dispatch import Signal
 
 order_created = Signal()
+# ! Sent once per batch of orders by store.events, with orders=[...]
+orders_created = Signal()
@@ -1,6 +1,12 @@
-from store.models import Customer
+from store.models import Customer, Product, Collection, Promotion, Order, OrderItem
+from store.search import get_search_backend
+from store.cache import invalidate_catalog
+from store.pricing import effective_price, product_discount, refresh_effective_prices
+from store.orders import refresh_order_totals
+from store.history import record_payment_change
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.conf import settings
 
 # THis function (Signla handler) will be called everytime the user model is saved .
@@ -10,4 +16,96 @@ def create_customer_for_new_user(sender, **kwargs):
         Customer.objects.create(user = kwargs['instance'])
 
 
+# Keep the product search index in step with the catalog, once the
+# write commits: a rolled back save must not become searchable
+@receiver(post_save, sender = Product)
+def index_product(sender, **kwargs):
+    product = kwargs['instance']
+    transaction.on_commit(lambda: get_search_backend().index(product), robust=True)
 
+@receiver(post_delete, sender = Product)
+def unindex_product(sender, **kwargs):
+    # delete() clears instance.pk, keep it for later
+    product_id = kwargs['instance'].pk
+    transaction.on_commit(lambda: get_search_backend().remove(product_id), robust=True)
+
+
+# Any change to the catalog makes the cached product/collection responses stale
+@receiver([post_save, post_delete], sender = Product)
+@receiver([post_save, post_delete], sender = Collection)
+@receiver([post_save, post_delete], sender = Promotion)
+@receiver(m2m_changed, sender = Product.promotions.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    invalidate_catalog()
+
+
+# ! Keeping Product.effective_price up to date (see store.pricing)
+# Only a new price needs the promotions, a save that keeps the loaded
+# unit_price keeps the loaded effective_price too (promotion changes
+# update it through refresh_effective_prices)
+@receiver(pre_save, sender = Product)
+def set_effective_price(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and "unit_price" not in update_fields:
+        return
+    if instance._state.adding:
+        discount = None
+    elif "effective_price" in instance.__dict__ and \
+            instance.unit_price == instance.__dict__.get("_loaded_unit_price"):
+        return
+    else:
+        discount = product_discount(instance)
+    instance.effective_price = effective_price(instance.unit_price, discount)
+    instance._loaded_unit_price = instance.unit_price
+
+@receiver(m2m_changed, sender = Product.promotions.through)
+def promotions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # promotion.product_set.clear() doesn't tell us which products
+        instance._cleared_product_ids = list(
+            instance.product_set.values_list("id", flat=True)
+        )
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        product_ids = pk_set if action != "post_clear" else instance.__dict__.pop("_cleared_product_ids", [])
+    else:
+        product_ids = [instance.pk]
+    refresh_effective_prices(product_ids)
+    invalidate_catalog()
+
+@receiver(post_save, sender = Promotion)
+def promotion_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_effective_prices(instance.product_set.values_list("id", flat=True))
+        invalidate_catalog()
+
+@receiver(pre_delete, sender = Promotion)
+def promotion_deleting(sender, instance, **kwargs):
+    instance._affected_product_ids = list(instance.product_set.values_list("id", flat=True))
+
+@receiver(post_delete, sender = Promotion)
+def promotion_deleted(sender, instance, **kwargs):
+    refresh_effective_prices(instance.__dict__.pop("_affected_product_ids", []))
+    invalidate_catalog()
+
+
+# Order.item_count / total_price follow item edits (admin inline etc.),
+# checkout sets them itself since bulk_create sends no signals
+@receiver([post_save, post_delete], sender = OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    refresh_order_totals([instance.order_id])
+
+
+# Customer history follows payment status changes (PATCH /orders, admin)
+@receiver(pre_save, sender = Order)
+def order_saving(sender, instance, **kwargs):
+    if instance.pk:
+        instance._old_payment_status = Order.objects.filter(pk=instance.pk) \
+            .values_list("payment_status", flat=True).first()
+
+@receiver(post_save, sender = Order)
+def order_saved(sender, instance, created, **kwargs):
+    old_status = instance.__dict__.pop("_old_payment_status", None)
+    if not created and old_status is not None:
+        record_payment_change(instance, old_status)
@@ -1,3 +1,1372 @@
-from django.test import TestCase
+import base64
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from uuid import uuid4
+
+from django.contrib.auth.models import Permission
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+
+from core.models import User
+from store.models import (
+    ArchivedOrder, Cart, CartItem, Collection, CustomerHistory, CustomerProductStat, IdempotencyKey, Order,
+    OrderEvent, OrderItem, Product, Promotion,
+)
+from store.archive import archive_orders
+from store.cart_reaper import reap_abandoned_carts
+from store.cache import get_catalog_version
+from store.cart_storage import CacheCartStorage, CartStateLost, get_cart_storage, reset_cart_storage
+from store.carts import add_cart_item, cart_summary, cart_total, line_total, sync_cart_items
+from store.events import Metrics
+from store.export import export_rows
+from store.outbox import claim_events, prune_delivered, relay_batch
+from store.pricing import effective_price, refresh_effective_prices
+from store.search import BaseSearchBackend, get_search_backend, reset_search_backend
+from store.serializers import OrderSerializer
+from store.signals import order_created
+from store.views import OrderViewSet, ProductViewSet
 
 # Create your tests here.
+
+
+# ! Query plan regression suite for product listings. For every supported
+# ! ProductFilter / ordering combination we build the exact queryset
+# ! ProductViewSet + KeysetPagination would run, EXPLAIN it and fail if the
+# ! database has to scan the whole table (or sort when an index could
+# ! give the rows in order already).
+class ProductQueryPlanTests(TestCase):
+    FILTERS = {
+        "none": {},
+        "collection": {"collection_id": "{collection}"},
+        "price_range": {"unit_price__gt": "20", "unit_price__lt": "60"},
+        "collection_price": {
+            "collection_id": "{collection}", "unit_price__gt": "20", "unit_price__lt": "60",
+        },
+        "effective_price_range": {"effective_price__gt": "20", "effective_price__lt": "60"},
+    }
+    ORDERINGS = [
+        None, "unit_price", "-unit_price", "last_update", "-last_update",
+        "effective_price", "-effective_price",
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        collections = Collection.objects.bulk_create(
+            Collection(title=f"Collection {i}") for i in range(20)
+        )
+        cls.collection = collections[0]
+        Product.objects.bulk_create(
+            Product(
+                title=f"Product {i}",
+                slug=f"product-{i}",
+                unit_price=1 + i % 97,
+                effective_price=1 + i % 97,
+                inventory=i % 30,
+                collection=collections[i % len(collections)],
+            )
+            for i in range(2000)
+        )
+
+    def listing_queryset(self, params, second_page=False):
+        request = Request(APIRequestFactory().get("/store/products/", params))
+        view = ProductViewSet(request=request, action="list", kwargs={}, args=(), format_kwarg=None)
+        queryset = view.filter_queryset(view.get_queryset())
+        paginator = view.paginator
+        ordering = paginator.ordering = paginator.get_ordering(request, queryset, view)
+        queryset = queryset.order_by(*ordering)
+        if second_page:
+            # What a cursor decodes to: the position of the first page's last row
+            last = queryset[paginator.page_size - 1]
+            values = paginator.clean_values(queryset, paginator.position(last))
+            queryset = queryset.filter(paginator.after(ordering, values))
+        return queryset[:paginator.page_size + 1]
+
+    def plan(self, queryset):
+        if connection.vendor == "sqlite":
+            return queryset.explain()
+        if connection.vendor == "mysql":
+            return queryset.explain(format="TRADITIONAL")
+        self.skipTest(f"No plan checks for {connection.vendor}")
+
+    def assertUsesIndex(self, plan, combination, expect_sorted, allow_pk_scan=False):
+        table = Product._meta.db_table
+        if connection.vendor == "sqlite":
+            # On SQLite a bare "SCAN table" walks the rowid (primary key) b-tree
+            lines = [line for line in plan.splitlines() if table in line]
+            full_scan = not allow_pk_scan and any(
+                f"SCAN {table}" in line and "USING" not in line for line in lines
+            )
+            filesort = "USE TEMP B-TREE FOR ORDER BY" in plan
+        else:
+            full_scan = any(
+                line.split()[4:5] == ["ALL"] for line in plan.splitlines() if table in line
+            )
+            filesort = "Using filesort" in plan
+        self.assertFalse(full_scan, f"{combination} does a full table scan:\n{plan}")
+        if expect_sorted:
+            self.assertFalse(filesort, f"{combination} sorts instead of using an index:\n{plan}")
+
+    def test_filter_and_ordering_combinations_use_indexes(self):
+        for filter_name, filters in self.FILTERS.items():
+            for ordering in self.ORDERINGS:
+                params = {
+                    key: value.format(collection=self.collection.id)
+                    for key, value in filters.items()
+                }
+                if ordering:
+                    params["ordering"] = ordering
+                combination = f"filter={filter_name} ordering={ordering or 'id'}"
+                # A price range plus ordering on another column can't come
+                # from one index: the range is an index search, rows get sorted
+                range_fields = {key.split("__")[0] for key in filters if "__" in key}
+                expect_sorted = (
+                    not range_fields
+                    or range_fields == {(ordering or "").lstrip("-")}
+                )
+                # Walking the primary key for the first page is fine on its own
+                allow_pk_scan = not filters and ordering is None
+                with self.subTest(combination):
+                    plan = self.plan(self.listing_queryset(params))
+                    self.assertUsesIndex(plan, combination, expect_sorted, allow_pk_scan)
+                # The (col > x) OR (col = x AND id > y) cursor predicate must
+                # not push later pages off the composite index
+                with self.subTest(combination + " cursor page"):
+                    plan = self.plan(self.listing_queryset(params, second_page=True))
+                    self.assertUsesIndex(plan, combination, expect_sorted, allow_pk_scan)
+
+
+# ! Product listing through the API: keyset cursors come from the client
+# ! and have to be treated as untrusted input.
+class ProductListingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title="Pens")
+        Product.objects.bulk_create(
+            Product(
+                title=f"Pen {i}", slug=f"pen-{i}", unit_price=1 + i % 7,
+                effective_price=1 + i % 7, inventory=10, collection=collection,
+            )
+            for i in range(25)
+        )
+
+    def get(self, params):
+        return APIClient().get("/store/products/", params)
+
+    def test_every_ordering_pages_through_all_products(self):
+        expected = set(Product.objects.values_list("id", flat=True))
+        for field in ProductViewSet.ordering_fields:
+            for ordering in (field, "-" + field):
+                with self.subTest(ordering=ordering):
+                    response = self.get({"ordering": ordering})
+                    seen = []
+                    while True:
+                        self.assertEqual(response.status_code, 200)
+                        for row in response.data["results"]:
+                            self.assertNotIn("last_update", row)
+                            seen.append(row["id"])
+                        if not response.data["next"]:
+                            break
+                        response = APIClient().get(response.data["next"])
+                    self.assertEqual(len(seen), len(expected))
+                    self.assertEqual(set(seen), expected)
+
+    def test_detail_with_a_malformed_id_is_not_found(self):
+        for path in ("/store/products/abc/", "/store/collections/abc/"):
+            with self.subTest(path=path):
+                self.assertEqual(APIClient().get(path).status_code, 404)
+
+    def test_promotion_prices_are_stored_rounded(self):
+        product = Product.objects.first()
+        product.unit_price = Decimal("9.99")
+        product.save()
+        promotion = Promotion.objects.create(description="Spring", discount=15)
+        # m2m add goes through refresh_effective_prices (SQL), 9.99 * 0.85 = 8.4915
+        product.promotions.add(promotion)
+        self.assertTrue(Product.objects.filter(pk=product.pk, effective_price=Decimal("8.49")).exists())
+
+    def test_tampered_cursor_is_not_found(self):
+        cursors = {
+            "id": [["abc"], [None], [[1]]],
+            "unit_price": [["abc", 1], ["1.00", "x"], [{"a": 1}, 1]],
+            "-last_update": [["yesterday", 1]],
+        }
+        for ordering, values in cursors.items():
+            for value in values:
+                payload = json.dumps({"v": value, "r": False})
+                cursor = base64.urlsafe_b64encode(payload.encode("ascii")).decode("ascii")
+                with self.subTest(ordering=ordering, cursor=value):
+                    response = self.get({"ordering": ordering, "cursor": cursor})
+                    self.assertEqual(response.status_code, 404)
+
+
+    @override_settings(STORE_SEARCH_MAX_RESULTS=5, STORE_SEARCH_BACKEND="store.search.InvertedIndexSearchBackend")
+    def test_search_reports_its_result_cap(self):
+        reset_search_backend()
+        self.addCleanup(reset_search_backend)
+        with self.assertLogs("store.search", "WARNING"):
+            response = self.get({"search": "pen", "pagination": "page"})
+        self.assertEqual(response.data["search_max_results"], 5)
+        self.assertEqual(response.data["count"], 5)
+        self.assertNotIn("search_max_results", self.get({}).data)
+
+    @override_settings(STORE_SEARCH_MAX_RESULTS=5, STORE_SEARCH_BACKEND="store.search.InvertedIndexSearchBackend")
+    def test_search_cap_counts_filtered_matches(self):
+        reset_search_backend()
+        self.addCleanup(reset_search_backend)
+        # The five best "pen" matches all cost 5 or less
+        with self.assertLogs("store.search", "WARNING"):
+            response = self.get({"search": "pen", "unit_price__gt": 5, "pagination": "page"})
+        expected = Product.objects.filter(unit_price__gt=5).count()
+        self.assertGreater(expected, 5)
+        self.assertEqual(response.data["count"], 5)
+        self.assertTrue(all(Decimal(row["unit_price"]) > 5 for row in response.data["results"]))
+
+    @override_settings(STORE_SEARCH_BACKEND="store.search.InvertedIndexSearchBackend")
+    def test_search_index_follows_committed_writes_only(self):
+        reset_search_backend()
+        self.addCleanup(reset_search_backend)
+        backend = get_search_backend()
+        collection = Collection.objects.first()
+
+        def matches(query):
+            return list(backend.search(Product.objects.all(), query).values_list("id", flat=True))
+
+        self.assertEqual(matches("inkwell"), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Product.objects.create(
+                        title="Inkwell", slug="inkwell", unit_price=4, inventory=1, collection=collection,
+                    )
+                    raise DatabaseError("rolled back")
+            except DatabaseError:
+                pass
+            # The next product may get the rolled back row's id
+            blotter = Product.objects.create(
+                title="Blotter", slug="blotter", unit_price=4, inventory=1, collection=collection,
+            )
+            self.assertEqual(matches("blotter"), [])
+        self.assertEqual(matches("blotter"), [blotter.id])
+        self.assertEqual(matches("inkwell"), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            blotter.delete()
+        self.assertEqual(backend.scores("blotter"), [])
+
+    def test_search_backends_must_implement_search(self):
+        with self.assertRaises(TypeError):
+            BaseSearchBackend()
+
+    def test_catalog_version_is_bumped_after_commit(self):
+        product = Product.objects.first()
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.title = "Fountain pen"
+            product.save()
+            # Still inside the writer's transaction
+            self.assertEqual(get_catalog_version(), version)
+        self.assertGreater(get_catalog_version(), version)
+
+class BulkProductTests(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(title="Pens")
+        self.existing = Product.objects.create(
+            title="Pen", slug="pen", unit_price=2, inventory=1, collection=self.collection,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="pim", email="pim@example.com", is_staff=True))
+
+    def post(self, rows):
+        return self.client.post("/store/products/bulk/", rows, format="json")
+
+    def row(self, slug, **extra):
+        return {"title": slug, "slug": slug, "unit_price": 3, "inventory": 5,
+                "collection_id": self.collection.id, **extra}
+
+    def test_creates_return_201_with_ids(self):
+        # MySQL: bulk_create gives the objects no primary keys back
+        for returns_rows in (True, False):
+            with self.subTest(returns_rows=returns_rows), mock.patch.object(
+                type(connection.features), "can_return_rows_from_bulk_insert",
+                new_callable=mock.PropertyMock, return_value=returns_rows,
+            ):
+                # Slugs aren't unique, the ids must still match their rows
+                titles = [f"Pen {returns_rows} {i}" for i in range(3)]
+                rows = [self.row("pen", title=title) for title in titles]
+                response = self.post(rows + [self.row("pen", id=self.existing.id)])
+                self.assertEqual(response.status_code, 201)
+                created = dict(Product.objects.filter(title__in=titles).values_list("id", "title"))
+                self.assertEqual([created.get(pk) for pk in response.data["created"]], titles)
+                self.assertEqual(response.data["updated"], [self.existing.id])
+
+    def test_invalid_rows_fail_the_batch_with_errors_per_row(self):
+        response = self.post([
+            self.row("pen-1"),
+            self.row("pen-2", collection_id=self.collection.id + 100),
+            self.row("pen-3", unit_price=-1),
+            self.row("pen-4", id=self.existing.id + 100),
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.data
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(errors[0], {})
+        self.assertEqual(list(errors[1]), ["collection_id"])
+        self.assertEqual(list(errors[2]), ["unit_price"])
+        self.assertEqual(list(errors[3]), ["id"])
+        # Nothing from the batch was written, not even the valid row
+        self.assertEqual(list(Product.objects.values_list("slug", flat=True)), ["pen"])
+
+    def test_updates_only_return_200(self):
+        response = self.post([self.row("pen", id=self.existing.id)])
+        self.assertEqual(response.status_code, 200)
+
+# ! Many "add to cart" clicks on the same cart/product at once. With the
+# ! old get() / += / save() every lost update showed up here as a wrong
+# ! quantity or an IntegrityError on unique_together.
+class AddCartItemConcurrencyTests(TransactionTestCase):
+    THREADS = 8
+    ADDS_PER_THREAD = 10
+
+    def setUp(self):
+        self.user = User.objects.create(username="shopper", email="shopper@example.com")
+        collection = Collection.objects.create(title="Mugs")
+        self.product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=10, inventory=100, collection=collection
+        )
+        self.cart = Cart.objects.create()
+
+    def add_to_cart(self, quantity):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            return [
+                client.post(
+                    f"/store/carts/{self.cart.id}/items/",
+                    {"product_id": self.product.id, "quantity": quantity},
+                    format="json",
+                ).status_code
+                for _ in range(self.ADDS_PER_THREAD)
+            ]
+        finally:
+            connections.close_all()
+
+    def test_concurrent_adds_are_all_counted(self):
+        with ThreadPoolExecutor(max_workers=self.THREADS) as pool:
+            results = list(pool.map(self.add_to_cart, [2] * self.THREADS))
+
+        statuses = [code for codes in results for code in codes]
+        self.assertEqual(statuses, [201] * self.THREADS * self.ADDS_PER_THREAD)
+        item = CartItem.objects.get(cart=self.cart, product=self.product)
+        self.assertEqual(item.quantity, 2 * self.THREADS * self.ADDS_PER_THREAD)
+
+    def test_unknown_product_is_rejected_without_a_row(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            f"/store/carts/{self.cart.id}/items/",
+            {"product_id": self.product.id + 1000, "quantity": 1},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("product_id", response.data)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+    def test_sync_upserts_a_line_added_meanwhile(self):
+        # The add lands after sync read the cart's lines but before it inserts
+        read_lines = CartItem.objects.filter
+
+        def filter_racing_an_add(*args, **kwargs):
+            if read.call_count > 1:
+                return read_lines(*args, **kwargs)
+            lines = list(read_lines(*args, **kwargs))
+            add_cart_item(self.cart.id, self.product.id, 5)
+            return lines
+
+        with mock.patch.object(CartItem.objects, "filter", side_effect=filter_racing_an_add) as read:
+            sync_cart_items(self.cart.id, {self.product.id: 2})
+        item = CartItem.objects.get(cart=self.cart, product=self.product)
+        self.assertEqual(item.quantity, 2)
+
+    def test_sync_on_a_database_without_conflict_targets(self):
+        # MySQL: ON DUPLICATE KEY UPDATE, bulk_create() refuses unique_fields
+        with mock.patch.object(
+            type(connection.features), "supports_update_conflicts_with_target",
+            new_callable=mock.PropertyMock, return_value=False,
+        ):
+            counts = sync_cart_items(self.cart.id, {self.product.id: 3})
+        self.assertEqual(counts, {"created": 1, "updated": 0, "deleted": 0})
+        item = CartItem.objects.get(cart=self.cart, product=self.product)
+        self.assertEqual(item.quantity, 3)
+
+
+# ! Cart totals from the database (store.carts) and from the cache
+# ! storage: same values, always with 2 decimal places.
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        caches["carts"].clear()
+        collection = Collection.objects.create(title="Pens")
+        self.pen = Product.objects.create(
+            title="Pen", slug="pen", unit_price=Decimal("2.50"), inventory=10, collection=collection
+        )
+        self.ink = Product.objects.create(
+            title="Ink", slug="ink", unit_price=Decimal("1.25"), inventory=10, collection=collection
+        )
+
+    def test_line_and_cart_totals(self):
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.pen, quantity=3)
+        CartItem.objects.create(cart=cart, product=self.ink, quantity=1)
+
+        lines = CartItem.objects.filter(cart=cart).annotate(total=line_total()).values_list("product_id", "total")
+        self.assertEqual({product_id: str(total) for product_id, total in lines}, {
+            self.pen.id: "7.50", self.ink.id: "1.25",
+        })
+        total = Cart.objects.filter(pk=cart.pk).annotate(total=cart_total()).values_list("total", flat=True).get()
+        self.assertEqual(str(total), "8.75")
+
+        summary = cart_summary(cart.pk)
+        self.assertEqual(summary, {"id": cart.pk, "item_count": 2, "quantity": 4, "total_price": Decimal("8.75")})
+        self.assertEqual(str(summary["total_price"]), "8.75")
+        self.assertEqual(str(cart_summary(Cart.objects.create().pk)["total_price"]), "0.00")
+        self.assertIsNone(cart_summary(uuid4()))
+
+    def test_storages_agree_on_totals(self):
+        self.addCleanup(reset_cart_storage)
+        results = {}
+        for path in ["store.cart_storage.DatabaseCartStorage", "store.cart_storage.CacheCartStorage"]:
+            with self.subTest(path), override_settings(STORE_CART_STORAGE=path):
+                reset_cart_storage()
+                storage = get_cart_storage()
+                cart_id = storage.create_cart().id
+                storage.add_item(cart_id, self.pen.id, 3)
+                storage.add_item(cart_id, self.ink.id, 1)
+                cart = storage.get_cart(cart_id)
+                results[path] = (
+                    str(cart.total_price),
+                    sorted(str(item.total_price) for item in cart.items.all()),
+                    sorted(str(item.total_price) for item in storage.get_items(cart_id)),
+                    str(storage.summary(cart_id)["total_price"]),
+                    str(storage.create_cart().total_price),
+                )
+                self.assertEqual(results[path], ("8.75", ["1.25", "7.50"], ["1.25", "7.50"], "8.75", "0.00"))
+
+
+# ! The cache cart storage against a real (locmem) cache: carts live only
+# ! in the cache until a flush writes them behind, checkout flushes first.
+@override_settings(
+    STORE_CART_STORAGE="store.cart_storage.CacheCartStorage",
+    STORE_CART_FLUSH_BATCH=1000, STORE_CART_FLUSH_INTERVAL=60 * 60,
+)
+class CacheCartStorageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches["carts"].clear()
+        reset_cart_storage()
+        self.addCleanup(reset_cart_storage)
+        collection = Collection.objects.create(title="Mugs")
+        self.product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=4, inventory=10, collection=collection
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="carter", email="carter@example.com"))
+
+    def test_add_patch_flush_checkout(self):
+        cart_id = self.client.post("/store/carts/").data["id"]
+        items_url = f"/store/carts/{cart_id}/items/"
+        response = self.client.post(items_url, {"product_id": self.product.id, "quantity": 2}, format="json")
+        self.assertEqual(response.status_code, 201)
+        item_id = self.client.get(items_url).data[0]["id"]
+        response = self.client.patch(f"{items_url}{item_id}/", {"quantity": 3}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f"/store/carts/{cart_id}/").data["total_price"], 12)
+        # Nothing written yet
+        self.assertFalse(Cart.objects.filter(pk=cart_id).exists())
+
+        storage = get_cart_storage()
+        created_at = storage.get_cart(cart_id).created_at
+        self.assertEqual(storage.flush(), 1)
+        cart = Cart.objects.get(pk=cart_id)
+        self.assertEqual(cart.created_at, created_at)
+        self.assertEqual(list(cart.items.values_list("product_id", "quantity")), [(self.product.id, 3)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/store/orders/", {"cart_id": cart_id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(OrderItem.objects.values_list("product_id", "quantity")), [(self.product.id, 3)])
+        self.assertFalse(Cart.objects.filter(pk=cart_id).exists())
+        self.assertIsNone(storage.get_cart(cart_id))
+
+    def test_flush_carts_command_keeps_cart_timestamps(self):
+        storage = get_cart_storage()
+        cart = storage.create_cart()
+        storage.add_item(cart.id, self.product.id, 1)
+        state = storage.cache.get(storage.cart_key(cart.id))
+
+        out = StringIO()
+        call_command("flush_carts", stdout=out)
+        self.assertIn("Flushed 1 carts", out.getvalue())
+        row = Cart.objects.get(pk=cart.id)
+        self.assertEqual((row.created_at, row.updated_at), (state["created_at"], state["updated_at"]))
+        self.assertEqual(storage.cache.get(storage.dirty_key), {})
+
+    def test_flush_keeps_carts_it_lost_dirty(self):
+        storage = get_cart_storage()
+        kept = storage.create_cart().id
+        storage.add_item(kept, self.product.id, 1)
+        lost = storage.create_cart().id
+        storage.add_item(lost, self.product.id, 2)
+        # What an evicting cache would do to an unflushed cart
+        storage.cache.delete(storage.cart_key(lost))
+
+        with self.assertRaises(CartStateLost) as raised:
+            storage.flush()
+        self.assertEqual(raised.exception.cart_ids, [str(lost)])
+        self.assertEqual(raised.exception.flushed, 1)
+        self.assertTrue(Cart.objects.filter(pk=kept).exists())
+        self.assertEqual(list(storage.cache.get(storage.dirty_key)), [str(lost)])
+
+        with self.assertRaises(CommandError):
+            call_command("flush_carts", stdout=StringIO())
+        storage.discard([lost])
+        self.assertEqual(storage.flush(), 0)
+
+    def test_busy_cart_is_a_503(self):
+        storage = get_cart_storage()
+        cart_id = storage.create_cart().id
+        # Another request holds the cart
+        storage.cache.add(f"{storage.cart_key(cart_id)}:lock", "other", 5)
+        with mock.patch.object(CacheCartStorage, "lock_wait", 0.01):
+            response = self.client.post(
+                f"/store/carts/{cart_id}/items/", {"product_id": self.product.id, "quantity": 1}, format="json",
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data["detail"].code, "cart_busy")
+
+class CheckoutCatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_product_pages_show_stock_left_after_checkout(self):
+        collection = Collection.objects.create(title="Mugs")
+        product = Product.objects.create(title="Mug", slug="mug", unit_price=4, inventory=5, collection=collection)
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=product, quantity=2)
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username="buyer", email="buyer@example.com"))
+        detail = client.get(f"/store/products/{product.id}/")
+        self.assertEqual(client.get("/store/products/").data["results"][0]["inventory"], 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/store/orders/", {"cart_id": str(cart.id)}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(client.get(f"/store/products/{product.id}/").data["inventory"], 3)
+        self.assertEqual(client.get("/store/products/").data["results"][0]["inventory"], 3)
+        # A client holding the old ETag gets the new body, not a 304
+        response = client.get(f"/store/products/{product.id}/", HTTP_IF_NONE_MATCH=detail["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+# ! Product.effective_price: saves only look the promotions up when the
+# ! price changes, and the SQL refresh agrees with effective_price().
+class ProductPricingTests(TestCase):
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=Decimal("9.99"), inventory=5, collection=collection
+        )
+        self.promotion = Promotion.objects.create(description="Spring", discount=12.5)
+        product.promotions.add(self.promotion)
+
+    def save(self, product):
+        with CaptureQueriesContext(connection) as queries:
+            product.save()
+        return [query["sql"] for query in queries.captured_queries if "store_product_promotions" in query["sql"]]
+
+    def test_save_without_price_change_skips_the_promotions(self):
+        product = Product.objects.get()
+        product.title = "Big mug"
+        self.assertEqual(self.save(product), [])
+        self.assertEqual(Product.objects.values_list("effective_price", flat=True).get(), Decimal("8.74"))
+
+    def test_price_change_applies_the_best_promotion(self):
+        product = Product.objects.get()
+        product.promotions.add(Promotion.objects.create(description="Summer", discount=20))
+        product.refresh_from_db()
+        product.unit_price = Decimal("20.00")
+        self.assertEqual(len(self.save(product)), 1)
+        self.assertEqual(product.effective_price, Decimal("16.00"))
+        # Saved again as is, nothing left to look up
+        self.assertEqual(self.save(product), [])
+
+        product = Product.objects.prefetch_related("promotions").get()
+        product.unit_price = Decimal("10.00")
+        self.assertEqual(self.save(product), [])
+        self.assertEqual(Product.objects.values_list("effective_price", flat=True).get(), Decimal("8.00"))
+
+    def test_update_fields_without_the_price(self):
+        product = Product.objects.only("id", "inventory").get()
+        product.inventory = 3
+        with self.assertNumQueries(1):
+            product.save(update_fields=["inventory"])
+
+    def test_sql_refresh_matches_effective_price(self):
+        product = Product.objects.get()
+        for unit_price, discount in [("9.99", 12.5), ("10.00", 33.33333), ("7.77", 0.005), ("5.00", 150), ("5.00", -5)]:
+            with self.subTest(unit_price=unit_price, discount=discount):
+                Product.objects.filter(pk=product.pk).update(unit_price=Decimal(unit_price))
+                Promotion.objects.filter(pk=self.promotion.pk).update(discount=discount)
+                refresh_effective_prices([product.pk])
+                stored = Product.objects.values_list("effective_price", flat=True).get()
+                self.assertEqual(str(stored), str(effective_price(Decimal(unit_price), discount)))
+
+
+# ! ETag / If-None-Match on product endpoints: 304 while nothing changed,
+# ! a new body once the product, its price or a promotion on it did.
+class ProductConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title="Mugs")
+        self.product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=10, inventory=5, collection=collection
+        )
+        self.promotion = Promotion.objects.create(description="Spring", discount=10)
+        self.client = APIClient()
+        self.urls = ["/store/products/", f"/store/products/{self.product.id}/"]
+
+    def etags(self):
+        etags = {}
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response["ETag"]
+        return etags
+
+    def assertModified(self, etags):
+        for url, etag in etags.items():
+            with self.subTest(url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etag)
+
+    def test_unchanged_product_is_not_modified(self):
+        for url, etag in self.etags().items():
+            with self.subTest(url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b"")
+
+    def test_product_change_gives_a_new_body(self):
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = "Big mug"
+            self.product.save()
+        self.assertModified(etags)
+
+    def test_price_change_gives_a_new_body(self):
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.unit_price = 12
+            self.product.save()
+        self.assertModified(etags)
+        self.assertEqual(self.client.get(self.urls[1]).data["unit_price"], Decimal("12.00"))
+
+    def test_promotion_changes_give_a_new_body(self):
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.promotions.add(self.promotion)
+        self.assertModified(etags)
+
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.promotion.discount = 20
+            self.promotion.save()
+        self.assertModified(etags)
+
+
+# ! ?facets=1 on product listings: counts per collection and price bucket
+# ! for the filtered products, buckets are [min, max) with open ends.
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.mugs, self.cups = Collection.objects.create(title="Mugs"), Collection.objects.create(title="Cups")
+        for i, (price, collection) in enumerate([
+            ("5", self.mugs), ("10", self.mugs), ("24.99", self.mugs),
+            ("25", self.cups), ("100", self.cups), ("150", self.cups),
+        ]):
+            Product.objects.create(
+                title=f"Mug {i}", slug=f"mug-{i}", unit_price=Decimal(price), inventory=1, collection=collection,
+            )
+
+    def facets(self, **params):
+        response = APIClient().get("/store/products/", {"facets": "1", **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.json()["facets"]
+
+    def test_counts_per_collection_and_price_bucket(self):
+        facets = self.facets()
+        self.assertEqual(facets["collection_id"], [
+            {"value": self.mugs.id, "count": 3}, {"value": self.cups.id, "count": 3},
+        ])
+        # An edge price falls in the bucket it opens
+        self.assertEqual(facets["unit_price"], [
+            {"min": None, "max": 10, "count": 1},
+            {"min": 10, "max": 25, "count": 2},
+            {"min": 25, "max": 50, "count": 1},
+            {"min": 50, "max": 100, "count": 0},
+            {"min": 100, "max": None, "count": 2},
+        ])
+
+    def test_custom_buckets_and_filters(self):
+        facets = self.facets(price_buckets="25,10", collection_id=self.mugs.id)
+        self.assertEqual(facets["collection_id"], [{"value": self.mugs.id, "count": 3}])
+        self.assertEqual([(bucket["min"], bucket["max"], bucket["count"]) for bucket in facets["unit_price"]], [
+            (None, 10, 1), (10, 25, 2), (25, None, 0),
+        ])
+        response = APIClient().get("/store/products/", {"facets": "1", "price_buckets": "cheap"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_catalog_write_refreshes_cached_facets(self):
+        self.assertEqual(self.facets()["unit_price"][0]["count"], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(title="Cheap mug", slug="cheap", unit_price=1, inventory=1, collection=self.mugs)
+        # Same filters in another order share the facet entry, a stale
+        # one would still say 1
+        self.assertEqual(self.facets(ordering="-unit_price")["unit_price"][0]["count"], 2)
+
+
+# ! GET /store/products/export/ streams the filtered catalog in primary
+# ! key chunks, as CSV or NDJSON.
+class ProductExportTests(TestCase):
+    def setUp(self):
+        self.mugs, self.cups = Collection.objects.create(title="Mugs"), Collection.objects.create(title="Cups")
+        self.products = [
+            Product.objects.create(
+                title=f"Item {i}", slug=f"item-{i}", unit_price=1 + i, inventory=i,
+                collection=self.mugs if i % 2 else self.cups,
+            )
+            for i in range(7)
+        ]
+
+    def export(self, **params):
+        with mock.patch.object(ProductViewSet, "export_chunk_size", 3):
+            response = APIClient().get("/store/products/export/", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content).decode("utf-8")
+
+    def test_csv(self):
+        response, body = self.export(export_format="csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="products.csv"', response["Content-Disposition"])
+        rows = list(csv.DictReader(StringIO(body)))
+        self.assertEqual([int(row["id"]) for row in rows], [product.id for product in self.products])
+        self.assertEqual(rows[1]["collection_title"], "Mugs")
+        self.assertEqual(rows[2]["unit_price"], "3.00")
+
+    def test_ndjson_with_filters(self):
+        response, body = self.export(export_format="ndjson", collection_id=self.mugs.id, unit_price__gt=2)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in body.splitlines()]
+        expected = [product.id for product in self.products if product.collection_id == self.mugs.id][1:]
+        self.assertEqual([row["id"] for row in rows], expected)
+        self.assertEqual({row["collection_title"] for row in rows}, {"Mugs"})
+
+    def test_chunk_boundaries(self):
+        ids = [product.id for product in self.products]
+        for count, queries in [(7, 3), (6, 3), (3, 2), (2, 1)]:
+            with self.subTest(count=count):
+                queryset = Product.objects.filter(id__in=ids[:count])
+                with self.assertNumQueries(queries):
+                    rows = list(export_rows(queryset, chunk_size=3))
+                self.assertEqual([row[0] for row in rows], ids[:count])
+
+    def test_unknown_format(self):
+        response = APIClient().get("/store/products/export/", {"export_format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+
+# ! Abandoned cart reaping goes by the last change to a cart, not its age.
+class CartReaperTests(TestCase):
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        self.product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=4, inventory=10, collection=collection
+        )
+        long_ago = timezone.now() - timedelta(days=40)
+        self.idle, self.active, self.fresh = [Cart.objects.create() for _ in range(3)]
+        for cart in (self.idle, self.active):
+            CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        Cart.objects.filter(pk__in=[self.idle.pk, self.active.pk]).update(created_at=long_ago, updated_at=long_ago)
+        # Still being filled, a month after it was created
+        item = self.active.items.get()
+        get_cart_storage().update_item(self.active.pk, item.pk, 3)
+
+    def test_only_idle_carts_are_reaped(self):
+        stats = reap_abandoned_carts(ttl=timedelta(days=30), chunk_size=1)
+        self.assertEqual((stats["carts"], stats["items"]), (1, 1))
+        self.assertEqual(
+            set(Cart.objects.values_list("pk", flat=True)), {self.active.pk, self.fresh.pk}
+        )
+
+    def test_reap_carts_command(self):
+        out = StringIO()
+        call_command("reap_carts", "--ttl-hours", str(24 * 30), "--chunk-size", "1", stdout=out)
+        self.assertIn("Deleted 1 carts and 1 items", out.getvalue())
+        self.assertFalse(Cart.objects.filter(pk=self.idle.pk).exists())
+
+
+class OrderEventMetricsTests(TestCase):
+    def test_failed_events_are_not_counted_delivered(self):
+        metrics = Metrics()
+        metrics.record_batch(5, 2, 0.01)
+        snapshot = metrics.snapshot(depth=0)
+        self.assertEqual((snapshot["delivered"], snapshot["failed"]), (3, 2))
+
+# ! The order events outbox relay: claiming, retries with backoff,
+# ! pruning, and the relay_order_events command around them.
+class OrderOutboxTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="relay", email="relay@example.com")
+        self.orders = [Order.objects.create(customer=user.customer) for _ in range(3)]
+        # The checkout writes these, due right away here
+        self.events = [
+            OrderEvent.objects.create(order=order, available_at=timezone.now() - timedelta(seconds=1))
+            for order in self.orders
+        ]
+
+    def receive(self, receiver):
+        order_created.connect(receiver, weak=False)
+        self.addCleanup(order_created.disconnect, receiver)
+
+    def test_relays_claim_disjoint_batches(self):
+        for skip_locked in (True, False):
+            OrderEvent.objects.update(claim_token="", attempts=0, available_at=timezone.now() - timedelta(seconds=1))
+            with self.subTest(skip_locked=skip_locked), mock.patch.object(
+                type(connection.features), "has_select_for_update_skip_locked",
+                new_callable=mock.PropertyMock, return_value=skip_locked,
+            ):
+                first = claim_events(batch_size=2, lease=60)
+                second = claim_events(batch_size=2, lease=60)
+                self.assertEqual([event.pk for event in first], [event.pk for event in self.events[:2]])
+                self.assertEqual([event.pk for event in second], [self.events[2].pk])
+                self.assertNotEqual(first[0].claim_token, second[0].claim_token)
+                self.assertTrue(all(event.attempts == 1 for event in first + second))
+                # Leased, nothing is due until the lease runs out
+                self.assertEqual(claim_events(), [])
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        failing = self.orders[1].pk
+
+        def receiver(sender, order, **kwargs):
+            if order.pk == failing:
+                raise RuntimeError("mail server down")
+
+        self.receive(receiver)
+        with self.assertLogs("store.outbox", "ERROR"):
+            self.assertEqual(relay_batch(), (2, 1))
+        event = OrderEvent.objects.get(order_id=failing)
+        self.assertIsNone(event.delivered_at)
+        self.assertIn("mail server down", event.last_error)
+        self.assertEqual((event.attempts, event.claim_token), (1, ""))
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertLessEqual(event.available_at, timezone.now() + timedelta(seconds=2))
+        # Not due again before the backoff is over
+        self.assertEqual(relay_batch(), (0, 0))
+
+        failing = None
+        OrderEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+        self.assertEqual(relay_batch(), (1, 0))
+        event.refresh_from_db()
+        self.assertIsNotNone(event.delivered_at)
+        self.assertEqual(event.attempts, 2)
+
+    def test_prune_deletes_only_old_delivered_events(self):
+        long_ago = timezone.now() - timedelta(days=30)
+        old, recent, pending = self.events
+        OrderEvent.objects.filter(pk=old.pk).update(delivered_at=long_ago)
+        OrderEvent.objects.filter(pk=recent.pk).update(delivered_at=timezone.now())
+        # Undelivered for a month, still has to go out
+        OrderEvent.objects.filter(pk=pending.pk).update(available_at=long_ago)
+
+        self.assertEqual(prune_delivered(older_than=timedelta(days=1), chunk_size=1), 1)
+        self.assertEqual(
+            set(OrderEvent.objects.values_list("pk", flat=True)), {recent.pk, pending.pk}
+        )
+
+    def test_relay_order_events_command(self):
+        delivered = []
+        self.receive(lambda sender, order, **kwargs: delivered.append(order.pk))
+        out = StringIO()
+        # It would close the connection this test's transaction lives on
+        with mock.patch("store.management.commands.relay_order_events.close_old_connections"):
+            call_command("relay_order_events", "--once", "--batch-size", "2", stdout=out)
+        self.assertIn("Delivered 3 events, 0 failed", out.getvalue())
+        self.assertEqual(sorted(delivered), [order.pk for order in self.orders])
+        self.assertFalse(OrderEvent.objects.filter(delivered_at__isnull=True).exists())
+
+
+# ! OrderViewSet reads: the query count doesn't grow with the orders on
+# ! the page, and the denormalized totals follow item edits.
+class OrderReadTests(TestCase):
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        self.mug = Product.objects.create(title="Mug", slug="mug", unit_price=4, inventory=50, collection=collection)
+        self.cup = Product.objects.create(title="Cup", slug="cup", unit_price=3, inventory=50, collection=collection)
+        self.user = User.objects.create(username="reader", email="reader@example.com")
+        self.staff = User.objects.create(username="staff", email="staff@example.com", is_staff=True)
+        self.client = APIClient()
+
+    def place(self, customer):
+        order = Order.objects.create(customer=customer)
+        OrderItem.objects.create(order=order, product=self.mug, quantity=2, unit_price=Decimal("4.00"))
+        OrderItem.objects.create(order=order, product=self.cup, quantity=1, unit_price=Decimal("3.00"))
+        return order
+
+    def list_queries(self, user):
+        self.client.force_authenticate(user)
+        # The first request of a user does its one-off writes (customer row)
+        self.client.get("/store/orders/")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/store/orders/")
+        self.assertEqual(response.status_code, 200, response.data)
+        return len(queries), response.data
+
+    def test_list_queries_dont_grow_with_orders(self):
+        other = self.place(self.staff.customer)
+        self.place(self.user.customer)
+        for user in [self.user, self.staff]:
+            self.assertEqual(self.list_queries(user)[0], 2)
+        for _ in range(4):
+            self.place(self.user.customer)
+            self.place(self.staff.customer)
+
+        for user in [self.user, self.staff]:
+            with self.subTest(user.username):
+                count, data = self.list_queries(user)
+                # Orders, then their items with the products joined
+                self.assertEqual(count, 2)
+                orders = data["results"] if isinstance(data, dict) else data
+                self.assertEqual(len(orders), 5 if user == self.user else 10)
+                self.assertEqual(other.pk in [order["id"] for order in orders], user == self.staff)
+                self.assertTrue(all(len(order["items"]) == 2 for order in orders))
+
+    def test_totals_follow_item_changes(self):
+        order = self.place(self.user.customer)
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.total_price), (2, Decimal("11.00")))
+
+        item = order.items.get(product=self.mug)
+        item.quantity = 5
+        item.save()
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.total_price), (2, Decimal("23.00")))
+
+        item.delete()
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.total_price), (1, Decimal("3.00")))
+
+        order.items.all().delete()
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.total_price), (0, Decimal("0")))
+
+        self.client.force_authenticate(self.user)
+        data = self.client.get(f"/store/orders/{order.pk}/").data
+        self.assertEqual((data["item_count"], Decimal(str(data["total_price"]))), (0, Decimal("0")))
+
+
+class OrderArchiveTests(TestCase):
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        self.product = Product.objects.create(title="Mug", slug="mug", unit_price=4, inventory=5, collection=collection)
+        self.user = User.objects.create(username="archivist", email="archivist@example.com", is_staff=True)
+        self.order = Order.objects.create(customer=self.user.customer)
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2, unit_price=4)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def archive(self):
+        return archive_orders(age=timedelta(0))
+
+    def test_archiving_moves_rows_without_delete_signals(self):
+        self.order.refresh_from_db()
+        self.order.payment_status = Order.PAYMENT_COMPLETED
+        self.order.save()
+        OrderEvent.objects.create(
+            order=self.order, available_at=self.order.placed_at, delivered_at=self.order.placed_at,
+        )
+        history = CustomerHistory.objects.values().get(customer=self.user.customer)
+
+        with mock.patch("store.signals.handlers.refresh_order_totals") as refresh:
+            self.assertEqual(self.archive()["orders"], 1)
+        refresh.assert_not_called()
+
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertFalse(OrderEvent.objects.exists())
+        archived = ArchivedOrder.objects.get(pk=self.order.pk)
+        self.assertEqual((archived.item_count, archived.total_price), (1, 8))
+        self.assertEqual(list(archived.items.values_list("product_id", "quantity")), [(self.product.id, 2)])
+        self.assertEqual(CustomerHistory.objects.values().get(customer=self.user.customer), history)
+
+    def test_orders_with_undelivered_events_are_held_back(self):
+        later = Order.objects.create(customer=self.user.customer)
+        event = OrderEvent.objects.create(order=self.order, available_at=self.order.placed_at)
+
+        self.assertEqual(self.archive()["orders"], 1)
+        self.assertEqual(list(ArchivedOrder.objects.values_list("pk", flat=True)), [later.pk])
+        self.assertTrue(OrderEvent.objects.filter(pk=event.pk, delivered_at__isnull=True).exists())
+        self.assertTrue(Order.objects.filter(pk=self.order.pk).exists())
+
+        # Delivered now: the next run gets it, past the later order already moved
+        OrderEvent.objects.filter(pk=event.pk).update(delivered_at=timezone.now())
+        self.assertEqual(self.archive()["orders"], 1)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderEvent.objects.exists())
+
+    def test_product_referenced_only_by_archived_items_is_not_deleted(self):
+        self.assertEqual(self.archive()["orders"], 1)
+        response = self.client.delete(f"/store/products/{self.product.id}/")
+        self.assertEqual(response.status_code, 405)
+        self.assertTrue(Product.objects.filter(pk=self.product.pk).exists())
+
+    def test_archived_order_detail(self):
+        self.archive()
+        response = self.client.get(f"/store/orders/{self.order.id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["id"], self.order.id)
+        for pk in ("abc", self.order.id + 1):
+            with self.subTest(pk=pk):
+                self.assertEqual(self.client.get(f"/store/orders/{pk}/").status_code, 404)
+
+class PaymentReconciliationTests(TestCase):
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        product = Product.objects.create(title="Mug", slug="mug", unit_price=5, inventory=5, collection=collection)
+        self.user = User.objects.create(username="finance", email="finance@example.com", is_staff=True)
+        self.orders = {}
+        for status in (Order.PAYMENT_COMPLETED, Order.PAYMENT_FAILED):
+            order = Order.objects.create(customer=self.user.customer)
+            OrderItem.objects.create(order=order, product=product, quantity=2, unit_price=5)
+            order.refresh_from_db()
+            order.payment_status = status
+            order.save()
+            self.orders[status] = order
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def reconcile(self, rows):
+        response = self.client.post("/store/orders/reconcile/", rows, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def history(self):
+        history = CustomerHistory.objects.get(customer=self.user.customer)
+        return history.completed_order_count, history.total_spent
+
+    def test_history_follows_completed_and_failed_flips(self):
+        self.assertEqual(self.history(), (1, 10))
+        completed, failed = self.orders[Order.PAYMENT_COMPLETED], self.orders[Order.PAYMENT_FAILED]
+        report = self.reconcile([
+            {"id": completed.id, "payment_status": "F"},
+            {"id": failed.id, "payment_status": "Completed"},
+        ])
+        self.assertEqual(report["updated"], 2)
+        self.assertEqual(self.history(), (1, 10))
+        self.reconcile([{"id": completed.id, "payment_status": "C"}])
+        self.assertEqual(self.history(), (2, 20))
+        report = self.reconcile([
+            {"id": completed.id, "payment_status": "failed"},
+            {"id": failed.id, "payment_status": "F"},
+        ])
+        self.assertEqual((report["updated"], self.history()), (2, (0, 0)))
+
+    def test_archived_orders_are_reconciled_too(self):
+        order = self.orders[Order.PAYMENT_COMPLETED]
+        archive_orders(age=timedelta(0))
+        report = self.reconcile([{"id": order.id, "payment_status": "F"}])
+        self.assertEqual((report["updated"], report["unknown"]), (1, 0))
+        self.assertEqual(ArchivedOrder.objects.get(pk=order.id).payment_status, Order.PAYMENT_FAILED)
+        self.assertEqual(self.history(), (0, 0))
+
+    def test_out_of_range_ids_are_invalid_rows(self):
+        report = self.reconcile([
+            {"id": 10 ** 30, "payment_status": "C"},
+            {"id": -1, "payment_status": "C"},
+            {"id": 2 ** 63, "payment_status": "C"},
+        ])
+        self.assertEqual([row["row"] for row in report["invalid"]], [0, 1, 2])
+        self.assertEqual(report["updated"], 0)
+
+def skip_without_concurrent_writes(test):
+    if connection.vendor == "sqlite" and \
+            connection.settings_dict["OPTIONS"].get("transaction_mode") != "IMMEDIATE":
+        # Deferred SQLite transactions fail with "database is locked"
+        # instead of waiting when two of them start writing at once
+        # (storefront.test_settings, the default for manage.py test, sets it)
+        test.skipTest("needs row locks or SQLite transaction_mode IMMEDIATE")
+
+
+# ! GET /store/customers/<id>/history/ and the rebuild_customer_history
+# ! command. Orders go through checkout, so record_order() builds the
+# ! rollups incrementally the way it does in production.
+class CustomerHistoryMixin:
+    def setUp(self):
+        collection = Collection.objects.create(title="Mugs")
+        self.mug = Product.objects.create(title="Mug", slug="mug", unit_price=4, inventory=100, collection=collection)
+        self.cup = Product.objects.create(title="Cup", slug="cup", unit_price=3, inventory=100, collection=collection)
+        self.buyer = User.objects.create(username="buyer", email="buyer@example.com")
+
+    def checkout(self, user, lines):
+        cart = Cart.objects.create()
+        for product, quantity in lines:
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post("/store/orders/", {"cart_id": str(cart.id)}, format="json")
+        self.assertEqual(response.status_code, 200, response.data)
+        return Order.objects.get(pk=response.data["id"])
+
+    def complete(self, order):
+        order.payment_status = Order.PAYMENT_COMPLETED
+        order.save()
+
+    def rollups(self):
+        return (
+            list(CustomerHistory.objects.order_by("customer_id").values(
+                "customer_id", "order_count", "completed_order_count", "total_spent", "last_order_at",
+            )),
+            list(CustomerProductStat.objects.order_by("customer_id", "product_id").values(
+                "customer_id", "product_id", "quantity", "amount",
+            )),
+        )
+
+
+class CustomerHistoryTests(CustomerHistoryMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = self.checkout(self.buyer, [(self.mug, 2), (self.cup, 1)])
+        self.second = self.checkout(self.buyer, [(self.cup, 5)])
+        self.complete(self.first)
+        self.viewer = User.objects.create(username="viewer", email="viewer@example.com")
+        self.viewer.user_permissions.add(Permission.objects.get(codename="view_history"))
+        self.client = APIClient()
+
+    def history(self, user, customer_id=None, **params):
+        self.client.force_authenticate(user)
+        return self.client.get(f"/store/customers/{customer_id or self.buyer.customer.id}/history/", params)
+
+    def test_history_needs_the_view_history_permission(self):
+        self.assertEqual(self.client.get(f"/store/customers/{self.buyer.customer.id}/history/").status_code, 401)
+        # Staff alone isn't enough, nor being the customer
+        staff = User.objects.create(username="staff", email="staff@example.com", is_staff=True)
+        for user in [self.buyer, staff]:
+            with self.subTest(user.username):
+                self.assertEqual(self.history(user).status_code, 403)
+        self.assertEqual(self.history(self.viewer).status_code, 200)
+        self.assertEqual(self.history(self.viewer, customer_id=10**6).status_code, 404)
+
+    def test_history_payload(self):
+        response = self.history(self.viewer)
+        self.assertEqual(response.status_code, 200, response.data)
+        data = response.json()
+        self.assertEqual(data["customer_id"], self.buyer.customer.id)
+        self.assertEqual((data["order_count"], data["completed_order_count"]), (2, 1))
+        self.assertEqual(Decimal(data["total_spent"]), Decimal("11.00"))
+        self.assertIsNotNone(data["last_order_at"])
+        self.assertEqual(
+            [(row["product_id"], row["title"], row["quantity"], Decimal(row["amount"])) for row in data["top_products"]],
+            [(self.cup.id, "Cup", 6, Decimal("18.00")), (self.mug.id, "Mug", 2, Decimal("8.00"))],
+        )
+
+        self.assertEqual(len(self.history(self.viewer, top=1).json()["top_products"]), 1)
+        self.assertEqual(len(self.history(self.viewer, top="many").json()["top_products"]), 2)
+
+    def test_customer_without_orders(self):
+        data = self.history(self.viewer, customer_id=self.viewer.customer.id).json()
+        self.assertEqual((data["order_count"], data["completed_order_count"]), (0, 0))
+        self.assertEqual((Decimal(data["total_spent"]), data["last_order_at"], data["top_products"]), (0, None, []))
+
+
+# ! The rebuild runs its chunks in worker threads with their own
+# ! connections, so the orders have to be committed
+class CustomerHistoryRebuildTests(CustomerHistoryMixin, TransactionTestCase):
+    def setUp(self):
+        skip_without_concurrent_writes(self)
+        super().setUp()
+
+    def test_rebuild_matches_incremental_history(self):
+        other = User.objects.create(username="other", email="other@example.com")
+        old = self.checkout(self.buyer, [(self.mug, 2), (self.cup, 1)])
+        self.complete(old)
+        self.checkout(other, [(self.mug, 1)])
+        # Archived orders count too, history is lifetime
+        self.assertEqual(archive_orders(age=timedelta(0))["orders"], 2)
+        self.complete(self.checkout(self.buyer, [(self.cup, 3)]))
+        self.checkout(self.buyer, [(self.mug, 1), (self.cup, 1)])
+        self.checkout(other, [(self.cup, 2)])
+
+        incremental = self.rollups()
+        self.assertEqual(len(incremental[0]), 2)
+        CustomerHistory.objects.update(order_count=0, total_spent=0)
+        CustomerProductStat.objects.all().delete()
+
+        call_command("rebuild_customer_history", chunk_size=1, workers=2, stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+
+# ! Many customers checking out at once, competing for the same stock.
+# ! Every cart holds the two scarce products in opposite orders, which
+# ! deadlocks unless stock is always locked in the same (id) order.
+class CheckoutStockStressTests(TransactionTestCase):
+    CUSTOMERS = 12
+    STOCK = 5
+
+    def setUp(self):
+        skip_without_concurrent_writes(self)
+        collection = Collection.objects.create(title="Limited")
+        self.scarce = [
+            Product.objects.create(
+                title=f"Limited {i}", slug=f"limited-{i}", unit_price=10,
+                inventory=self.STOCK, collection=collection,
+            )
+            for i in range(2)
+        ]
+        self.carts = []
+        for i in range(self.CUSTOMERS):
+            cart = Cart.objects.create()
+            products = self.scarce if i % 2 else self.scarce[::-1]
+            for product in products:
+                CartItem.objects.create(cart=cart, product=product, quantity=1)
+            user = User.objects.create(username=f"buyer{i}", email=f"buyer{i}@example.com")
+            self.carts.append((user, cart))
+
+    def checkout(self, customer):
+        user, cart = customer
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            response = client.post("/store/orders/", {"cart_id": str(cart.id)}, format="json")
+            return response.status_code, response.data
+        finally:
+            connections.close_all()
+
+    def test_concurrent_checkouts_never_oversell(self):
+        with ThreadPoolExecutor(max_workers=self.CUSTOMERS) as pool:
+            results = list(pool.map(self.checkout, self.carts))
+
+        statuses = [status for status, _ in results]
+        self.assertEqual(statuses.count(200), self.STOCK, results)
+        self.assertEqual(statuses.count(400), self.CUSTOMERS - self.STOCK, results)
+        for status, data in results:
+            if status == 400:
+                self.assertIn("items", data)
+
+        for product in self.scarce:
+            product.refresh_from_db()
+            self.assertEqual(product.inventory, 0)
+            sold = sum(OrderItem.objects.filter(product=product).values_list("quantity", flat=True))
+            self.assertEqual(sold, self.STOCK)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+        # Failed checkouts are rolled back whole, their carts are still there
+        self.assertEqual(Cart.objects.count(), self.CUSTOMERS - self.STOCK)
+
+
+# ! A flaky client sending the same order request several times, some of
+# ! them at the same moment. Only one order may come out of it.
+class IdempotentCheckoutTests(TransactionTestCase):
+    RETRIES = 6
+
+    def setUp(self):
+        skip_without_concurrent_writes(self)
+        collection = Collection.objects.create(title="Mugs")
+        product = Product.objects.create(
+            title="Mug", slug="mug", unit_price=10, inventory=100, collection=collection
+        )
+        self.user = User.objects.create(username="flaky", email="flaky@example.com")
+        self.cart = Cart.objects.create()
+        CartItem.objects.create(cart=self.cart, product=product, quantity=2)
+
+    def place_order(self, key):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            response = client.post(
+                "/store/orders/", {"cart_id": str(self.cart.id)},
+                format="json", HTTP_IDEMPOTENCY_KEY=key,
+            )
+            return response.status_code, response.json()
+        finally:
+            connections.close_all()
+
+    def test_concurrent_retries_place_one_order(self):
+        with ThreadPoolExecutor(max_workers=self.RETRIES) as pool:
+            results = list(pool.map(self.place_order, ["order-1"] * self.RETRIES))
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual({status for status, _ in results}, {200}, results)
+        self.assertEqual({body["id"] for _, body in results}, {Order.objects.get().id})
+
+        # A later retry is answered from the stored response
+        status, body = self.place_order("order-1")
+        self.assertEqual((status, body["id"]), (200, Order.objects.get().id))
+
+    def test_retry_after_a_failed_response_places_one_order(self):
+        # The first attempt breaks while rendering the order (a read that
+        # hits a locked database, say), the retry must not fail on the cart
+        render = OrderSerializer.to_representation
+        calls = []
+
+        def flaky_render(serializer, order):
+            calls.append(order.pk)
+            if len(calls) == 1:
+                raise DatabaseError("database is locked")
+            return render(serializer, order)
+
+        with mock.patch.object(OrderSerializer, "to_representation", flaky_render):
+            with self.assertRaises(DatabaseError):
+                self.place_order("order-3")
+            status, body = self.place_order("order-3")
+        self.assertEqual(status, 200)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(body["id"], Order.objects.get().id)
+
+    def test_server_error_response_rolls_back_the_order(self):
+        # The handler places the order, then answers 500 instead of raising
+        checkout = OrderViewSet.checkout
+
+        def failing_checkout(view, request):
+            checkout(view, request)
+            return Response({"detail": "Payment provider unavailable."}, status=503)
+
+        with mock.patch.object(OrderViewSet, "checkout", failing_checkout):
+            status, _ = self.place_order("order-4")
+        self.assertEqual(status, 503)
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertTrue(Cart.objects.filter(pk=self.cart.pk).exists())
+        self.assertFalse(IdempotencyKey.objects.filter(key="order-4").exists())
+
+        status, body = self.place_order("order-4")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["id"], Order.objects.get().id)
+
+    def test_key_reused_for_another_request_is_refused(self):
+        self.assertEqual(self.place_order("order-2")[0], 200)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            "/store/orders/", {"cart_id": str(Cart.objects.create().id)},
+            format="json", HTTP_IDEMPOTENCY_KEY="order-2",
+        )
+        self.assertEqual(response.status_code, 422)
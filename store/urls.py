@@ -1,4 +1,4 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from . import views
 from rest_framework_nested import routers
 
@@ -18,7 +18,14 @@ products_router.register("reviews", views.ReviewViewSet, basename='product-revie
 carts_router = routers.NestedDefaultRouter(router,"carts", lookup="cart")
 carts_router.register("items",views.CartItemsViewSet, basename="cart-items")
 
-urlpatterns = router.urls + products_router.urls + carts_router.urls
+# ! The nested router has no PUT on a list route, so the whole-cart
+# ! replace gets its own path in front of the router ones (trailing slash
+# ! optional, a PUT can't follow the APPEND_SLASH redirect)
+cart_items_list = views.CartItemsViewSet.as_view({"get": "list", "post": "create", "put": "replace"})
+
+urlpatterns = [
+    re_path(r"^carts/(?P<cart_pk>[^/.]+)/items/?$", cart_items_list, name="cart-items-list"),
+] + router.urls + products_router.urls + carts_router.urls
 
 # ! This is how we use souters
 # router = SimpleRouter()
@@ -6,22 +6,53 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from store.permissions import FullDjangoModelPermissions, IsAdminOrReadOnly, ViewCustomerHistoryPermission
-from .models import Order, Product, Collection, OrderItem, Review, Cart, CartItem
+from .models import Order, Product, Collection, OrderItem, Review, Cart, CartItem, CustomerHistory, ArchivedOrder, ArchivedOrderItem
 from .serializers import *
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 # Generic filtering, by this third party library we can filter any
 # listings by any field of the model 
 from django_filters.rest_framework import DjangoFilterBackend
-from .filters import ProductFilter
+from .filters import ProductFilter, ProductSearchFilter
 #using for searching productsd using text
 from rest_framework.filters import SearchFilter, OrderingFilter
 # implement pagination
 from rest_framework.pagination import PageNumberPagination
-from .pagination import DefaultPagination
+from .pagination import DefaultPagination, ProductPagination, wants_page_numbers
+from .cache import CatalogCacheMixin, invalidate_catalog
+from .search import get_search_backend
+from .facets import ProductFacets
+from .conditional import ConditionalGetMixin, latest
+from .export import CONTENT_TYPES, STREAMS, export_rows
+from .carts import carts_with_totals, cart_items_with_totals
+from .cart_storage import get_cart_storage
+from .events import get_order_event_dispatcher
+from .history import top_products
+from .idempotency import IdempotencyMixin
+from .reconciliation import Reconciliation, parse_row
+from django.http import Http404
+from uuid import UUID
+from django.http import StreamingHttpResponse
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, ListModelMixin, UpdateModelMixin
 from rest_framework.decorators import action
+from rest_framework.exceptions import MethodNotAllowed
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+
+# Cart ids are UUIDs, anything else simply isn't a cart
+def parse_cart_id(value):
+    try:
+        return UUID(str(value))
+    except ValueError:
+        raise Http404
+
+# Same for integer ids, before they reach a filter() that would raise
+def parse_id(value):
+    try:
+        return int(str(value))
+    except ValueError:
+        raise Http404
+
 #Level 4 Viewsets ########################################################
 # ! we use view sets to combine different generic APIViews into one viewset
 # ! This help to reduce duplicate code and methods that are same in logic but 
@@ -30,21 +61,59 @@ from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 # ! and can do any kind of operations
 # simple api views using methods> APIViews > Generic views > Viewsets
 
-class ProductViewSet(ModelViewSet):
+# ! Lets a viewset list rows through queryset.values() and a light
+# ! read only serializer instead of building a model instance per row
+class ValuesListMixin:
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.values_serializer_class
+        if serializer_class is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        # Keep annotations (search_rank) and the ?ordering= columns so keyset
+        # pagination can build its cursor from them, the serializer only
+        # outputs its own value_fields
+        ordering = [field.lstrip("-") for field in queryset.query.order_by if isinstance(field, str)]
+        fields = dict.fromkeys([*serializer_class.value_fields, *queryset.query.annotations, *ordering])
+        queryset = queryset.values(*fields)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer_class(page, many=True).data)
+        return Response(serializer_class(queryset, many=True).data)
+
+
+class ProductViewSet(ConditionalGetMixin, CatalogCacheMixin, ValuesListMixin, ModelViewSet):
     # This implementation combine queryset and serialized class from productList 
     # and ProductDetail Generic APIView, also use one delete method
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    # Listings skip ProductSerializer, see ValuesListMixin
+    values_serializer_class = ProductValuesSerializer
+    bulk_max_rows = 5000
+    export_chunk_size = 2000
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
-    search_fields = ["title", "description" ] #search products based on text title, desc
-    ordering_fields = ["unit_price", "last_update"] #sorting
-    pagination_class = DefaultPagination
+    # ! Searching on title, description is done by store.search backends now
+    # ! (see SEARCH_FIELDS there) instead of SearchFilter's LIKE '%term%'
+    # search_fields = ["title", "description" ] #search products based on text title, desc
+    ordering_fields = ["unit_price", "effective_price", "last_update"] #sorting
+    # ! Keyset pagination by default, page numbers only when asked for
+    pagination_class = ProductPagination
     # filterset_fields = ["collection_id"] #on which field we want filter
 
     #Customer permissions to endpoints for this view
     permission_classes = [IsAdminOrReadOnly]
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if wants_page_numbers(self.request):
+                self._paginator = DefaultPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     # ! After implementing generic filtering using django_filter liabrary
     # ! I have removed/commented the following code which was for filtering
@@ -56,18 +125,100 @@ class ProductViewSet(ModelViewSet):
     #         queryset = queryset.filter(collection_id=collection_id)
     #     return queryset
         
+    # ! ?facets=1 adds collection / price bucket counts for the current
+    # ! filters next to the page of products (see store.facets)
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        # Searches only ever return the best N matches (see store.search)
+        max_results = get_search_backend().max_results
+        if max_results and ProductSearchFilter().get_search_query(self.request):
+            response.data['search_max_results'] = max_results
+        if self.request.query_params.get('facets') in ('1', 'true'):
+            queryset = self.filter_queryset(self.get_queryset())
+            response.data['facets'] = ProductFacets(self.request, queryset).get()
+        return response
+
+    # ! Cheap probes for ETag / Last-Modified (see ConditionalGetMixin)
+    def get_list_validators(self):
+        return self.filter_queryset(self.get_queryset()) \
+            .aggregate(last_modified=Max('last_update'), count=Count('id'))
+
+    def get_detail_validators(self):
+        return Product.objects.filter(pk=parse_id(self.kwargs['pk'])) \
+            .aggregate(last_modified=Max('last_update'), count=Count('id'))
+
+    # ! POST /store/products/bulk/ with a list of products, creates and
+    # ! updates them all in one transaction or returns errors per row
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request):
+        serializer = BulkProductSerializer(
+            data=request.data, many=True, max_length=self.bulk_max_rows
+        )
+        serializer.is_valid(raise_exception=True)
+        result = serializer.save()
+
+        # bulk_create / bulk_update don't send post_save signals
+        products = result['created'] + result['updated']
+        transaction.on_commit(lambda: get_search_backend().index_many(products), robust=True)
+        invalidate_catalog()
+
+        return Response({
+            "created": [product.id for product in result['created']],
+            "updated": [product.id for product in result['updated']],
+        }, status=status.HTTP_201_CREATED if result['created'] else status.HTTP_200_OK)
+
+    # ! GET /store/products/export/?export_format=csv|ndjson streams the whole
+    # ! catalog (ProductFilter and ?search= still apply) instead of
+    # ! making partners walk every page of the API
+    @action(detail=False, methods=['GET'])
+    def export(self, request):
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in STREAMS:
+            return Response(
+                {"error": f"export_format must be one of {', '.join(STREAMS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = export_rows(queryset, chunk_size=self.export_chunk_size)
+        response = StreamingHttpResponse(
+            STREAMS[export_format](rows), content_type=CONTENT_TYPES[export_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{export_format}"'
+        return response
+
     def destroy(self, request, *args, **kwargs):
-       
-        if OrderItem.objects.filter(product_id=kwargs['pk']).count() > 0:
+        # Archived order items (store.archive) keep the product too
+        product_id = parse_id(kwargs['pk'])
+        if OrderItem.objects.filter(product_id=product_id).exists() or \
+                ArchivedOrderItem.objects.filter(product_id=product_id).exists():
             return Response({"error":"product can't be deleted, bcs it is linked with ordered item"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
         return super().destroy(request, *args, **kwargs)
     
     
-class CollectionViewSet(ModelViewSet):
+class CollectionViewSet(ConditionalGetMixin, CatalogCacheMixin, ModelViewSet):
     queryset = Collection.objects.annotate(products_count=Count("products"))
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly] #My customer permission class
 
+    # products_count depends on products too, so both tables are probed
+    def collection_validators(self, collections, products):
+        collections = collections.aggregate(last_modified=Max('last_update'), count=Count('id'))
+        products = products.aggregate(last_modified=Max('last_update'), count=Count('id'))
+        return {
+            "last_modified": latest(collections['last_modified'], products['last_modified']),
+            "collections": collections['count'],
+            "products": products['count'],
+        }
+
+    def get_list_validators(self):
+        return self.collection_validators(Collection.objects.all(), Product.objects.all())
+
+    def get_detail_validators(self):
+        pk = parse_id(self.kwargs['pk'])
+        return self.collection_validators(
+            Collection.objects.filter(pk=pk), Product.objects.filter(collection_id=pk)
+        )
+
     def delete(self, request, pk):
         collection = get_object_or_404(Collection, pk = pk)
         if collection.products.count() > 0:
@@ -90,13 +241,39 @@ class CartViewSet(
                     RetrieveModelMixin, 
                     GenericViewSet,
                     DestroyModelMixin ):
-    queryset = Cart.objects.prefetch_related("items__product").all()
+    # ! Carts are read and written through the configured cart storage
+    # ! (store.cart_storage), database or cache hot store. The queryset is
+    # ! only here for the router basename / browsable API.
+    queryset = carts_with_totals()
     serializer_class = CartSerializer
 
+    def create(self, request, *args, **kwargs):
+        cart = get_cart_storage().create_cart()
+        return Response(CartSerializer(cart).data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk):
+        cart = get_cart_storage().get_cart(parse_cart_id(pk))
+        if cart is None:
+            raise Http404
+        return Response(CartSerializer(cart).data)
+
+    def destroy(self, request, pk):
+        if not get_cart_storage().delete_cart(parse_cart_id(pk)):
+            raise Http404
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    # ! GET /store/carts/{id}/summary/ totals and counts only, no items
+    @action(detail=True)
+    def summary(self, request, pk):
+        summary = get_cart_storage().summary(parse_cart_id(pk))
+        if summary is None:
+            return Response({"error": "No cart with given id found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(CartSummarySerializer(summary).data)
+
 
 class CartItemsViewSet(ModelViewSet):
-    #The methods we allow for this endpoint
-    http_method_names = ['get', "post", "patch", "delete"]
+    #The methods we allow for this endpoint, PUT only on the list (replace)
+    http_method_names = ['get', "post", "put", "patch", "delete"]
 
     #This is how to customly get Serializer based on scenario
     def get_serializer_class(self):
@@ -109,12 +286,43 @@ class CartItemsViewSet(ModelViewSet):
         return CartItemSerializer
     #This is how to pass some context to serialzer from url 
     def get_serializer_context(self):
-        return {"cart_id": self.kwargs['cart_pk']}
+        return {"cart_id": parse_cart_id(self.kwargs['cart_pk'])}
     # How to create a custom query set
     def get_queryset(self):
-        return CartItem.objects.\
-            filter(cart_id = self.kwargs['cart_pk']). \
-            select_related('product')
+        return cart_items_with_totals(). \
+            filter(cart_id = self.kwargs['cart_pk'])
+
+    # ! Reads and writes go through the cart storage, like CartViewSet
+    def get_object(self):
+        item = get_cart_storage().get_item(parse_cart_id(self.kwargs['cart_pk']), self.kwargs['pk'])
+        if item is None:
+            raise Http404
+        return item
+
+    def list(self, request, *args, **kwargs):
+        items = get_cart_storage().get_items(parse_cart_id(self.kwargs['cart_pk']))
+        return Response(CartItemSerializer(items, many=True).data)
+
+    def update(self, request, *args, **kwargs):
+        # Single lines are only PATCHed, PUT is the whole cart at once
+        if not kwargs.get("partial"):
+            raise MethodNotAllowed(request.method)
+        return super().update(request, *args, **kwargs)
+
+    # ! PUT /store/carts/{id}/items/ with the full list of lines the client
+    # ! wants. Applied as a diff in one transaction, returns the new cart.
+    def replace(self, request, *args, **kwargs):
+        serializer = SyncCartItemListSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        cart = get_cart_storage().get_cart(parse_cart_id(self.kwargs['cart_pk']))
+        return Response(CartSerializer(cart).data)
+
+    def destroy(self, request, *args, **kwargs):
+        cart_id = parse_cart_id(self.kwargs['cart_pk'])
+        if not get_cart_storage().remove_item(cart_id, self.kwargs['pk']):
+            raise Http404
+        return Response(status=status.HTTP_204_NO_CONTENT)
     
 
 # This is how can We get and update the customer profile data
@@ -144,15 +352,25 @@ class CustomerViewSet(ModelViewSet):
     
     # Anyone who have permission from admin can see customers history
     # The permission is give in from admin panel, and is implemented here
+    # ! Read from the CustomerHistory rollups (store.history), ?top=N
+    # ! picks how many top products come back
     @action(detail=True, permission_classes = [ViewCustomerHistoryPermission])
     def history(self, request, pk):
-        return Response("OK")
+        customer = get_object_or_404(Customer.objects.only("id"), pk=pk)
+        try:
+            top = min(max(int(request.query_params.get("top", 5)), 0), 50)
+        except ValueError:
+            top = 5
+        rollup = CustomerHistory.objects.filter(customer=customer).first() \
+            or CustomerHistory(customer=customer)
+        rollup.top_products = top_products(customer.id, top)
+        return Response(CustomerHistorySerializer(rollup).data)
 
 
     @action(detail=False, methods=['GET', 'PUT'],
             permission_classes=[IsAuthenticated]) #Action on list view not detail view
     def me(self, request):
-        (customer, created) = Customer.objects.get(user_id = request.user.id)
+        (customer, created) = Customer.objects.get_or_create(user_id = request.user.id)
 
         if request.method == 'GET':
             serializer = CustomerSerializer(customer)
@@ -165,26 +383,56 @@ class CustomerViewSet(ModelViewSet):
             return Response(serializer.data)
 
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(IdempotencyMixin, ModelViewSet):
     # queryset = Order.objects.all()
     http_method_names = ["get","post", "patch", "delete", "head", "options"]
 
     def get_permissions(self):
-        if self.request.method in ['PATCH',"DELETE"]:
+        if self.request.method in ['PATCH',"DELETE"] or self.action in ["event_metrics", "reconcile"]:
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
-    def validate_cart_id(self, cart_id):
-        if not Cart.objects.filter(pk=cart_id).exists():
-            raise serializers.ValidationError("No cart with given id found")
-        
-        if CartItem.objects.filter(cart_id=cart_id).count() == 0:
-            raise serializers.ValidationError("No Items founds in cart")
-
-        return cart_id
-
-
+    # ! POST /store/orders/reconcile/ settlement results in bulk:
+    # ! [{"id": 1, "payment_status": "C"}, ...] (or {"results": [...]}).
+    # ! Applied by store.reconciliation in a few UPDATEs per status.
+    reconcile_max_rows = 50000
+    reconcile_chunk_size = 5000
+
+    @action(detail=False, methods=["post"])
+    def reconcile(self, request):
+        rows = request.data.get("results") if isinstance(request.data, dict) else request.data
+        if not isinstance(rows, list):
+            return Response({"error": "Expected a list of {id, payment_status} objects"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > self.reconcile_max_rows:
+            return Response({"error": f"At most {self.reconcile_max_rows} rows per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        reconciliation = Reconciliation(dry_run=request.query_params.get("dry_run") in ("1", "true"))
+        parsed = []
+        for index, row in enumerate(rows):
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError("Expected an object")
+                parsed.append(parse_row(row.get("id"), row.get("payment_status")))
+            except ValueError as error:
+                reconciliation.add_invalid(index, str(error))
+        for start in range(0, len(parsed), self.reconcile_chunk_size):
+            reconciliation.apply(parsed[start:start + self.reconcile_chunk_size])
+        return Response(reconciliation.report())
+
+    # ! GET /store/orders/event_metrics/ order event queue depth, counters
+    # ! and handler latency of this process (store.events)
+    @action(detail=False)
+    def event_metrics(self, request):
+        return Response(get_order_event_dispatcher().stats())
+
+    # ! Retries carrying the same Idempotency-Key header get the first
+    # ! response back instead of placing the order again
     def create(self, request, *args, **kwargs):
+        return self.idempotent(request, self.checkout)
+
+    def checkout(self, request):
         # here we mentioning and passing data ot serializer because its in 
         # create method otherwise we create a global serializer_class = ''
         serializer = CreateOrderSerializer(
@@ -207,17 +455,36 @@ class OrderViewSet(ModelViewSet):
         return OrderSerializer
 
    
-    #! This is violation of command query separation principle
+    # ! Old orders live in the archive tables (store.archive), the detail
+    # ! endpoint looks there when the order isn't in the hot table
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            archived = self.get_archived_queryset().filter(pk=parse_id(kwargs["pk"])).first()
+            if archived is None:
+                raise
+            return Response(OrderSerializer(archived).data)
+
+    def get_archived_queryset(self):
+        user = self.request.user
+        queryset = ArchivedOrder.objects.prefetch_related(
+            Prefetch("items", queryset=ArchivedOrderItem.objects.select_related("product"))
+        )
+        if user.is_staff:
+            return queryset
+        return queryset.filter(customer__user_id = user.id)
+
+    # ! Items and their products come in two prefetch queries for the whole
+    # ! page, and the customer is a join, not a separate lookup
     def get_queryset(self):
         user = self.request.user
+        queryset = Order.objects.prefetch_related(
+            Prefetch("items", queryset=OrderItem.objects.select_related("product"))
+        ).order_by("id")
         if user.is_staff:
-            return Order.objects.all()
-       
-        # If the customer is not created it will create it & avoid throwing error
-        # This is query method to get some data but here we are potentially changing
-        # The state of data by create
-        customer_id = Customer.objects.only('id').get(user_id=user.id)
-        return Order.objects.filter(customer_id = customer_id)
+            return queryset
+        return queryset.filter(customer__user_id = user.id)
     
     
 
@@ -116,6 +116,73 @@ DATABASES = {
     }                                           
 }
 
+# Cache used for the catalog read-through cache (store.cache)
+# locmem is per process, point this at redis/memcached in production
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "storefront",
+    },
+    # Carts in the cache hot store exist only here until they are flushed,
+    # so they get a cache of their own that never culls them (in
+    # production a Redis with maxmemory-policy noeviction)
+    "carts": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "storefront-carts",
+        "OPTIONS": {"MAX_ENTRIES": 10 ** 7},
+    },
+}
+
+STORE_CATALOG_CACHE = "default"
+STORE_CATALOG_CACHE_TIMEOUT = 60 * 5
+
+# The in-process search index (SQLite / tests) returns at most this many
+# matches per search, listings report it as "search_max_results"
+STORE_SEARCH_MAX_RESULTS = 1000
+
+# Where carts live (store.cart_storage). Use
+# "store.cart_storage.CacheCartStorage" for the cache hot store which
+# writes carts behind to the database in batches and before checkout.
+STORE_CART_STORAGE = "store.cart_storage.DatabaseCartStorage"
+STORE_CART_CACHE = "carts"
+STORE_CART_CACHE_TIMEOUT = 60 * 60 * 24
+STORE_CART_FLUSH_BATCH = 50
+STORE_CART_FLUSH_INTERVAL = 30
+
+# Carts nobody changed for this long are deleted by `manage.py reap_carts`. Set
+# STORE_CART_REAPER_INTERVAL (seconds) to also reap from the web process.
+STORE_CART_TTL = 60 * 60 * 24 * 30
+STORE_CART_REAPER_INTERVAL = None
+STORE_CART_REAPER_CHUNK = 500
+
+# order_created receivers run after commit on a pool of worker threads
+# (store.events). STORE_ORDER_EVENTS_ASYNC = False sends them in the
+# request thread, still after commit.
+STORE_ORDER_EVENTS_ASYNC = True
+STORE_ORDER_EVENTS_WORKERS = 2
+STORE_ORDER_EVENTS_QUEUE_SIZE = 1000
+STORE_ORDER_EVENTS_BATCH_SIZE = 50
+STORE_ORDER_EVENTS_BATCH_WAIT = 0.05
+
+# Every order event is also written to the OrderEvent outbox in the
+# checkout transaction. `manage.py relay_order_events` sends the ones the
+# workers above haven't marked delivered after STORE_OUTBOX_RELAY_DELAY
+# seconds, and prunes delivered rows older than STORE_OUTBOX_RETENTION.
+STORE_OUTBOX_RELAY_DELAY = 30
+STORE_OUTBOX_RETENTION = 60 * 60 * 24 * 7
+
+# Idempotency-Key on POST /store/orders/: responses are replayed for
+# STORE_IDEMPOTENCY_TTL, a duplicate waits up to STORE_IDEMPOTENCY_WAIT
+# for the first request, a claim older than STORE_IDEMPOTENCY_LEASE is
+# considered abandoned. `manage.py purge_idempotency_keys` drops expired keys.
+STORE_IDEMPOTENCY_TTL = 60 * 60 * 24
+STORE_IDEMPOTENCY_WAIT = 10
+STORE_IDEMPOTENCY_LEASE = 60
+
+# Orders older than this are moved to the archive tables by
+# `manage.py archive_orders`
+STORE_ORDER_ARCHIVE_AFTER = 60 * 60 * 24 * 365
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -161,7 +228,8 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # JWTAuthentication with request.user cached (core.authentication)
+        'core.authentication.CachedJWTAuthentication',
        ),
        
     "DEFAULT_PERMISSION_CLASSES": [
@@ -178,6 +246,10 @@ REST_FRAMEWORK = {
     #setting pagination gloabbaly for every viewset
      }
 
+# How long a user snapshot behind a JWT is reused (seconds), saves bump it
+AUTH_USER_CACHE = "default"
+AUTH_USER_CACHE_TIMEOUT = 60
+
 SIMPLE_JWT = {
    'AUTH_HEADER_TYPES': ('JWT',),
    "ACCESS_TOKEN_LIFETIME":timedelta(days=1)
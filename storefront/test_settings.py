@@ -0,0 +1,24 @@
+from .settings import *
+
+# ! Settings `python manage.py test` uses by default (see manage.py), so the
+# ! suite runs without a MySQL server. Set DJANGO_SETTINGS_MODULE to
+# ! storefront.settings to run it against MySQL instead.
+# ! The test database is a file, not SQLite's in-memory default: the
+# ! concurrency tests open a connection per thread, and IMMEDIATE
+# ! transactions make concurrent writers wait for each other (like row
+# ! locks would) instead of failing with "database is locked".
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "storefront.sqlite3",
+        "TEST": {"NAME": BASE_DIR / "test_storefront.sqlite3"},
+        "OPTIONS": {"transaction_mode": "IMMEDIATE", "timeout": 20},
+    }
+}
+
+# The toolbar refuses to run under the test runner
+DEBUG_TOOLBAR_CONFIG = {"IS_RUNNING_TESTS": False}
+
+# Deliver order events in the request (on commit), not from worker threads
+# that would still be running when the test database is destroyed
+STORE_ORDER_EVENTS_ASYNC = False
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "storefront.settings")
 
 application = get_wsgi_application()
+
+# Periodic abandoned cart cleanup, a no-op unless STORE_CART_REAPER_INTERVAL is set
+from store.cart_reaper import start_cart_reaper  # noqa: E402
+
+start_cart_reaper()